@@ -0,0 +1,89 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of ahead of time compiled inference functions.
+
+A jitted function is lowered from abstract arguments and compiled once, then
+its executable is serialized to cache_dir under a key hashing the config, the
+device topology, the jax version and the shapes, dtypes and shardings of the
+arguments. Later processes computing the same key deserialize the executable
+instead of compiling it again, like train_compile does for the train step.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+from typing import Any, Callable, Dict, Sequence
+
+import jax
+from jax.experimental.serialize_executable import deserialize_and_load, serialize
+
+log = logging.getLogger(__name__)
+
+
+def abstractify(tree: Any) -> Any:
+  """Returns the ShapeDtypeStructs of the arrays of a pytree, keeping their shardings."""
+  return jax.tree_util.tree_map(lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=x.sharding), tree)
+
+
+def cache_key(name: str, config_keys: Dict[str, Any], abstract_args: Sequence[Any]) -> str:
+  """Hashes everything an executable depends on: config, topology, jax version and argument signature."""
+  devices = jax.devices()
+  key = repr((
+      name,
+      sorted((k, str(v)) for k, v in config_keys.items()),
+      jax.__version__,
+      jax.process_count(),
+      [(device.platform, device.device_kind, device.id) for device in devices],
+      jax.tree_util.tree_structure(abstract_args),
+      jax.tree_util.tree_leaves(abstract_args),
+  ))
+  return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def compile_or_load(
+    fn: Callable, abstract_args: Sequence[Any], cache_dir: str, name: str, config_keys: Dict[str, Any]
+) -> Callable:
+  """Returns jitted fn compiled for abstract_args, deserialized from cache_dir if it was compiled before.
+
+  Args:
+    fn: A jitted function, called with positional arguments only.
+    abstract_args: ShapeDtypeStructs, with shardings, of the arguments of fn.
+    cache_dir: Directory of the serialized executables.
+    name: Name of the function, part of the file name of its executables.
+    config_keys: The config the function depends on, e.g. `config.get_keys()`.
+  Returns:
+    The compiled function, which must be called with arguments matching
+    abstract_args exactly, including their shardings.
+  """
+  abstract_args = tuple(abstract_args)
+  path = os.path.join(cache_dir, f"{name}_{cache_key(name, config_keys, abstract_args)}.pickle")
+  if os.path.exists(path):
+    log.info(f"Loading compiled {name} from {path}")
+    with open(path, "rb") as f:
+      serialized = pickle.load(f)
+    in_tree = jax.tree_util.tree_structure((abstract_args, {}))
+    out_tree = jax.tree_util.tree_structure(jax.eval_shape(fn, *abstract_args))
+    return deserialize_and_load(serialized, in_tree, out_tree)
+
+  log.info(f"Compiling {name}, to be saved as {path}")
+  compiled = fn.lower(*abstract_args).compile()
+  serialized, _, _ = serialize(compiled)
+  os.makedirs(cache_dir, exist_ok=True)
+  # Write then rename, so that concurrent processes never load a partial file.
+  with open(path + ".tmp", "wb") as f:
+    pickle.dump(serialized, f)
+  os.replace(path + ".tmp", path)
+  return compiled
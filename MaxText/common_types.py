@@ -46,6 +46,7 @@ CACHE_BATCH = "cache_batch"
 CACHE_SEQUENCE = "cache_sequence"
 CACHE_HEADS = "cache_heads"
 CACHE_KV = "cache_kv"
+CACHE_PAGES = "cache_pages"
 CACHE_SCALE_BATCH = "cache_scale_batch"
 CACHE_SCALE_SEQUENCE = "cache_scale_sequence"
 CACHE_SCALE_HEADS = "cache_scale_heads"
@@ -33,28 +33,65 @@ def main(config):
   text = config.prompt
   metadata = engine.get_tokenizer()
   tokenizer_model = engine.build_tokenizer(metadata)
-  tokens, true_length = tokenizer_model.encode(text, is_bos=True, prefill_lengths=[config.max_prefill_predict_length])
-  assert true_length <= config.max_prefill_predict_length, "can't take too many tokens"
+  prefill_length = config.max_prefill_predict_length
+  if config.prefill_chunk_size > 0:
+    # Prompt positions past max_prefill_predict_length are cached in the ar cache, which keeps room for generation.
+    prefill_length = (config.max_target_length - 1) // config.prefill_chunk_size * config.prefill_chunk_size
+  tokens, true_length = tokenizer_model.encode(text, is_bos=True, prefill_lengths=[prefill_length])
+  assert true_length <= prefill_length, "can't take too many tokens"
   assert config.quantization != "fp8", "fp8 on NVIDIA GPUs is not supported in decode.py yet"
 
   # Split RNG before calling prefill
   rng, rng_prefill = jax.random.split(rng)
-  prefill_result, first_token = engine.prefill(params=params, padded_tokens=tokens, true_length=true_length, rng=rng_prefill)
+  if config.prefill_chunk_size > 0:
+    # Every chunk is appended to the prefill cache of the earlier ones.
+    prefill_result = None
+    for start in range(0, true_length, config.prefill_chunk_size):
+      rng_prefill, rng_chunk = jax.random.split(rng_prefill)
+      prefill_result, first_token = engine.prefill(
+          params=params,
+          existing_prefix=prefill_result,
+          padded_tokens=tokens[start : start + config.prefill_chunk_size],
+          true_length=min(config.prefill_chunk_size, true_length - start),
+          rng=rng_chunk,
+      )
+  else:
+    prefill_result, first_token = engine.prefill(
+        params=params, padded_tokens=tokens, true_length=true_length, rng=rng_prefill
+    )
   slot = 0
 
   rng, rng_init_decode = jax.random.split(rng)
   decode_state = engine.init_decode_state(rng_init_decode)
   decode_state = engine.insert(prefill_result, decode_state, slot=slot)
 
-  steps = range(config.max_prefill_predict_length, config.max_target_length)
+  # Prompt tokens past max_prefill_predict_length take up ar cache entries.
+  steps = range(max(config.max_prefill_predict_length, true_length), config.max_target_length)
   sampled_tokens_list = []
   sampled_tokens_list.append(first_token)
+  num_tokens = 1
   for _ in steps:
+    if num_tokens > len(steps):
+      break
     rng, rng_generate = jax.random.split(rng)
-    decode_state, sampled_tokens = engine.generate(params, decode_state, rng=rng_generate)
+    if config.decode_steps_per_call > 1:
+      decode_state, sampled_tokens = engine.generate_n(
+          params, decode_state, num_steps=config.decode_steps_per_call, rng=rng_generate
+      )
+    else:
+      decode_state, sampled_tokens = engine.generate(params, decode_state, rng=rng_generate)
     sampled_tokens_list.append(sampled_tokens)
-
-  results = [sampled_tokens.get_result_at_slot(slot).tokens.item() for sampled_tokens in sampled_tokens_list]
+    if config.speculative_num_tokens > 0:
+      # A speculative step emits its leading valid tokens, at least one.
+      num_tokens += int(sampled_tokens.get_result_at_slot(slot).valid.sum())
+    else:
+      num_tokens += config.decode_steps_per_call
+
+  results = []
+  for sampled_tokens in sampled_tokens_list:
+    slot_data = sampled_tokens.get_result_at_slot(slot)
+    results.extend(token.item() for token, valid in zip(slot_data.tokens[0], slot_data.valid[0]) if valid)
+  results = results[: len(steps) + 1]
   output = tokenizer_model.decode(results)
   print(f"Input `{text}` -> `{output}`")
 
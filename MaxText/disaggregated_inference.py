@@ -0,0 +1,139 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Disaggregated inference on one host, prefill and generate running on disjoint devices.
+
+A prefill thread computes the prefixes of requests with an engine on some
+devices, a transfer thread moves them onto the devices of a generate engine, and
+the generate loop inserts them into empty decode slots between generate steps.
+The stages are connected by bounded queues, so a long prefill delays the
+admission of its own request but not the generate steps of in-flight ones. This
+is the pipeline of JetStream's disaggregated server (see maxengine_config),
+without a server, e.g. to try a device split on CPU with
+--xla_force_host_platform_device_count.
+"""
+
+import dataclasses
+import queue
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import jax
+import numpy as np
+
+from maxengine import MaxEngine
+
+
+@dataclasses.dataclass
+class Request:
+  id: str
+  # Prompt, padded to a prefill length.
+  tokens: jax.Array
+  true_length: int
+
+
+class DisaggregatedInference:
+  """Runs requests through a prefill engine and a generate engine on disjoint devices."""
+
+  def __init__(
+      self,
+      prefill_engine: MaxEngine,
+      generate_engine: MaxEngine,
+      prefill_params,
+      generate_params,
+      eos_id: Optional[int] = None,
+      max_queued_prefixes: int = 4,
+  ):
+    self.prefill_engine = prefill_engine
+    self.generate_engine = generate_engine
+    self.prefill_params = prefill_params
+    self.generate_params = generate_params
+    self.eos_id = eos_id
+    self.max_decode_length = generate_engine.config.max_target_length - generate_engine.config.max_prefill_predict_length
+    # Bounds the prefixes held on each side of the transfer, i.e. their device memory.
+    self.max_queued_prefixes = max_queued_prefixes
+
+  def _prefill_worker(self, requests: Sequence[Request], prefilled: queue.Queue):
+    for request in requests:
+      prefix, first_token = self.prefill_engine.prefill(
+          params=self.prefill_params, padded_tokens=request.tokens, true_length=request.true_length
+      )
+      prefilled.put((request, prefix, first_token))
+    prefilled.put(None)
+
+  def _transfer_worker(self, prefilled: queue.Queue, transferred: queue.Queue):
+    while (item := prefilled.get()) is not None:
+      request, prefix, first_token = item
+      prefix = self.generate_engine.transfer(prefix)
+      # Only hand over prefixes already on the generate devices, so that inserts never wait on a transfer.
+      jax.block_until_ready(prefix)
+      transferred.put((request, prefix, int(np.asarray(first_token.data)[0, 0])))
+    transferred.put(None)
+
+  def _is_finished(self, tokens: List[int]) -> bool:
+    return tokens[-1] == self.eos_id or len(tokens) > self.max_decode_length
+
+  def run(self, requests: Sequence[Request]) -> Dict[str, List[int]]:
+    """Returns the tokens generated for every request, by id."""
+    prefilled = queue.Queue(maxsize=self.max_queued_prefixes)
+    transferred = queue.Queue(maxsize=self.max_queued_prefixes)
+    threads = [
+        threading.Thread(target=self._prefill_worker, args=(requests, prefilled), daemon=True),
+        threading.Thread(target=self._transfer_worker, args=(prefilled, transferred), daemon=True),
+    ]
+    for thread in threads:
+      thread.start()
+
+    results = {}
+    decode_state = self.generate_engine.init_decode_state()
+    empty_slots = list(range(self.generate_engine.max_concurrent_decodes))
+    slot_to_id = {}
+    more_requests = True
+    while more_requests or slot_to_id:
+      # Admit the prefixes already transferred, waiting for one only when no slot is decoding.
+      while more_requests and empty_slots:
+        try:
+          item = transferred.get(block=not slot_to_id)
+        except queue.Empty:
+          break
+        if item is None:
+          more_requests = False
+          break
+        request, prefix, first_token = item
+        results[request.id] = [first_token]
+        if self._is_finished(results[request.id]):
+          continue
+        slot = empty_slots.pop()
+        decode_state = self.generate_engine.insert(prefix, decode_state, slot)
+        slot_to_id[slot] = request.id
+      if not slot_to_id:
+        continue
+
+      decode_state, result_tokens = self.generate_engine.generate(self.generate_params, decode_state)
+      data = np.asarray(result_tokens.data)
+      tokens = data[:, result_tokens.tokens_idx[0] : result_tokens.tokens_idx[1]]
+      valid = data[:, result_tokens.valid_idx[0] : result_tokens.valid_idx[1]]
+      for slot, id_ in list(slot_to_id.items()):
+        for token, is_valid in zip(tokens[slot], valid[slot]):
+          if not is_valid:
+            break
+          results[id_].append(int(token))
+          if self._is_finished(results[id_]):
+            del slot_to_id[slot]
+            empty_slots.append(slot)
+            break
+
+    for thread in threads:
+      thread.join()
+    return results
@@ -17,6 +17,7 @@ limitations under the License.
 """Inference microbenchmark for prefill and autoregressive steps."""
 import datetime
 import jax
+import jax.numpy as jnp
 import json
 import sys
 
@@ -33,6 +34,8 @@ import pyconfig
 
 import warnings
 
+from layers import attentions
+
 warnings.simplefilter("ignore", category=FutureWarning)
 
 _WARMUP_ITERS = 2
@@ -119,6 +122,51 @@ def prefill_insert_benchmark(config, engine, decode_state, params, total_slots,
   return result_dict, decode_state
 
 
+def prefill_bulk_insert(engine, decode_state, params, total_slots, tokens, true_length, rng):
+  """Prefills total_slots requests and inserts them all with one bulk_insert."""
+  prefill_results = []
+  for _ in range(total_slots):
+    rng, rng_prefill = jax.random.split(rng)
+    prefill_result, _ = engine.prefill(params=params, padded_tokens=tokens, true_length=true_length, rng=rng_prefill)
+    prefill_results.append(prefill_result)
+  slots = jax.numpy.arange(total_slots, dtype=jax.numpy.int32)
+  return engine.bulk_insert(prefill_results, decode_state, slots), rng
+
+
+def prefill_bulk_insert_benchmark_loop(
+    config, engine, decode_state, params, total_slots, tokens, true_length, iters, profile_name
+):
+  """Inner loop for benchmarking prefill and bulk insert step."""
+  prof = profiler.Profiler(config, profile_name)
+  prof.activate()
+  start = datetime.datetime.now()
+  rng = jax.random.PRNGKey(1234)
+  for _ in range(iters):
+    decode_state, rng = prefill_bulk_insert(engine, decode_state, params, total_slots, tokens, true_length, rng)
+  jax.block_until_ready(decode_state)
+  end = datetime.datetime.now()
+  prof.deactivate()
+  return (end - start).total_seconds(), decode_state
+
+
+def prefill_bulk_insert_benchmark(config, engine, decode_state, params, total_slots, tokens, true_length, iters):
+  """Handles warmup, running bulk insert benchmark, and printing results."""
+  rng = jax.random.PRNGKey(1234)
+  for _ in range(_WARMUP_ITERS):
+    decode_state, rng = prefill_bulk_insert(engine, decode_state, params, total_slots, tokens, true_length, rng)
+  jax.block_until_ready(decode_state)
+
+  print(f"Prefill and bulk insert benchmark results for length {tokens.size}:\n")
+  time_in_s, decode_state = prefill_bulk_insert_benchmark_loop(
+      config, engine, decode_state, params, total_slots, tokens, true_length, iters, f"prefill_bulk_insert_{tokens.size}"
+  )
+  # Averaged per request, to compare with the prefill and insert step.
+  prefill_insert_average_ms = time_in_s / (iters * total_slots) * 1000.0
+  print(f"\tPrefill + Bulk insert average time per request: {prefill_insert_average_ms:.3f} ms\n\n\n\n")
+  result_dict = {"time_in_ms": prefill_insert_average_ms}
+  return result_dict, decode_state
+
+
 def ar_benchmark_loop(config, engine, params, decode_state, iters, profile_name):
   """Inner loop for benchmarking ar step."""
   prof = profiler.Profiler(config, profile_name)
@@ -168,6 +216,39 @@ def ar_benchmark(config, engine, params, decode_state, global_batch_size, cache_
   return result_dict, decode_state
 
 
+def ragged_cache_update_benchmark(config, batch_size, iters):
+  """Times the ragged ar cache update of one cache var, as a scatter and as the per slot loop it replaced."""
+  cache_length = config.max_target_length - config.max_prefill_predict_length
+  ar_cache_axis_order = tuple(int(i) for i in config.ar_cache_axis_order.split(","))
+  logical_shape = (batch_size, cache_length, config.num_kv_heads, config.head_dim)
+  shape = tuple(logical_shape[i] for i in ar_cache_axis_order)
+  batch_axis, sequence_axis = ar_cache_axis_order.index(0), ar_cache_axis_order.index(1)
+  token_shape = tuple(1 if axis == sequence_axis else dim for axis, dim in enumerate(shape))
+  dtype = jnp.int8 if config.quantize_kvcache else config.dtype
+  rng_token, rng_lengths = jax.random.split(jax.random.PRNGKey(1234))
+  cache = jnp.zeros(shape, dtype)
+  one_token = jax.random.normal(rng_token, token_shape).astype(dtype)
+  lengths = jax.random.randint(rng_lengths, (batch_size,), 0, cache_length)
+
+  result_dict = {}
+  for name, update_fn in (("scatter", attentions.ragged_cache_update), ("loop", attentions.ragged_cache_update_loop)):
+    update = jax.jit(update_fn, static_argnums=(3, 4), donate_argnums=(0,))
+    for _ in range(_WARMUP_ITERS):
+      cache = update(cache, one_token, lengths, batch_axis, sequence_axis)
+    jax.block_until_ready(cache)
+    start = datetime.datetime.now()
+    for _ in range(iters):
+      cache = update(cache, one_token, lengths, batch_axis, sequence_axis)
+    jax.block_until_ready(cache)
+    result_dict[f"{name}_time_in_ms"] = (datetime.datetime.now() - start).total_seconds() / iters * 1000.0
+  print(
+      f"Ragged cache update results for batch size {batch_size}:\n"
+      f"\tScatter average time: {result_dict['scatter_time_in_ms']:.3f} ms\n"
+      f"\tPer slot loop average time: {result_dict['loop_time_in_ms']:.3f} ms\n\n"
+  )
+  return result_dict
+
+
 def collate_results(config, results, model_size, cache_size, num_model_params, incl_config=False):
   """Adds model/cache size info and optionally config info to results."""
   results["sizes"] = {
@@ -229,17 +310,11 @@ def summarize_prefill_result(engine, params, tokens, true_length):
   rng = jax.random.PRNGKey(1234)
   prefill_result, _ = engine.prefill(params=params, padded_tokens=tokens, true_length=true_length, rng=rng)
   jax.block_until_ready(prefill_result)
-  num_prefill_logits_params, total_prefill_logits_size, avg_prefill_logits_param_size = max_utils.summarize_pytree_data(
-      prefill_result["logits"], name="Prefill Logits", raw=True
-  )
   num_prefill_cache_params, total_prefill_cache_size, avg_prefill_cache_param_size = max_utils.summarize_pytree_data(
       prefill_result["cache"], name="Prefill Cache"
   )
   del prefill_result
   return {
-      "num_logits_params": num_prefill_logits_params,
-      "total_logits_size": total_prefill_logits_size,
-      "avg_logits_param_size": avg_prefill_logits_param_size,
       "num_cache_params": num_prefill_cache_params,
       "total_cache_size": total_prefill_cache_size,
       "avg_cache_param_size": avg_prefill_cache_param_size,
@@ -269,6 +344,7 @@ def main(config, inference_metadata: Optional[Dict[str, Any]] = None):
     benchmark_results["prefill-result-sizes"] = {}
     benchmark_results["prefill"] = {}
     benchmark_results["insert"] = {}
+    benchmark_results["bulk_insert"] = {}
     prefill_tokens = {}
     prefill_true_lengths = {}
 
@@ -306,11 +382,34 @@ def main(config, inference_metadata: Optional[Dict[str, Any]] = None):
           prefill_insert_time["time_in_ms"] - benchmark_results["prefill"][prefill_length]["time_in_ms"]
       )
 
+      if "bulk_insert" in stages_to_benchmark:
+        prefill_bulk_insert_time, decode_state = prefill_bulk_insert_benchmark(
+            config,
+            engine,
+            decode_state,
+            params,
+            engine.max_concurrent_decodes,
+            prefill_tokens[prefill_length],
+            prefill_true_lengths[prefill_length],
+            benchmark_loop_iters,
+        )
+        benchmark_results["bulk_insert"][prefill_length] = {}
+        benchmark_results["bulk_insert"][prefill_length]["time_in_ms"] = (
+            prefill_bulk_insert_time["time_in_ms"] - benchmark_results["prefill"][prefill_length]["time_in_ms"]
+        )
+
   if "generate" in stages_to_benchmark:
     benchmark_results["autoregressive"], decode_state = ar_benchmark(
         config, engine, params, decode_state, engine.max_concurrent_decodes, cache_size, model_size, benchmark_loop_iters
     )
 
+  if "ragged_cache_update" in stages_to_benchmark:
+    benchmark_results["ragged_cache_update"] = {}
+    for batch_size in [int(b) for b in config.inference_microbenchmark_ragged_update_batch_sizes.split(",")]:
+      benchmark_results["ragged_cache_update"][batch_size] = ragged_cache_update_benchmark(
+          config, batch_size, benchmark_loop_iters
+      )
+
   results = collate_results(config, benchmark_results, model_size, cache_size, num_model_params)
   print_results_for_analyze(results)
   if inference_metadata:
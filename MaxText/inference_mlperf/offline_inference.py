@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Callable, List
+from typing import Callable, List, Optional
 import dataclasses
 from collections import defaultdict
+import queue
+import time
 import jax
 from jax import numpy as jnp
 import numpy as np
@@ -23,7 +25,9 @@ from jetstream.engine import engine_api
 
 import logging
 # pylint: disable=no-name-in-module
+import aot_cache
 from maxengine import set_engine_vars_from_base_engine
+from scheduler import Scheduler
 
 log = logging.getLogger(__name__)
 
@@ -33,11 +37,28 @@ class InputData:
   id: str
   tokens: jax.Array
   true_length: int
+  # Estimated number of generated tokens, used by some schedulers.
+  expected_output_length: Optional[int] = None
+  # time.perf_counter() at which the query arrived, when queries stream in.
+  arrival_time: Optional[float] = None
+  # Number of tokens after which the row is done, e.g. that of its bucket on an engine shared by longer buckets.
+  # At most the max_decode_length of the engine, which applies if None.
+  max_decode_length: Optional[int] = None
 
 
 class OfflineInference:
 
-  def __init__(self, engine: engine_api.Engine, params, base_engine: engine_api.Engine):
+  def __init__(
+      self,
+      engine: engine_api.Engine,
+      params,
+      base_engine: engine_api.Engine,
+      max_prefill_batch_size: int = 1,
+      max_prefill_pack_size: int = 1,
+      scheduler: Optional[Scheduler] = None,
+  ):
+    if max_prefill_pack_size > 1 and engine.config.speculative_num_tokens > 0:
+      raise ValueError("max_prefill_pack_size > 1 doesn't support speculative decoding")
     self.engine = engine
     self.decode_state = None
     if params is None:
@@ -52,6 +73,12 @@ class OfflineInference:
     metadata = engine.get_tokenizer()
     self.tokenizer = engine.build_tokenizer(metadata)
     self.dummy = False
+    # Number of same-bucket prompts prefilled together in one forward pass.
+    self.max_prefill_batch_size = max_prefill_batch_size
+    # Number of short prompts concatenated into one max_prefill_length sequence.
+    self.max_prefill_pack_size = max_prefill_pack_size
+    # Decides the admission order of rows and when to prefill rather than decode.
+    self.scheduler = scheduler if scheduler is not None else Scheduler()
 
     self._cached_pref = {}
     self._cached_generate = None
@@ -78,22 +105,118 @@ class OfflineInference:
 
     self.batch_inference(warmup_samples, desc="warmup")
 
+  def compile(self, prefill_lengths, cache_dir):
+    """Fills _cached_pref and _cached_generate with ahead of time compiled functions.
+
+    Executables are loaded from cache_dir when an earlier process compiled them
+    for the same config and topology, and saved there otherwise. Prefill and
+    insert are fused into one executable per prefill length.
+    """
+    self.init_decode_state()
+    config_keys = self.engine.config.get_keys()
+    abstract_params = aot_cache.abstractify(self.params)
+    abstract_decode_state = aot_cache.abstractify(self.decode_state)
+    replicated = self.engine.replicated_sharding
+    scalar = jax.ShapeDtypeStruct((), jnp.int32, sharding=replicated)
+
+    generate = aot_cache.compile_or_load(
+        self.engine.generate, (abstract_params, abstract_decode_state), cache_dir, "generate", config_keys
+    )
+    self._cached_generate = generate
+
+    if self.engine.prefix_cache is not None:
+      log.info("Not compiling prefill ahead of time, the prefix cache looks prompts up on the host")
+      return
+
+    def prefill_insert(params, tokens, slot, true_length, decode_state):
+      prefill_result, first_token = self.engine.prefill(params=params, padded_tokens=tokens, true_length=true_length)
+      return first_token, self.engine.insert(prefill_result, decode_state, slot)
+
+    fused_prefill_insert = jax.jit(prefill_insert, donate_argnums=(4,))
+    for length in prefill_lengths:
+      tokens = jax.ShapeDtypeStruct((length,), jnp.int32, sharding=replicated)
+      compiled = aot_cache.compile_or_load(
+          fused_prefill_insert,
+          (abstract_params, tokens, scalar, scalar, abstract_decode_state),
+          cache_dir,
+          f"prefill_insert_{length}",
+          config_keys,
+      )
+
+      def cached_prefill_insert(params, tokens, slot, true_length, decode_state, compiled=compiled):
+        return compiled(
+            params,
+            jax.device_put(jnp.asarray(tokens, dtype=jnp.int32), replicated),
+            jax.device_put(jnp.int32(slot), replicated),
+            jax.device_put(jnp.int32(true_length), replicated),
+            decode_state,
+        )
+
+      self._cached_pref[length] = cached_prefill_insert
+
   def _prefill_insert(self, params, tokens, slot, true_length, decode_state):
     """return decodestate."""
-    prefill_result, first_token = self.engine.prefill(params=params, padded_tokens=tokens, true_length=true_length)
+    prefill_result, first_token = self.engine.prefill_with_prefix_cache(
+        params=params, padded_tokens=tokens, true_length=true_length
+    )
     decode_state = self.engine.insert(prefill_result, decode_state, slot=slot)
     return first_token, decode_state
 
+  def _prefill_insert_batch(self, params, tokens, slots, true_lengths, decode_state):
+    """return decodestate."""
+    prefill_result, first_tokens = self.engine.prefill_batch(
+        params=params, padded_tokens=tokens, true_lengths=true_lengths
+    )
+    decode_state = self.engine.insert_batch(prefill_result, decode_state, slots=slots)
+    return first_tokens, decode_state
+
+  def _prefill_insert_packed(self, params, tokens, positions, segment_ids, starts, true_lengths, slots, decode_state):
+    """return decodestate."""
+    prefill_result, first_tokens = self.engine.prefill_packed(
+        params=params,
+        padded_tokens=tokens,
+        decoder_positions=positions,
+        decoder_segment_ids=segment_ids,
+        start_positions=starts,
+        true_lengths=true_lengths,
+    )
+    decode_state = self.engine.insert_batch(prefill_result, decode_state, slots=slots)
+    return first_tokens, decode_state
+
+  def _pack_rows(self, rows):
+    """Concatenates rows into one max_prefill_length sequence with per row segment ids and positions."""
+    packed_length = self.engine.max_prefill_length
+    tokens = np.zeros((packed_length,), dtype=np.int32)
+    positions = np.zeros((packed_length,), dtype=np.int32)
+    segment_ids = np.zeros((packed_length,), dtype=np.int32)
+    starts = np.zeros((self.max_prefill_pack_size,), dtype=np.int32)
+    true_lengths = np.ones((self.max_prefill_pack_size,), dtype=np.int32)
+    offset = 0
+    for i, row in enumerate(rows):
+      tokens[offset : offset + row.true_length] = np.asarray(row.tokens)[: row.true_length]
+      positions[offset : offset + row.true_length] = np.arange(row.true_length)
+      segment_ids[offset : offset + row.true_length] = i + 1
+      starts[i] = offset
+      true_lengths[i] = row.true_length
+      offset += row.true_length
+    return tokens, positions, segment_ids, starts, true_lengths
+
   def batch_inference_with_callback(
       self,
       data: List[InputData],
       emit_first_token: Callable[[str, int], bool],
       emit_token: Callable[[str, int], bool],
       desc: str,
+      arrivals: Optional[queue.Queue] = None,
+      emit_done: Optional[Callable[[str], None]] = None,
   ):
     """callback is a function that takes id and token. It will be called once per output
 
     token.
+
+    With arrivals, rows keep streaming in from that queue after data, until a
+    None is received, and are admitted as they come. emit_done, if given, is
+    called with the id of every row once it generated its last token.
     """
 
     def prefill(slot, tokens, true_length):
@@ -102,6 +225,10 @@ class OfflineInference:
         log.debug("dummy prefill")
         return 123
 
+      chunk_size = self.engine.config.prefill_chunk_size
+      if 0 < chunk_size < true_length:
+        return prefill_chunked(slot, tokens, true_length, chunk_size)
+
       prefill_fn = self._prefill_insert
       if (cached := self._cached_pref.get(len(tokens))) is not None:
         prefill_fn = cached
@@ -111,25 +238,110 @@ class OfflineInference:
       )
       return first_token.data[0][0].item()
 
+    def prefill_chunked(slot, tokens, true_length, chunk_size):
+      # Decode steps run between chunks, so a long prompt doesn't stall the active slots.
+      prefix = None
+      for start in range(0, true_length, chunk_size):
+        chunk = tokens[start : start + chunk_size]
+        if len(chunk) < chunk_size:
+          chunk = jnp.pad(chunk, (0, chunk_size - len(chunk)))
+        prefix, first_token = self.engine.prefill(
+            params=self.params,
+            existing_prefix=prefix,
+            padded_tokens=chunk,
+            true_length=min(chunk_size, true_length - start),
+        )
+        if slot_to_id and start + chunk_size < true_length:
+          decode()
+      self.decode_state = self.engine.insert(prefix, self.decode_state, slot=slot)
+      return first_token.data[0][0].item()
+
+    def prefill_batch(slots, rows):
+      nonlocal self
+      if self.dummy:
+        log.debug("dummy prefill batch")
+        return [123] * len(rows)
+
+      # Pad up to a fixed number of rows so every bucket compiles only once;
+      # padding rows target an out of range slot and are dropped by insert_batch.
+      num_padding = self.max_prefill_batch_size - len(rows)
+      tokens = np.stack([np.asarray(row.tokens) for row in rows] + [np.zeros_like(rows[0].tokens)] * num_padding)
+      tokens = jnp.asarray(tokens)
+      true_lengths = jnp.array([row.true_length for row in rows] + [1] * num_padding, dtype=jnp.int32)
+      slots = jnp.array(slots + [self.batch_size] * num_padding, dtype=jnp.int32)
+
+      first_tokens, self.decode_state = self._prefill_insert_batch(
+          self.params, tokens=tokens, slots=slots, true_lengths=true_lengths, decode_state=self.decode_state
+      )
+      first_tokens = first_tokens.convert_to_numpy()
+      return [first_tokens.data[i][0].item() for i in range(len(rows))]
+
+    def prefill_packed(slots, rows):
+      nonlocal self
+      if self.dummy:
+        log.debug("dummy prefill packed")
+        return [123] * len(rows)
+
+      tokens, positions, segment_ids, starts, true_lengths = self._pack_rows(rows)
+      # Padding prompts target an out of range slot and are dropped by insert_batch.
+      slots = np.array(slots + [self.batch_size] * (self.max_prefill_pack_size - len(rows)), dtype=np.int32)
+      first_tokens, self.decode_state = self._prefill_insert_packed(
+          self.params,
+          tokens=jnp.array(tokens),
+          positions=jnp.array(positions),
+          segment_ids=jnp.array(segment_ids),
+          starts=jnp.array(starts),
+          true_lengths=jnp.array(true_lengths),
+          slots=jnp.array(slots),
+          decode_state=self.decode_state,
+      )
+      first_tokens = first_tokens.convert_to_numpy()
+      return [first_tokens.data[i][0].item() for i in range(len(rows))]
+
+    def gather_packable_rows(row_idx, num_allowed):
+      """Consecutive rows whose prompts together fit in one max_prefill_length sequence."""
+      rows = []
+      total_length = 0
+      while (
+          len(rows) < min(num_allowed, self.max_prefill_pack_size)
+          and row_idx + len(rows) < len(pending)
+          and total_length + pending[row_idx + len(rows)].true_length <= self.engine.max_prefill_length
+      ):
+        total_length += pending[row_idx + len(rows)].true_length
+        rows.append(pending[row_idx + len(rows)])
+      return rows
+
+    pending = self.scheduler.order(data)
     empty_slots = list(range(self.batch_size))
     slot_to_id = {}
     num_prefills = {}
     num_decodes = 0
+    num_prefills_since_decode = 0
 
     dummy_length = 1
+    # Number of rows admitted into every slot so far, which tells the rows of a slot apart.
+    slot_admissions = [0] * self.batch_size
+    # Number of tokens after which the row of every slot is done.
+    slot_max_decode_lengths = [self.max_decode_length] * self.batch_size
+    # The tokens of the last dispatched decode step, with the rows of the slots they were generated for.
+    in_flight = None
 
     def decode():
+      """Dispatches a decode step, then processes the tokens of the previous one while it runs."""
       log.debug("decode")
       nonlocal self
       nonlocal slot_to_id
       nonlocal dummy_length
+      nonlocal num_prefills_since_decode
+      nonlocal in_flight
+      num_prefills_since_decode = 0
       if self.dummy:
         log.debug("Dummy generate")
         res = engine_api.ResultTokens(
             data=np.array([[123, 1, dummy_length]] * self.batch_size),
-            tokens_idx=(0, 0),
-            valid_idx=(0, 0),
-            length_idx=(0, 0),
+            tokens_idx=(0, 1),
+            valid_idx=(1, 2),
+            length_idx=(2, 3),
             samples_per_slot=(0, 0),
         )
         dummy_length += 1
@@ -139,50 +351,147 @@ class OfflineInference:
         if self._cached_generate is not None:
           gen_fn = self._cached_generate
         self.decode_state, result_tokens = gen_fn(self.params, self.decode_state)
+        result_tokens.data.copy_to_host_async()
+
+      previous, in_flight = in_flight, (
+          result_tokens,
+          {slot: (id_, slot_admissions[slot]) for slot, id_ in slot_to_id.items()},
+      )
+      if previous is not None:
+        process_tokens(*previous)
 
+    def process_tokens(result_tokens, dispatched_rows):
       result_tokens = result_tokens.convert_to_numpy()
 
       newly_empty = []
-      for slot, id_ in slot_to_id.items():
-        token, is_valid, length = result_tokens.data[slot]
+      for slot, (id_, admission) in dispatched_rows.items():
+        if slot not in slot_to_id or slot_admissions[slot] != admission:
+          # The row finished at the previous step, which was only known once this one was dispatched.
+          continue
+        # Every row holds the tokens of the step, their validity and the length, e.g. with
+        # speculative decoding several tokens per slot, of which the leading ones are valid.
+        row = result_tokens.data[slot]
+        tokens = row[result_tokens.tokens_idx[0] : result_tokens.tokens_idx[1]]
+        valid = row[result_tokens.valid_idx[0] : result_tokens.valid_idx[1]]
+        length = row[result_tokens.length_idx[0]]
         log.debug(f"slot is {slot}, length is {length}")
         should_finish = False
-        if is_valid:
+        for token, is_valid in zip(tokens, valid):
+          if should_finish or not is_valid:
+            break
           should_finish = emit_token(id_, token.item())
-        if should_finish or length >= self.max_decode_length:
+        is_done = length + max(int(valid.sum()) - 1, 0) >= slot_max_decode_lengths[slot]
+        if len(row) > result_tokens.length_idx[1]:
+          # With per_slot_stop_criteria, the engine evaluated the stop criteria and flags done slots after the length.
+          # The callback still ends a row, e.g. at the eos token, which the request stop criteria need not list.
+          is_done = is_done or bool(row[result_tokens.length_idx[1]])
+        if should_finish or is_done:
           newly_empty.append(slot)
 
       # Add slots of those that are empty to empty
       for slot in newly_empty:
+        if emit_done is not None:
+          emit_done(slot_to_id[slot])
         del slot_to_id[slot]
         empty_slots.append(slot)
 
-    for row in data:
+      if newly_empty and not self.dummy and self.engine.config.use_paged_attention:
+        # Give the kv cache pages of finished slots back to the pool; padding slots are out of range.
+        slots = np.full((self.batch_size,), self.batch_size, dtype=np.int32)
+        slots[: len(newly_empty)] = newly_empty
+        self.decode_state = self.engine.release_slots(self.decode_state, jnp.array(slots))
+
+    arrivals_open = arrivals is not None
+
+    def receive(block):
+      """Adds the rows arrived so far to the rows to admit, first waiting for one if block."""
+      nonlocal arrivals_open
+      num_received = 0
+      while arrivals_open:
+        try:
+          row = arrivals.get(block=block and num_received == 0)
+        except queue.Empty:
+          break
+        if row is None:
+          arrivals_open = False
+        else:
+          pending.append(row)
+          num_received += 1
+      if num_received:
+        pending[row_idx:] = self.scheduler.order(pending[row_idx:])
+
+    row_idx = 0
+    while row_idx < len(pending) or arrivals_open:
+      receive(block=row_idx == len(pending) and not slot_to_id)
+      if row_idx == len(pending):
+        if slot_to_id:
+          # Keep decoding until more rows arrive.
+          num_decodes += 1
+          decode()
+        continue
       log.debug(f"empty_slots {len(empty_slots)}")
-      while not empty_slots:
-        # If slots are all full, decode until there are free slots
-        # to insert
+      oldest_wait = 0.0
+      if pending[row_idx].arrival_time is not None:
+        oldest_wait = time.perf_counter() - pending[row_idx].arrival_time
+      num_allowed = self.scheduler.num_prefills_allowed(
+          num_prefills_since_decode, len(empty_slots), len(slot_to_id), oldest_wait
+      )
+      if num_allowed == 0:
+        # If slots are full, or the scheduler holds prefills back, decode first.
         num_decodes += 1
         log.debug(f"decode-{desc}-{num_decodes}")
         decode()
-      # do one insert
-      num_tokens = len(row.tokens)
-      num_prefills[num_tokens] = 0 if num_tokens not in num_prefills else num_prefills[num_tokens] + 1
+        continue
+      num_tokens = len(pending[row_idx].tokens)
+      packed_rows = gather_packable_rows(row_idx, num_allowed) if self.max_prefill_pack_size > 1 else []
+      # Otherwise gather consecutive rows of the same bucket, up to the number of allowed prefills, unless they are
+      # prefilled in chunks.
+      rows = packed_rows if len(packed_rows) > 1 else [pending[row_idx]]
+      while (
+          len(packed_rows) <= 1
+          and len(rows) < min(num_allowed, self.max_prefill_batch_size)
+          and row_idx + len(rows) < len(pending)
+          and len(pending[row_idx + len(rows)].tokens) == num_tokens
+          and not 0 < self.engine.config.prefill_chunk_size < num_tokens
+      ):
+        rows.append(pending[row_idx + len(rows)])
+      row_idx += len(rows)
+      # Drop the admitted rows, which a long stream of arrivals would otherwise accumulate.
+      del pending[:row_idx]
+      row_idx = 0
+      num_prefills_since_decode += len(rows)
+
+      num_prefills[num_tokens] = (0 if num_tokens not in num_prefills else num_prefills[num_tokens]) + len(rows)
       log.debug(
-          f"prefill-{desc}-{num_prefills} num_tokens {num_tokens} true_length {row.true_length} num_empty_slots {len(empty_slots)} num_decodes {num_decodes}"
+          f"prefill-{desc}-{num_prefills} num_tokens {num_tokens} num_rows {len(rows)} num_empty_slots {len(empty_slots)} num_decodes {num_decodes}"
       )
-      slot = empty_slots.pop()
-      first_token = prefill(slot, row.tokens, row.true_length)
-      should_terminate = emit_first_token(row.id, first_token)
-      if not should_terminate:
-        slot_to_id[slot] = row.id
+      slots = [empty_slots.pop() for _ in rows]
+      if len(rows) == 1:
+        first_tokens = [prefill(slots[0], rows[0].tokens, rows[0].true_length)]
+      elif len(packed_rows) > 1:
+        first_tokens = prefill_packed(slots, rows)
       else:
-        empty_slots.append(slot)  # dont use the slot
+        first_tokens = prefill_batch(slots, rows)
+      for slot, row, first_token in zip(slots, rows, first_tokens):
+        should_terminate = emit_first_token(row.id, first_token)
+        if not should_terminate:
+          slot_to_id[slot] = row.id
+          slot_admissions[slot] += 1
+          # Prompt tokens past the prefill cache, of chunked prefills, take up decode cache entries.
+          max_decode_length = self.max_decode_length - max(
+              row.true_length - self.engine.config.max_prefill_predict_length, 0
+          )
+          slot_max_decode_lengths[slot] = min(max_decode_length, row.max_decode_length or max_decode_length)
+        else:
+          empty_slots.append(slot)  # dont use the slot
+          if emit_done is not None:
+            emit_done(row.id)
 
     while slot_to_id:
       log.debug(f"decode-{desc}-{num_decodes} num_filled_slots {len(slot_to_id)}")
       num_decodes += 1
       decode()
+    # The tokens of the last decode step, dispatched before the last rows finished, are all dropped.
     log.info(f"summary-{desc}-prefills-{num_prefills}-decodes-{num_decodes} completed.")
 
   def batch_inference(self, data: List[InputData], desc=""):
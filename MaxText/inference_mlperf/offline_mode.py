@@ -21,8 +21,10 @@ import math
 import logging
 import os
 import sys
-import array
 import collections
+import itertools
+import queue
+import threading
 
 import jax
 import jax.numpy as jnp
@@ -44,6 +46,7 @@ sys.path.insert(0, parent_dir)
 
 from maxengine import create_engine_from_config_flags
 import offline_inference
+import scheduler
 
 _MLPERF_ID = "llama2-70b"
 
@@ -153,6 +156,95 @@ flags.DEFINE_bool(
     required=False,
 )
 
+flags.DEFINE_string(
+    "aot_cache_dir",
+    "",
+    "If set, prefill and generate are compiled ahead of time, loading and saving the executables in this directory.",
+    required=False,
+)
+
+flags.DEFINE_enum(
+    "scenario",
+    "offline",
+    ["offline", "server"],
+    "MLPerf scenario. The server scenario admits queries as they arrive, into a single engine (see shared_engine).",
+    required=False,
+)
+
+flags.DEFINE_float(
+    "server_ttft_target_ms",
+    2000.0,
+    "Server scenario: time to first token target, prompts waiting for longer are prefilled first.",
+    required=False,
+)
+
+flags.DEFINE_float(
+    "server_tpot_target_ms",
+    200.0,
+    "Server scenario: time per output token target, which bounds the prefills between decode steps.",
+    required=False,
+)
+
+flags.DEFINE_float(
+    "server_prefill_time_ms",
+    100.0,
+    "Server scenario: estimated time of a prefill, e.g. from inference_microbenchmark.",
+    required=False,
+)
+
+flags.DEFINE_float(
+    "server_decode_step_time_ms",
+    50.0,
+    "Server scenario: estimated time of a decode step, e.g. from inference_microbenchmark.",
+    required=False,
+)
+
+flags.DEFINE_bool(
+    "shared_engine",
+    False,
+    "If set, a single engine serves every query batch, so that queries of all prefill lengths share its decode "
+    "slots. It has the largest batch size of the query batches and the cache length of the longest prefill length, "
+    "so its kv cache must fit that many slots of that length; every query still ends at the target length of its "
+    "own query batch.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "max_prefill_batch_size",
+    1,
+    "Maximum number of same-bucket prompts to prefill together in one forward pass.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "max_prefill_pack_size",
+    1,
+    "Maximum number of short prompts concatenated into one prefill sequence. Values <= 1 disable packing.",
+    required=False,
+)
+
+flags.DEFINE_enum(
+    "scheduler",
+    "fifo",
+    list(scheduler.SCHEDULERS),
+    "Admission order of the queries of every batch, see scheduler.py.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "max_prefills_per_decode",
+    0,
+    "Maximum number of prompts prefilled between two decode steps, 0 for no limit.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "min_empty_slots",
+    1,
+    "Number of empty decode slots to wait for before prefilling while other slots are decoding.",
+    required=False,
+)
+
 flags.DEFINE_float(
     "tok_outlen_multiplier",
     3.0,
@@ -173,11 +265,34 @@ scenario_map = {
 }
 
 
-def pad_tokens(tokens):
-  true_length = len(tokens)
-  target_length = max(int(2 ** math.ceil(math.log2(true_length))), 32)
-  padded = tokens + [0] * (target_length - true_length)
-  return padded, true_length
+def load_samples(dataset, sample_ids):
+  """Returns the InputData of the dataset rows at positions sample_ids, by sample id.
+
+  Prompts are padded to the next power of two, at least 32, all prompts of a
+  padded length together into one host matrix. Each InputData holds a host row
+  of it, so a prefill moves its rows to device in a single transfer.
+  """
+  sample_ids = np.asarray(sample_ids, dtype=np.int64)
+  prompts = dataset.tok_input.to_numpy()[sample_ids]
+  output_lengths = dataset.tok_output_length.to_numpy()[sample_ids]
+  true_lengths = np.fromiter((len(prompt) for prompt in prompts), dtype=np.int64, count=len(prompts))
+  padded_lengths = np.maximum(2 ** np.ceil(np.log2(true_lengths)).astype(np.int64), 32)
+
+  input_data = {}
+  for padded_length in np.unique(padded_lengths):
+    rows = np.flatnonzero(padded_lengths == padded_length)
+    lengths = true_lengths[rows]
+    # Scatter the concatenated prompts into their rows of the matrix.
+    tokens = np.concatenate([np.asarray(prompt, dtype=np.int32) for prompt in prompts[rows]])
+    row_idx = np.repeat(np.arange(len(rows)), lengths)
+    col_idx = np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    padded = np.zeros((len(rows), padded_length), dtype=np.int32)
+    padded[row_idx, col_idx] = tokens
+    for i, row in enumerate(rows):
+      input_data[int(sample_ids[row])] = offline_inference.InputData(  # to be filled later
+          "", padded[i], int(lengths[i]), expected_output_length=int(output_lengths[row])
+      )
+  return input_data
 
 
 def _init_query_batches():
@@ -199,10 +314,8 @@ def timed(msg):
   log.info(msg + " done: " + str(end - start))
 
 
-def _classify_query(dataset_rows, index, query_batches):
-  sample = dataset_rows[index][1]
-  input_len = sample.tok_input_length
-  total_len = int(sample.tok_input_length + FLAGS.tok_outlen_multiplier * sample.tok_output_length)
+def _classify_query(input_len, output_len, query_batches):
+  total_len = int(input_len + FLAGS.tok_outlen_multiplier * output_len)
   query_batch_keys = list(query_batches.keys())
   query_batch_keys.sort()
   target_inputs = [lb[0] for lb in query_batch_keys]
@@ -220,6 +333,12 @@ def _classify_query(dataset_rows, index, query_batches):
   return -1
 
 
+def _max_decode_length(group_idx):
+  """Returns the number of tokens decoded for a query of a query batch, up to twice its prefill length in all."""
+  length, _ = group_idx
+  return length
+
+
 def _pick_batch_size(num_samples, max_batch, dataset_size, sample_size):
   """max_batch to not run OOM."""
   if num_samples <= max_batch:
@@ -230,22 +349,16 @@ def _pick_batch_size(num_samples, max_batch, dataset_size, sample_size):
 
 def get_warmup_samples(dataset):
   query_batches = _init_query_batches()
-  pandas_rows = list(dataset.iterrows())
-  input_data = {}
-  for sample_id in range(len(pandas_rows)):
-    p = pandas_rows[sample_id][1]
-    padded, length = pad_tokens(p.tok_input)
-    input_data[sample_id] = offline_inference.InputData("", jnp.array(padded), length)  # to be filled later
-  for data in input_data.values():
-    # make sure tokens are transferred to device
-    jax.block_until_ready(data.tokens)
-  sample_id_to_input = input_data
-  for sample_id in range(len(input_data)):
-    group_idx = _classify_query(pandas_rows, sample_id, query_batches)
+  sample_id_to_input = load_samples(dataset, range(len(dataset)))
+  input_lengths = dataset.tok_input_length.to_numpy()
+  output_lengths = dataset.tok_output_length.to_numpy()
+  for sample_id in range(len(sample_id_to_input)):
+    group_idx = _classify_query(input_lengths[sample_id], output_lengths[sample_id], query_batches)
     if group_idx == -1:
       continue
     input_ = copy.copy(sample_id_to_input[sample_id])
     input_.id = sample_id
+    input_.max_decode_length = _max_decode_length(group_idx)
     query_batches[group_idx].append(input_)
 
   interesting_buckets = [
@@ -274,6 +387,14 @@ def get_warmup_samples(dataset):
   return warmup_samples
 
 
+def _groups_by_instance(offline_inf_instances):
+  """Returns every OfflineInference with the query batches it serves, all of them with --shared_engine."""
+  groups = {}
+  for group_idx, offline_inf in offline_inf_instances.items():
+    groups.setdefault(id(offline_inf), (offline_inf, []))[1].append(group_idx)
+  return list(groups.values())
+
+
 class SUT:
 
   def __init__(self, data, offline_inf_instances):
@@ -282,6 +403,8 @@ class SUT:
 
     # pandas dataframe, it has tok
     self._dataset = data
+    self._input_lengths = data.tok_input_length.to_numpy()
+    self._output_lengths = data.tok_output_length.to_numpy()
 
     # List of things with .id and .index
     self._queries = None
@@ -304,13 +427,14 @@ class SUT:
     log.info(f"Before Issue {num_queries} queries - classified queries {num_grouped_queries}")
     self._query_batches = _init_query_batches()
     for q in queries:
-      group_idx = _classify_query(self.pandas_rows, q.index, self._query_batches)
+      group_idx = _classify_query(self._input_lengths[q.index], self._output_lengths[q.index], self._query_batches)
       if group_idx == -1:
         num_skipped_queries += 1
         log.debug("Filtering out query of input len larger than acceptable configuration")
       else:
         input_data = copy.copy(self._sample_id_to_input[q.index])
         input_data.id = q.id
+        input_data.max_decode_length = _max_decode_length(group_idx)
         self._query_batches[group_idx].append(input_data)
     num_grouped_queries = [len(self._query_batches[b]) for b in self._query_batches]
     log.info(f"Issue {num_queries} queries - classified queries {num_grouped_queries} num_skipped {num_skipped_queries}")
@@ -325,37 +449,29 @@ class SUT:
   def flush_queries(self):
     log.info("Flush queries start")
     start = time.perf_counter()
-    for group_idx in self._query_batches:
-      group = self._query_batches[group_idx]
-      log.info(f"Flush queries processing {group_idx} with {len(group)} samples")
-      self.offline_inf_instances[group_idx].init_decode_state()
-      result = self.offline_inf_instances[group_idx].batch_inference(group, desc=f"batch-{group_idx}")
-      self.offline_inf_instances[group_idx].decode_state = None
+    for offline_inf, group_idxs in _groups_by_instance(self.offline_inf_instances):
+      # Query batches sharing an engine are processed together, so that their queries are in flight together.
+      group = [input_data for group_idx in group_idxs for input_data in self._query_batches[group_idx]]
+      log.info(f"Flush queries processing {group_idxs} with {len(group)} samples")
+      offline_inf.init_decode_state()
+      result = offline_inf.batch_inference(group, desc=f"batch-{group_idxs}")
+      offline_inf.decode_state = None
       gc.collect()
-      for key, val in result.items():
-        key = int(key)
-        lg.FirstTokenComplete([make_response(key, [val[0]])])
-        resp = make_response(key, val)
-        lg.QuerySamplesComplete([resp])
+      ids = [int(key) for key in result]
+      first_token_responses, first_token_arena = make_responses(ids, [val[:1] for val in result.values()])
+      lg.FirstTokenComplete(first_token_responses)
+      responses, arena = make_responses(ids, list(result.values()))
+      lg.QuerySamplesComplete(responses)
+      del first_token_arena, arena  # LoadGen copied the responses.
 
     log.info("Flush queries end")
     end = time.perf_counter()
 
   def LoadSamplesToRam(self, sample_list):
-    """Pads the data, move them to jax array on device"""
+    """Pads the data into host arrays, which the prefills move to device."""
     log.info("LoadSamplesToRam start")
     start = time.perf_counter()
-    input_data = {}
-    self.pandas_rows = list(self._dataset.iterrows())
-
-    for sample_id in sample_list:
-      p = self.pandas_rows[sample_id][1]
-      padded, length = pad_tokens(p.tok_input)
-      input_data[sample_id] = offline_inference.InputData("", jnp.array(padded), length)  # to be filled later
-
-    for data in input_data.values():
-      # make sure tokens are transferred to device
-      jax.block_until_ready(data.tokens)
+    input_data = load_samples(self._dataset, sample_list)
 
     self._sample_id_to_input = input_data
 
@@ -367,15 +483,86 @@ class SUT:
     pass
 
 
-def make_response(id_, response_token_ids):
-  n_tokens = len(response_token_ids)
-  response_token_ids = np.array(response_token_ids, dtype=np.int64)
-  response_array = array.array("B", response_token_ids.tobytes())
-  response_info = response_array.buffer_info()
-  response_data = response_info[0]
-  response_size = response_info[1] * response_array.itemsize
-  query_sample_response = lg.QuerySampleResponse(id_, response_data, response_size, n_tokens)
-  return query_sample_response
+class ServerSUT(SUT):
+  """System under test of the Server scenario, streaming queries through one OfflineInference as they arrive.
+
+  issue_queries hands queries over to a background loop, which admits them into
+  free decode slots between decode steps, and reports their first token and
+  their completion to LoadGen as soon as they are generated.
+  """
+
+  def __init__(self, data, offline_inf_instances):
+    super().__init__(data, offline_inf_instances)
+    ((self.offline_inf, _),) = _groups_by_instance(offline_inf_instances)
+    self._arrivals = queue.Queue()
+    self._thread = None
+
+  def start(self):
+    self.offline_inf.init_decode_state()
+    self._thread = threading.Thread(target=self._serve, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._arrivals.put(None)
+    self._thread.join()
+    self.offline_inf.decode_state = None
+
+  def _serve(self):
+    eos_id = self.offline_inf.tokenizer.eos_id
+    tokens = {}
+
+    def emit_first_token(id_, token):
+      tokens[id_] = [token]
+      responses, _ = make_responses([id_], [[token]])
+      lg.FirstTokenComplete(responses)
+      return token == eos_id
+
+    def emit_token(id_, token):
+      tokens[id_].append(token)
+      return token == eos_id
+
+    def emit_done(id_):
+      responses, _ = make_responses([id_], [tokens.pop(id_)])
+      lg.QuerySamplesComplete(responses)
+
+    self.offline_inf.batch_inference_with_callback(
+        [], emit_first_token, emit_token, desc="server", arrivals=self._arrivals, emit_done=emit_done
+    )
+
+  def issue_queries(self, queries):
+    assert self._sample_id_to_input is not None
+    for q in queries:
+      group_idx = _classify_query(self._input_lengths[q.index], self._output_lengths[q.index], self._query_batches)
+      if group_idx == -1:
+        log.debug("Filtering out query of input len larger than acceptable configuration")
+        responses, _ = make_responses([q.id], [[]])
+        lg.QuerySamplesComplete(responses)
+        continue
+      input_data = copy.copy(self._sample_id_to_input[q.index])
+      input_data.id = q.id
+      input_data.max_decode_length = _max_decode_length(group_idx)
+      input_data.arrival_time = time.perf_counter()
+      self._arrivals.put(input_data)
+
+  def flush_queries(self):
+    pass
+
+
+def make_responses(ids, token_lists):
+  """Builds the responses of several queries, pointing into one contiguous int64 arena of their tokens.
+
+  Returns the responses and the arena, which must be kept alive until LoadGen
+  has been handed the responses.
+  """
+  lengths = np.fromiter((len(tokens) for tokens in token_lists), dtype=np.int64, count=len(token_lists))
+  arena = np.fromiter(itertools.chain.from_iterable(token_lists), dtype=np.int64, count=int(lengths.sum()))
+  offsets = (np.cumsum(lengths) - lengths) * arena.itemsize
+  address = arena.ctypes.data
+  responses = [
+      lg.QuerySampleResponse(id_, address + int(offset), int(n_tokens) * arena.itemsize, int(n_tokens))
+      for id_, offset, n_tokens in zip(ids, offsets, lengths)
+  ]
+  return responses, arena
 
 
 def _estimated_counts_by_bucket(dataset):
@@ -409,11 +596,11 @@ def main(argv):
     server = jax.profiler.start_server(FLAGS.jax_profiler_port)
 
   settings = lg.TestSettings()
-  settings.scenario = lg.TestScenario.Offline
+  settings.scenario = scenario_map[FLAGS.scenario]
   user_conf = FLAGS.user_conf
 
-  settings.FromConfig(FLAGS.mlperf_conf, _MLPERF_ID, "Offline")
-  settings.FromConfig(user_conf, _MLPERF_ID, "Offline")
+  settings.FromConfig(FLAGS.mlperf_conf, _MLPERF_ID, FLAGS.scenario.capitalize())
+  settings.FromConfig(user_conf, _MLPERF_ID, FLAGS.scenario.capitalize())
   log.info("Mlperf config: %s", FLAGS.mlperf_conf)
   log.info("User config: %s", user_conf)
 
@@ -424,7 +611,6 @@ def main(argv):
   estimated_counts_by_bucket = _estimated_counts_by_bucket(dataset)
   log.info(f"Dataset len {len(dataset)}, estimated counts by bucket {estimated_counts_by_bucket}")
 
-  rows = list(dataset.iterrows())
   len_batch_str = FLAGS.prefill_lengths_and_batch_sizes
   log.info(f"Prefill lengths and Batch sizes: {len_batch_str}")
   log.info(f"Maxengine args: {FLAGS.maxengine_args}")
@@ -435,9 +621,27 @@ def main(argv):
   query_batches = _init_query_batches()
   params = None
   base_engine = None
-  # Create an engine and corresponding offline_inf_instance per batch of queries
+  if FLAGS.scenario == "server":
+    policy = scheduler.LatencyTargetScheduler(
+        tpot_target=FLAGS.server_tpot_target_ms / 1000,
+        ttft_target=FLAGS.server_ttft_target_ms / 1000,
+        prefill_time=FLAGS.server_prefill_time_ms / 1000,
+        decode_step_time=FLAGS.server_decode_step_time_ms / 1000,
+        max_prefills_per_decode=FLAGS.max_prefills_per_decode,
+        min_empty_slots=FLAGS.min_empty_slots,
+    )
+  else:
+    policy = scheduler.create_scheduler(FLAGS.scheduler, FLAGS.max_prefills_per_decode, FLAGS.min_empty_slots)
+  # Create an engine and corresponding offline_inf_instance per batch of queries, or a single one for all of them.
   for group_idx in query_batches:
     (length, batch) = group_idx
+    if FLAGS.shared_engine or FLAGS.scenario == "server":
+      if offline_inf_instances:
+        offline_inf_instances[group_idx] = next(iter(offline_inf_instances.values()))
+        continue
+      # Enough slots for the largest query batch, each long enough for the longest prefill length.
+      length = max(group_length for group_length, _ in query_batches)
+      batch = max(group_batch for _, group_batch in query_batches)
     target_length = 2 * length
     log.info(f"Using batch size: {batch} and length: {length}")
     engine = create_engine_from_config_flags(
@@ -446,23 +650,44 @@ def main(argv):
         max_target_length=target_length,
         args_str=FLAGS.maxengine_args,
     )
-    offline_inf = offline_inference.OfflineInference(engine, params, base_engine)
+    offline_inf = offline_inference.OfflineInference(
+        engine,
+        params,
+        base_engine,
+        FLAGS.max_prefill_batch_size,
+        FLAGS.max_prefill_pack_size,
+        policy,
+    )
     if params is None and offline_inf.params is not None:
       base_engine = engine
     params = offline_inf.params
     offline_inf_instances[group_idx] = offline_inf
 
+  if FLAGS.aot_cache_dir:
+    with timed("aot_compile"):
+      for offline_inf, group_idxs in _groups_by_instance(offline_inf_instances):
+        length = max(group_length for group_length, _ in group_idxs)
+        prefill_lengths = [2**i for i in range(5, int(math.log2(length)) + 1)]  # The load_samples buckets.
+        log.info(f"compile ahead of time for {length}")
+        offline_inf.compile(prefill_lengths, FLAGS.aot_cache_dir)
+        offline_inf.decode_state = None  # drop state
+        gc.collect()
+
   if not FLAGS.skip_warmup:
     with timed("warmup"):
-      for group_idx in offline_inf_instances:
-        (length, batch) = group_idx
+      for offline_inf, group_idxs in _groups_by_instance(offline_inf_instances):
+        length = max(group_length for group_length, _ in group_idxs)
         log.info(f"warm up for {length}")
-        offline_inf_instances[group_idx].init_decode_state()
-        offline_inf_instances[group_idx].warmup(length, warmup_samples[group_idx])
-        offline_inf_instances[group_idx].decode_state = None  # drop state
+        offline_inf.init_decode_state()
+        offline_inf.warmup(length, [sample for group_idx in group_idxs for sample in warmup_samples[group_idx]])
+        offline_inf.decode_state = None  # drop state
         gc.collect()
 
-  sut = SUT(dataset, offline_inf_instances)
+  if FLAGS.scenario == "server":
+    sut = ServerSUT(dataset, offline_inf_instances)
+    sut.start()
+  else:
+    sut = SUT(dataset, offline_inf_instances)
 
   if FLAGS.mlperf_test_mode == "accuracy":
     settings.mode = lg.TestMode.AccuracyOnly
@@ -495,6 +720,8 @@ def main(argv):
   lg.StartTestWithLogSettings(lgSUT, qsl, settings, log_settings, FLAGS.audit_conf)
   log.info(f"query counts {[len(sut._query_batches[q]) for q in sut._query_batches]}")
   log.info("Run Completed!")
+  if FLAGS.scenario == "server":
+    sut.stop()
   log.info("Destroying SUT...")
   lg.DestroySUT(lgSUT)
 
@@ -0,0 +1,276 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Continuous batching policies for OfflineInference, and a simulator to compare them on a recorded trace.
+
+A scheduler decides in which order rows are admitted, and how many of them may
+be prefilled into empty decode slots before the next decode step. Rows are
+anything with `tokens` (padded), `true_length` and `expected_output_length`
+attributes, e.g. offline_inference.InputData or TraceEntry.
+"""
+
+import dataclasses
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+Row = Any
+
+
+class Scheduler:
+  """Admits rows in input order, prefilling into every empty slot before decoding.
+
+  Attributes:
+    max_prefills_per_decode: Maximum number of rows prefilled between two decode
+      steps, 0 for no limit.
+    min_empty_slots: Number of empty slots to wait for before prefilling, while
+      other slots are decoding, e.g. so that batched prefills are full.
+  """
+
+  def __init__(self, max_prefills_per_decode: int = 0, min_empty_slots: int = 1):
+    self.max_prefills_per_decode = max_prefills_per_decode
+    self.min_empty_slots = max(min_empty_slots, 1)
+
+  def order(self, rows: Sequence[Row]) -> List[Row]:
+    """Returns the rows in admission order."""
+    return list(rows)
+
+  def num_prefills_allowed(
+      self, num_prefills_since_decode: int, num_empty_slots: int, num_active_slots: int, oldest_wait: float = 0.0
+  ) -> int:
+    """Returns how many rows may be prefilled now, 0 to run a decode step first.
+
+    Never returns 0 when no slot is active, which would leave nothing to decode.
+    oldest_wait is the time in seconds the next row to admit has waited since
+    its arrival, when rows stream in.
+    """
+    if num_active_slots == 0:
+      return num_empty_slots
+    if num_prefills_since_decode == 0 and num_empty_slots < self.min_empty_slots:
+      return 0
+    if self.max_prefills_per_decode > 0:
+      return min(num_empty_slots, max(self.max_prefills_per_decode - num_prefills_since_decode, 0))
+    return num_empty_slots
+
+
+class ExpectedOutputLengthScheduler(Scheduler):
+  """Admits rows by expected output length, shortest or longest first.
+
+  Starting long generations first keeps them from monopolizing slots at the end
+  of a batch, while shortest first minimizes the mean completion time. Rows
+  without an expected output length are admitted last, in input order.
+  """
+
+  def __init__(self, longest_first: bool = False, **kwargs):
+    super().__init__(**kwargs)
+    self.longest_first = longest_first
+
+  def order(self, rows: Sequence[Row]) -> List[Row]:
+    known = [row for row in rows if row.expected_output_length is not None]
+    unknown = [row for row in rows if row.expected_output_length is None]
+    return sorted(known, key=lambda row: row.expected_output_length, reverse=self.longest_first) + unknown
+
+
+class BucketScheduler(Scheduler):
+  """Admits rows of the same padded length together, so that prefills can be batched.
+
+  Buckets are admitted in order of their first row, and rows in input order
+  within a bucket. Combine with min_empty_slots to wait for enough empty slots
+  to prefill a full batch.
+  """
+
+  def order(self, rows: Sequence[Row]) -> List[Row]:
+    buckets: Dict[int, List[Row]] = {}
+    for row in rows:
+      buckets.setdefault(len(row.tokens), []).append(row)
+    return [row for bucket in buckets.values() for row in bucket]
+
+
+class LatencyTargetScheduler(Scheduler):
+  """Admits rows in arrival order, bounding prefills between decode steps to meet latency targets.
+
+  Every prefill between two decode steps delays the next token of all active
+  slots, so at most (tpot_target - decode_step_time) / prefill_time rows, and at
+  least one, are prefilled between decode steps. A row that would otherwise miss
+  its first token target, having waited ttft_target - prefill_time, is prefilled
+  regardless, but only one such row per decode step, so that a backlog of late
+  rows still leaves room for decode steps. Times are in seconds, the costs e.g.
+  from inference_microbenchmark.
+  """
+
+  def __init__(self, tpot_target: float, ttft_target: float, prefill_time: float, decode_step_time: float, **kwargs):
+    super().__init__(**kwargs)
+    max_prefills_per_decode = max(int((tpot_target - decode_step_time) // prefill_time), 1)
+    if self.max_prefills_per_decode > 0:
+      max_prefills_per_decode = min(max_prefills_per_decode, self.max_prefills_per_decode)
+    self.max_prefills_per_decode = max_prefills_per_decode
+    self.ttft_target = ttft_target
+    self.prefill_time = prefill_time
+
+  def num_prefills_allowed(
+      self, num_prefills_since_decode: int, num_empty_slots: int, num_active_slots: int, oldest_wait: float = 0.0
+  ) -> int:
+    num_allowed = super().num_prefills_allowed(num_prefills_since_decode, num_empty_slots, num_active_slots)
+    late = oldest_wait + self.prefill_time >= self.ttft_target
+    if num_allowed == 0 and num_empty_slots > 0 and late and num_prefills_since_decode <= self.max_prefills_per_decode:
+      return 1
+    return num_allowed
+
+
+SCHEDULERS = {
+    "fifo": Scheduler,
+    "shortest_output_first": lambda **kwargs: ExpectedOutputLengthScheduler(longest_first=False, **kwargs),
+    "longest_output_first": lambda **kwargs: ExpectedOutputLengthScheduler(longest_first=True, **kwargs),
+    "bucket": BucketScheduler,
+}
+
+
+def create_scheduler(policy: str = "fifo", max_prefills_per_decode: int = 0, min_empty_slots: int = 1) -> Scheduler:
+  if policy not in SCHEDULERS:
+    raise ValueError(f"Unknown scheduler policy {policy}, expected one of {list(SCHEDULERS)}")
+  return SCHEDULERS[policy](max_prefills_per_decode=max_prefills_per_decode, min_empty_slots=min_empty_slots)
+
+
+@dataclasses.dataclass
+class TraceEntry:
+  """A request of a recorded trace: its padded prompt and the number of tokens it generated."""
+
+  id: str
+  tokens: Sequence[int]
+  true_length: int
+  output_length: int
+  expected_output_length: Optional[int] = None
+
+
+def trace_from_results(data: Sequence[Row], results: Dict[Any, List[int]]) -> List[TraceEntry]:
+  """Records the trace of a batch_inference run, from its input rows and its results."""
+  return [
+      TraceEntry(
+          id=str(row.id),
+          tokens=[int(t) for t in row.tokens],
+          true_length=row.true_length,
+          output_length=len(results[row.id]),
+          expected_output_length=row.expected_output_length,
+      )
+      for row in data
+  ]
+
+
+def save_trace(trace: Sequence[TraceEntry], path: str) -> None:
+  with open(path, "w", encoding="utf-8") as f:
+    for entry in trace:
+      f.write(json.dumps(dataclasses.asdict(entry)) + "\n")
+
+
+def load_trace(path: str) -> List[TraceEntry]:
+  with open(path, "r", encoding="utf-8") as f:
+    return [TraceEntry(**json.loads(line)) for line in f if line.strip()]
+
+
+@dataclasses.dataclass
+class SimulationResult:
+  """Summary of a simulated run, times being in the units of the cost model."""
+
+  total_time: float
+  num_prefill_calls: int
+  num_decodes: int
+  # Mean fraction of slots generating a token, over decode steps.
+  slot_utilization: float
+  # Time from the admission of the last row to the end, when slots drain.
+  drain_time: float
+
+
+def simulate(
+    scheduler: Scheduler,
+    trace: Sequence[TraceEntry],
+    batch_size: int,
+    max_decode_length: int,
+    max_prefill_batch_size: int = 1,
+    prefill_call_time: float = 1.0,
+    prefill_token_time: float = 0.0,
+    decode_step_time: float = 1.0,
+) -> SimulationResult:
+  """Replays a trace through the OfflineInference admission loop under a cost model.
+
+  Like OfflineInference, consecutive rows of the same padded length are
+  prefilled together, up to max_prefill_batch_size, the first token of every row
+  comes from its prefill and a row leaves its slot once it has generated its
+  recorded output length or max_decode_length tokens.
+
+  Args:
+    scheduler: The policy to evaluate.
+    trace: The recorded requests.
+    batch_size: Number of decode slots.
+    max_decode_length: Maximum number of decode steps of a row.
+    max_prefill_batch_size: Maximum number of rows prefilled in one call.
+    prefill_call_time: Fixed cost of a prefill call.
+    prefill_token_time: Cost of a prefill call per padded prompt token.
+    decode_step_time: Cost of a decode step over all slots.
+  """
+  pending = scheduler.order(trace)
+  remaining = {}  # slot -> tokens left to generate.
+  empty_slots = list(range(batch_size))
+  time = 0.0
+  num_prefill_calls = num_decodes = num_prefills_since_decode = 0
+  active_slot_steps = 0
+
+  def decode():
+    nonlocal time, num_decodes, num_prefills_since_decode, active_slot_steps
+    time += decode_step_time
+    num_decodes += 1
+    num_prefills_since_decode = 0
+    active_slot_steps += len(remaining)
+    for slot in list(remaining):
+      remaining[slot] -= 1
+      if remaining[slot] <= 0:
+        del remaining[slot]
+        empty_slots.append(slot)
+
+  row_idx = 0
+  while row_idx < len(pending):
+    num_allowed = scheduler.num_prefills_allowed(num_prefills_since_decode, len(empty_slots), len(remaining))
+    if num_allowed == 0:
+      decode()
+      continue
+    rows = [pending[row_idx]]
+    while (
+        len(rows) < min(num_allowed, max_prefill_batch_size)
+        and row_idx + len(rows) < len(pending)
+        and len(pending[row_idx + len(rows)].tokens) == len(rows[0].tokens)
+    ):
+      rows.append(pending[row_idx + len(rows)])
+    row_idx += len(rows)
+
+    time += prefill_call_time + prefill_token_time * len(rows[0].tokens) * len(rows)
+    num_prefill_calls += 1
+    num_prefills_since_decode += len(rows)
+    for row in rows:
+      slot = empty_slots.pop()
+      # The first token comes from the prefill.
+      num_tokens = min(row.output_length - 1, max_decode_length)
+      if num_tokens > 0:
+        remaining[slot] = num_tokens
+      else:
+        empty_slots.append(slot)
+  admission_end = time
+
+  while remaining:
+    decode()
+
+  return SimulationResult(
+      total_time=time,
+      num_prefill_calls=num_prefill_calls,
+      num_decodes=num_decodes,
+      slot_utilization=active_slot_steps / max(num_decodes * batch_size, 1),
+      drain_time=time - admission_end,
+  )
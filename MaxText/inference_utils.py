@@ -27,7 +27,7 @@ NEG_INF = -1.0e7  # Masking purpose
 """
 
 
-def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0):
+def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0, nucleus_candidates=0):
   """
   logits: unnormalized logits to sample, shaped [YOUR_LEADING_DIMS, Vocab], before logit
   rng: rng key to use
@@ -35,34 +35,59 @@ def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0):
   topk: restricting to topk logits before sampling
   nucleus_topp: restricting to p probability mass before sampling
   temperature: temperature parameter for scaling probability
+  nucleus_candidates: number of top logits to look for the nucleus in before sorting all of them, 0 to always sort
   """
   if algorithm == "greedy":
     return jnp.argmax(logits, axis=-1)
   elif algorithm == "weighted":
     return jax.random.categorical(rng, logits / temperature)
   elif algorithm == "nucleus":
-    return sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng)
+    return sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng, nucleus_candidates)
   elif algorithm == "topk":
     return sample_topk_logits(logits, topk, temperature, rng)
   else:
     raise ValueError(f"Sampling {algorithm=} not supported!")
 
 
-def sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng):
+def sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng, num_candidates=0):
   """Restrict sampling to the top logits with cumulative probability >= nucleus_topp.
 
   The nucleus sampling method is proposed in the paper `The Curious Case of
   Neural Text Degeneration (https://arxiv.org/pdf/1904.09751.pdf)`
 
+  With 0 < num_candidates < Vocab, the nucleus is looked for among the top
+  num_candidates logits, found by `jax.lax.top_k` instead of a sort of the whole
+  vocabulary. The vocabulary is only sorted in the steps where some row needs
+  more candidates to reach nucleus_topp, so the sampled distribution is exact.
   """
   if nucleus_topp < 0:
     raise ValueError("Can't apply nucleus with parameter {nucleus_topp=} less zero")
+  if not 0 < num_candidates < logits.shape[-1]:
+    return _sample_nucleus_topp_sorted(logits, nucleus_topp, temperature, rng)
+
+  candidate_logits, candidate_idxs = jax.lax.top_k(logits, num_candidates)
+  # Probabilities over the whole vocabulary, whose normalizer needs no sort.
+  log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+  candidate_cum_probs = jnp.cumsum(jnp.exp(candidate_logits - log_normalizer), axis=-1)
+  cutoff_index = jnp.sum(candidate_cum_probs < nucleus_topp, axis=-1, keepdims=True)
+  candidate_logits = jnp.where(jnp.arange(num_candidates) <= cutoff_index, candidate_logits, NEG_INF)
+  candidate = jnp.expand_dims(jax.random.categorical(rng, candidate_logits / temperature), axis=-1)
+  sampled_tokens = jnp.squeeze(jnp.take_along_axis(candidate_idxs, candidate, axis=-1), axis=-1).astype(jnp.int32)
+  return jax.lax.cond(
+      jnp.all(candidate_cum_probs[..., -1] >= nucleus_topp),
+      lambda: sampled_tokens,
+      lambda: _sample_nucleus_topp_sorted(logits, nucleus_topp, temperature, rng),
+  )
+
+
+def _sample_nucleus_topp_sorted(logits, nucleus_topp, temperature, rng):
+  """Nucleus sampling from a descending sort of the whole vocabulary."""
   logits_sorted = jnp.sort(logits, axis=-1)[..., ::-1]  # sort descending
   sorted_cum_probs = jnp.cumsum(jax.nn.softmax(logits_sorted, axis=-1), axis=-1)  # get cumsum probs
   cutoff_index = jnp.sum(sorted_cum_probs < nucleus_topp, axis=-1, keepdims=True)  # find cutoff index
   cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
   logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
-  return jax.random.categorical(rng, logits / temperature)
+  return jax.random.categorical(rng, logits / temperature).astype(jnp.int32)
 
 
 def sample_topk_logits(logits, topk, temperature, rng):
@@ -73,3 +98,151 @@ def sample_topk_logits(logits, topk, temperature, rng):
   topk_token = jnp.expand_dims(jax.random.categorical(rng, topk_logits / temperature).astype(jnp.int32), axis=-1)
   sampled_tokens = jnp.squeeze(jnp.take_along_axis(topk_idxs, topk_token, axis=-1), axis=-1).astype(jnp.int32)
   return sampled_tokens
+
+
+def make_sampling_params(algorithm, topk=0, nucleus_topp=0, temperature=1.0):
+  """Converts the arguments of `sampling` into the per slot parameters of `sampling_per_slot`.
+
+  Greedy sampling becomes a zero temperature, and restrictions the algorithm
+  doesn't use are disabled: a topk of 0 and a nucleus_topp of 1.
+  """
+  if algorithm == "greedy":
+    topk, nucleus_topp, temperature = 0, 1.0, 0.0
+  elif algorithm == "weighted":
+    topk, nucleus_topp = 0, 1.0
+  elif algorithm == "nucleus":
+    if nucleus_topp < 0:
+      raise ValueError("Can't apply nucleus with parameter {nucleus_topp=} less zero")
+    topk = 0
+  elif algorithm == "topk":
+    if topk <= 0:
+      raise ValueError("Can't apply algorithm topk with parameter {topk=} less than or equal to zero")
+    nucleus_topp = 1.0
+  else:
+    raise ValueError(f"Sampling {algorithm=} not supported!")
+  return {
+      "topk": jnp.asarray(topk, dtype=jnp.int32),
+      "nucleus_topp": jnp.asarray(nucleus_topp, dtype=jnp.float32),
+      "temperature": jnp.asarray(temperature, dtype=jnp.float32),
+  }
+
+
+def sampling_per_slot(logits, rng, sampling_params, num_candidates=0):
+  """Samples every row of logits with its own parameters, in one pass for all of them.
+
+  A single descending sort of the logits serves both the top k and the nucleus
+  restrictions, which are applied in this order to the unscaled logits, and the
+  temperature only scales the logits left to sample from, as in `sampling`. With
+  0 < num_candidates < Vocab, only the top num_candidates logits are sorted, by
+  `jax.lax.top_k`, and the whole vocabulary only in the steps where some sampled
+  row needs more of them: a larger top k, a nucleus with more mass, or none.
+
+  logits: unnormalized logits to sample, shaped [batch, YOUR_OTHER_LEADING_DIMS, Vocab]
+  rng: rng key to use
+  sampling_params: dict of [batch] arrays, see `make_sampling_params`:
+    topk: restricting to topk logits before sampling, 0 to disable
+    nucleus_topp: restricting to p probability mass before sampling, >= 1 to disable
+    temperature: temperature parameter for scaling probability, 0 for greedy sampling
+  num_candidates: number of top logits to sample from before sorting all of them, 0 to always sort
+  """
+  batch, vocab = logits.shape[0], logits.shape[-1]
+
+  def per_row(x):
+    return jnp.reshape(x, (batch,) + (1,) * (logits.ndim - 1))
+
+  temperature = sampling_params["temperature"]
+  logits = logits.astype(jnp.float32)
+  log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+  cutoff_shape = logits.shape[:-1] + (1,)
+  topk = sampling_params["topk"]
+  topk = jnp.where((topk > 0) & (topk < vocab), topk, vocab)
+  nucleus_topp = per_row(sampling_params["nucleus_topp"])
+
+  def sample_sorted(logits_sorted, sorted_idxs):
+    """Samples from descending logits and their indices, all or a prefix of the vocabulary.
+
+    Also returns whether the nucleus of every row is known exactly from these logits.
+    """
+    num_sorted = logits_sorted.shape[-1]
+    row_topk = per_row(topk)
+    topk_cutoff_index = jnp.broadcast_to(per_row(jnp.minimum(topk, num_sorted) - 1), cutoff_shape)
+    logits_sorted = jnp.where(jnp.arange(num_sorted) <= topk_cutoff_index, logits_sorted, NEG_INF)
+    # Rows restricted to their top k logits renormalize over these, the others over the whole vocabulary.
+    sorted_log_mass = jax.nn.logsumexp(logits_sorted, axis=-1, keepdims=True)
+    exact_log_normalizer = jnp.where(row_topk < vocab, sorted_log_mass, log_normalizer)
+    # The mass of a top k reaching past the sorted logits is only bounded: its unsorted logits hold at least their
+    # share of the unsorted mass, and at most as much as the last sorted logit each.
+    partial = (row_topk > num_sorted) & (row_topk < vocab)
+    num_unsorted = jnp.maximum(row_topk - num_sorted, 1)
+    unsorted_log_mass = log_normalizer + jnp.log1p(-jnp.minimum(jnp.exp(sorted_log_mass - log_normalizer), 1.0))
+    lower_log_normalizer = jnp.logaddexp(
+        sorted_log_mass, unsorted_log_mass + jnp.log(num_unsorted / max(vocab - num_sorted, 1))
+    )
+    upper_log_normalizer = jnp.minimum(
+        log_normalizer, jnp.logaddexp(sorted_log_mass, jnp.log(num_unsorted) + logits_sorted[..., -1:])
+    )
+
+    def nucleus_cutoff_index(row_log_normalizer):
+      sorted_cum_probs = jnp.cumsum(jnp.exp(logits_sorted - row_log_normalizer), axis=-1)  # get cumsum probs
+      return jnp.sum(sorted_cum_probs < nucleus_topp, axis=-1, keepdims=True)  # find cutoff index
+
+    lower_cutoff_index = nucleus_cutoff_index(jnp.where(partial, lower_log_normalizer, exact_log_normalizer))
+    upper_cutoff_index = nucleus_cutoff_index(jnp.where(partial, upper_log_normalizer, exact_log_normalizer))
+    # The exact cutoff lies between the cutoffs of the bounds, it is known when they agree within the sorted logits.
+    nucleus_known = (lower_cutoff_index == upper_cutoff_index) & (upper_cutoff_index < num_sorted)
+    cutoff_index = jnp.where(nucleus_topp < 1.0, jnp.minimum(upper_cutoff_index, topk_cutoff_index), topk_cutoff_index)
+    logits_sorted = jnp.where(jnp.arange(num_sorted) <= cutoff_index, logits_sorted, NEG_INF)
+
+    scaled_logits_sorted = logits_sorted / per_row(jnp.where(temperature > 0, temperature, 1.0))
+    sampled = jnp.expand_dims(jax.random.categorical(rng, scaled_logits_sorted), axis=-1)
+    sampled_tokens = jnp.squeeze(jnp.take_along_axis(sorted_idxs, sampled, axis=-1), axis=-1).astype(jnp.int32)
+    greedy_tokens = sorted_idxs[..., 0].astype(jnp.int32)
+    tokens = jnp.where(per_row(temperature)[..., 0] > 0, sampled_tokens, greedy_tokens)
+    return tokens, nucleus_known
+
+  def sample_all():
+    sorted_idxs = jnp.argsort(-logits, axis=-1)  # sort descending
+    return sample_sorted(jnp.take_along_axis(logits, sorted_idxs, axis=-1), sorted_idxs)[0]
+
+  if not 0 < num_candidates < vocab:
+    return sample_all()
+  tokens, nucleus_known = sample_sorted(*jax.lax.top_k(logits, num_candidates))
+  # Greedy rows only need the top logit, the others a top k or a nucleus within the candidates.
+  covered = (per_row(temperature) <= 0) | (per_row(topk) <= num_candidates) | ((nucleus_topp < 1.0) & nucleus_known)
+  return jax.lax.cond(jnp.all(covered), lambda: tokens, sample_all)
+
+
+def make_stop_criteria(
+    stop_tokens=(), stop_sequences=(), max_new_tokens=0, *, max_stop_tokens, max_stop_sequences, max_stop_sequence_length
+):
+  """Converts the stop criteria of a request into the fixed size arrays of per slot stop criteria.
+
+  stop_tokens: token ids ending the generation, e.g. <|eot_id|>, at most max_stop_tokens
+  stop_sequences: token id sequences ending the generation once generated in a row, e.g. the tokens of a stop
+    string, at most max_stop_sequences of at most max_stop_sequence_length tokens
+  max_new_tokens: number of tokens to generate at most, the first one included, 0 for as many as fit
+  """
+  if len(stop_tokens) > max_stop_tokens:
+    raise ValueError(f"Got {len(stop_tokens)} stop tokens, more than {max_stop_tokens=}")
+  if len(stop_sequences) > max_stop_sequences:
+    raise ValueError(f"Got {len(stop_sequences)} stop sequences, more than {max_stop_sequences=}")
+  if any(not 0 < len(sequence) <= max_stop_sequence_length for sequence in stop_sequences):
+    raise ValueError(f"Stop sequences must have between 1 and {max_stop_sequence_length=} tokens")
+  if max_new_tokens < 0:
+    raise ValueError(f"Can't generate {max_new_tokens=} tokens")
+  # Token id -1 is never generated, so it pads the stop tokens, and the stop sequences, which are right aligned.
+  padded_stop_tokens = list(stop_tokens) + [-1] * (max_stop_tokens - len(stop_tokens))
+  padded_stop_sequences = [[-1] * max_stop_sequence_length] * max_stop_sequences
+  for i, sequence in enumerate(stop_sequences):
+    padded_stop_sequences[i] = [-1] * (max_stop_sequence_length - len(sequence)) + list(sequence)
+  return {
+      "stop_tokens": jnp.asarray(padded_stop_tokens, dtype=jnp.int32).reshape((max_stop_tokens,)),
+      "stop_sequences": jnp.asarray(padded_stop_sequences, dtype=jnp.int32).reshape(
+          (max_stop_sequences, max_stop_sequence_length)
+      ),
+      "stop_sequence_lengths": jnp.asarray(
+          [len(sequence) for sequence in stop_sequences] + [0] * (max_stop_sequences - len(stop_sequences)),
+          dtype=jnp.int32,
+      ).reshape((max_stop_sequences,)),
+      "max_new_tokens": jnp.asarray(max_new_tokens, dtype=jnp.int32),
+  }
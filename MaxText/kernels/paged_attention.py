@@ -0,0 +1,234 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Kernels for attention over a paged kv cache for efficient inference.
+
+The keys and values of every decode slot live in fixed size pages of a pool
+shared by all slots, [num_kv_heads, num_pages, page_size, head_dim]. A slot's
+block table, [batch_size, pages_per_slot], lists the pool pages holding its
+tokens in sequence order. Only the first ceil(length / page_size) entries of a
+block table are meaningful.
+"""
+
+import functools
+
+import jax
+from jax import lax
+from jax.experimental import pallas as pl
+from jax.experimental.pallas import tpu as pltpu
+import jax.numpy as jnp
+import common_types
+
+from kernels.ragged_attention import ragged_flash_attention_kernel, reference_gqa
+
+
+DEFAULT_MASK_VALUE = common_types.DEFAULT_MASK_VALUE
+
+
+@functools.partial(jax.jit, static_argnames=["mask_value"])
+def reference_paged_gqa(
+    q: jax.Array,
+    k_pages: jax.Array,
+    v_pages: jax.Array,
+    lengths: jax.Array,
+    block_tables: jax.Array,
+    mask_value: float = DEFAULT_MASK_VALUE,
+) -> tuple[jax.Array, jax.Array, jax.Array]:
+  """Paged group query attention reference, gathering the pages of every slot.
+
+  Args:
+    q: A [batch_size, 1, num_heads_q, head_dim] jax.Array.
+    k_pages: A [num_heads_kv, num_pages, page_size, head_dim] jax.Array.
+    v_pages: A [num_heads_kv, num_pages, page_size, head_dim] jax.Array.
+    lengths: A i32[batch_size] jax.Array.
+    block_tables: A i32[batch_size, pages_per_slot] jax.Array.
+    mask_value: The value used for padding in attention. By default it is a very
+      negative floating point number.
+
+  Returns:
+    The output of attention([batch_size, 1, num_heads, head_dim]), along with the
+    max logit ([batch_size, 1, num_heads, 1]) and softmax denominator ([batch_size,
+    1, num_heads, 1]).
+  """
+  num_heads_kv, num_pages, page_size, head_dim = k_pages.shape
+  batch_size, pages_per_slot = block_tables.shape
+  block_tables = jnp.minimum(block_tables, num_pages - 1)
+
+  def gather(pages):
+    pages = pages[:, block_tables]  # (n_kv, b, pages_per_slot, page_size, d)
+    pages = jnp.reshape(pages, (num_heads_kv, batch_size, pages_per_slot * page_size, head_dim))
+    return jnp.swapaxes(pages, 0, 1)  # (b, n_kv, s, d)
+
+  return reference_gqa(q[:, 0], gather(k_pages), gather(v_pages), lengths, mask_value=mask_value)
+
+
+def paged_flash_attention_kernel(
+    lengths_ref,
+    block_tables_ref,
+    q_ref,
+    k_ref,
+    v_ref,
+    o_ref,
+    m_ref,
+    l_ref,
+    *,
+    page_size: int,
+    mask_value: float,
+):
+  """Pallas kernel for flash attention over one page per grid step."""
+  del block_tables_ref  # Only read by the BlockSpec index maps.
+  ragged_flash_attention_kernel(
+      lengths_ref, q_ref, k_ref, v_ref, o_ref, m_ref, l_ref, block_size=page_size, mask_value=mask_value
+  )
+
+
+def paged_mqa(
+    q: jax.Array,
+    k_pages: jax.Array,
+    v_pages: jax.Array,
+    lengths: jax.Array,
+    block_tables: jax.Array,
+    *,
+    mask_value: float = DEFAULT_MASK_VALUE,
+    cost_estimate: pl.CostEstimate | None = None,
+) -> tuple[jax.Array, jax.Array, jax.Array]:
+  """Paged multi query attention.
+
+  Args:
+    q: A [batch_size, num_heads, head_dim] jax.Array.
+    k_pages: A [num_pages, page_size, head_dim] jax.Array.
+    v_pages: A [num_pages, page_size, head_dim] jax.Array.
+    lengths: A i32[batch_size] jax.Array.
+    block_tables: A i32[batch_size, pages_per_slot] jax.Array.
+    mask_value: The value used for padding in attention. By default it is a very
+      negative floating point number.
+    cost_estimate: A Pallas TPU cost estimate based on a reference implementation
+
+  Returns:
+    The output of attention([batch_size, num_heads, head_dim]), along with the
+    max logit ([batch_size, num_heads]) and softmax denominator ([batch_size,
+    num_heads]).
+  """
+  batch_size, num_heads, head_dim = q.shape
+  num_pages, page_size, _ = k_pages.shape
+  _, pages_per_slot = block_tables.shape
+  assert lengths.shape == (batch_size,)
+  assert lengths.dtype == jnp.int32
+  assert block_tables.dtype == jnp.int32
+
+  def compute_page_indices(b, i, lengths_ref, block_tables_ref):
+    # Past the end of a slot, keep pointing at its last page so that no new page is fetched.
+    last_good_page = jnp.maximum(lax.div(lengths_ref[b] + page_size - 1, page_size) - 1, 0)
+    page = block_tables_ref[b, jnp.minimum(i, last_good_page)]
+    return jnp.minimum(page, num_pages - 1), 0, 0
+
+  out, m, l = pl.pallas_call(
+      functools.partial(
+          paged_flash_attention_kernel,
+          page_size=page_size,
+          mask_value=mask_value,
+      ),
+      grid_spec=pltpu.PrefetchScalarGridSpec(
+          num_scalar_prefetch=2,
+          in_specs=[
+              pl.BlockSpec((None, num_heads, head_dim), lambda b, i, *_: (b, 0, 0)),
+              pl.BlockSpec((None, page_size, head_dim), compute_page_indices),
+              pl.BlockSpec((None, page_size, head_dim), compute_page_indices),
+          ],
+          out_specs=[
+              pl.BlockSpec((None, num_heads, head_dim), lambda b, i, *_: (b, 0, 0)),
+              pl.BlockSpec((None, num_heads, head_dim), lambda b, i, *_: (b, 0, 0)),
+              pl.BlockSpec((None, num_heads, head_dim), lambda b, i, *_: (b, 0, 0)),
+          ],
+          grid=(batch_size, pages_per_slot),
+      ),
+      compiler_params=dict(
+          mosaic=dict(
+              dimension_semantics=("parallel", "arbitrary"),
+          )
+      ),
+      out_shape=[
+          jax.ShapeDtypeStruct((batch_size, num_heads, head_dim), jnp.float32),
+          jax.ShapeDtypeStruct((batch_size, num_heads, head_dim), jnp.float32),
+          jax.ShapeDtypeStruct((batch_size, num_heads, head_dim), jnp.float32),
+      ],
+      cost_estimate=cost_estimate,
+  )(lengths, block_tables, q, k_pages, v_pages)
+  return out, m[..., 0], l[..., 0]
+
+
+@functools.partial(jax.jit, static_argnames=["mask_value"])
+def paged_gqa(
+    query: jax.Array,
+    key_pages: jax.Array,
+    value_pages: jax.Array,
+    lengths: jax.Array,
+    block_tables: jax.Array,
+    *,
+    mask_value: float = DEFAULT_MASK_VALUE,
+) -> tuple[jax.Array, jax.Array, jax.Array]:
+  """Paged group query attention, multi head attention being the case of equal head counts.
+
+  Args:
+    query: A [batch_size, 1, num_heads_q, head_dim] jax.Array.
+    key_pages: A [num_heads_kv, num_pages, page_size, head_dim] jax.Array.
+    value_pages: A [num_heads_kv, num_pages, page_size, head_dim] jax.Array.
+    lengths: A i32[batch_size] jax.Array.
+    block_tables: A i32[batch_size, pages_per_slot] jax.Array.
+    mask_value: The value used for padding in attention. By default it is a very
+      negative floating point number.
+
+  Returns:
+    The unnormalized output of attention([batch_size, 1, num_heads, head_dim]),
+    along with the max logit ([batch_size, 1, num_heads, 1]) and softmax
+    denominator ([batch_size, 1, num_heads, 1]).
+  """
+  cost_analysis = (
+      reference_paged_gqa.lower(
+          query,
+          key_pages,
+          value_pages,
+          lengths,
+          block_tables,
+          mask_value=mask_value,
+      )
+      .compile()
+      .cost_analysis()[0]
+  )
+  cost_estimate = pl.CostEstimate(
+      flops=int(cost_analysis["flops"]),
+      transcendentals=int(cost_analysis["transcendentals"]),
+      bytes_accessed=int(cost_analysis["bytes accessed"]),
+  )
+  batch_size, _, num_heads_q, head_dim = query.shape
+  num_heads_kv = key_pages.shape[0]
+
+  query = query.reshape(batch_size, num_heads_kv, num_heads_q // num_heads_kv, head_dim)  # (b, n_kv, n_q // n_kv, d)
+  o, m, l = jax.vmap(
+      functools.partial(
+          paged_mqa,
+          mask_value=mask_value,
+          cost_estimate=cost_estimate,
+      ),
+      in_axes=(1, 0, 0, None, None),
+      out_axes=1,
+  )(query, key_pages, value_pages, lengths, block_tables)
+
+  m = jnp.reshape(m, (batch_size, 1, num_heads_q, 1))
+  l = jnp.reshape(l, (batch_size, 1, num_heads_q, 1))
+  o = jnp.reshape(o, (batch_size, 1, num_heads_q, head_dim))
+  o = o * l
+  return o, m, l
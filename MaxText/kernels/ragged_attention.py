@@ -33,6 +33,34 @@ DEFAULT_MASK_VALUE = common_types.DEFAULT_MASK_VALUE
 shard_map = shard_map.shard_map
 
 
+def dequantize(x: jax.Array, scale: jax.Array | None) -> jax.Array:
+  """Dequantizes a [batch_size, seq_len, num_heads, head_dim] quantized cache with its scale, if any.
+
+  The scale is [batch_size, seq_len, num_heads, 1] or [batch_size, seq_len, 1, 1],
+  per token and head or per token, as the KVQuant axis_cfg layouts.
+  """
+  if scale is None:
+    return x
+  return x.astype(jnp.float32) * scale.astype(jnp.float32)
+
+
+def _check_quantized_dtype(x: jax.Array) -> None:
+  if x.dtype == jnp.int4:
+    raise ValueError("Ragged attention supports int8 quantized kv caches, not int4.")
+
+
+def _scale_rows(scale: jax.Array) -> tuple[jax.Array, int | None]:
+  """Lays out a [batch_size, seq_len, num_heads or 1, 1] scale with seq_len last, for the scale blocks of ragged_mqa.
+
+  Returns the scale and the axis of its heads, to vmap over with the heads of the
+  cache: per token and head scales become [batch_size, num_heads, 1, seq_len],
+  per token scales become [batch_size, 1, seq_len], which all heads share.
+  """
+  if scale.shape[2] == 1:
+    return jnp.swapaxes(scale[..., 0], 1, 2), None
+  return jnp.transpose(scale, (0, 2, 3, 1)), 1
+
+
 @functools.partial(jax.jit, static_argnames=["mask_value"])
 def reference_mqa(
     q: jax.Array,
@@ -149,14 +177,21 @@ def ragged_flash_attention_kernel(
     q_ref,
     k_ref,
     v_ref,
-    o_ref,
-    m_ref,
-    l_ref,
-    *,
+    *refs,
     block_size: int,
     mask_value: float,
+    quantized: bool = False,
 ):
-  """Pallas kernel for flash attention."""
+  """Pallas kernel for flash attention.
+
+  When quantized, the refs following v_ref are the [1, block_size] per token
+  scales of the key and value blocks, which are applied to the logits and the
+  probabilities of the block, so that only the quantized blocks are read.
+  """
+  if quantized:
+    k_scale_ref, v_scale_ref, o_ref, m_ref, l_ref = refs
+  else:
+    o_ref, m_ref, l_ref = refs
   b, i = pl.program_id(0), pl.program_id(1)
 
   @pl.when(i == 0)
@@ -175,6 +210,8 @@ def ragged_flash_attention_kernel(
     m_prev, l_prev = m_ref[...], l_ref[...]
 
     qk = lax.dot_general(q, k, (((1,), (1,)), ((), ())), preferred_element_type=jnp.float32)
+    if quantized:
+      qk = qk * k_scale_ref[...].astype(jnp.float32)
 
     mask = i * block_size + jax.lax.broadcasted_iota(jnp.int32, qk.shape, 1) < length
     qk = qk + jnp.where(mask, 0.0, mask_value)
@@ -182,7 +219,10 @@ def ragged_flash_attention_kernel(
 
     s_curr = jnp.exp(qk - m_curr[..., None])
     l_curr = jax.lax.broadcast_in_dim(s_curr.sum(axis=-1), l_prev.shape, (0,))
-    o_curr_times_l_curr = jnp.dot(s_curr, v)
+    if quantized:
+      o_curr_times_l_curr = jnp.dot(s_curr * v_scale_ref[...].astype(jnp.float32), v)
+    else:
+      o_curr_times_l_curr = jnp.dot(s_curr, v)
 
     m_curr = jax.lax.broadcast_in_dim(m_curr, m_prev.shape, (0,))
     m_next = jnp.maximum(m_prev, m_curr)
@@ -200,6 +240,8 @@ def ragged_mqa(
     k: jax.Array,
     v: jax.Array,
     lengths: jax.Array,
+    k_scale: jax.Array | None = None,
+    v_scale: jax.Array | None = None,
     *,
     block_size: int = 256,
     mask_value: float = DEFAULT_MASK_VALUE,
@@ -209,9 +251,11 @@ def ragged_mqa(
 
   Args:
     q: A [batch_size, 1, head_dim] jax.Array.
-    k: A [batch_size, seq_len, head_dim] jax.Array.
-    v: A [batch_size, seq_len, head_dim] jax.Array.
+    k: A [batch_size, seq_len, head_dim] jax.Array, possibly int8 quantized.
+    v: A [batch_size, seq_len, head_dim] jax.Array, possibly int8 quantized.
     lengths: A i32[batch_size] jax.Array.
+    k_scale: With an int8 k, its [batch_size, 1, seq_len] per token scale.
+    v_scale: With an int8 v, its [batch_size, 1, seq_len] per token scale.
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
     cost_estimate: A Pallas TPU cost estimate based on a reference implementation
@@ -222,6 +266,7 @@ def ragged_mqa(
     num_heads, 1]).
   """
   batch_size, num_heads, head_dim = q.shape
+  _check_quantized_dtype(k)
   assert lengths.shape == (batch_size,)
   assert lengths.dtype == jnp.int32
   seq_len = k.shape[1]
@@ -235,19 +280,32 @@ def ragged_mqa(
     i_next = jnp.where(not_done, i, jnp.where(am_last_batch, last_good_block, 0))
     return b_next, i_next, 0
 
+  def compute_ragged_scale_block_indices(b, i, lengths_ref):
+    b_next, i_next, _ = compute_ragged_block_indices(b, i, lengths_ref)
+    return b_next, 0, i_next
+
+  in_specs = [
+      pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
+      pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
+      pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
+  ]
+  inputs = [q, k, v]
+  quantized = k_scale is not None
+  if quantized:
+    assert v_scale is not None, "k and v must be both quantized or both not."
+    in_specs += [pl.BlockSpec((None, 1, block_size), compute_ragged_scale_block_indices)] * 2
+    inputs += [k_scale, v_scale]
+
   out, m, l = pl.pallas_call(
       functools.partial(
           ragged_flash_attention_kernel,
           block_size=block_size,
           mask_value=mask_value,
+          quantized=quantized,
       ),
       grid_spec=pltpu.PrefetchScalarGridSpec(
           num_scalar_prefetch=1,
-          in_specs=[
-              pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
-              pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
-              pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
-          ],
+          in_specs=in_specs,
           out_specs=[
               pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
               pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
@@ -266,7 +324,7 @@ def ragged_mqa(
           jax.ShapeDtypeStruct((batch_size, num_heads, head_dim), jnp.float32),
       ],
       cost_estimate=cost_estimate,
-  )(lengths, q, k, v)
+  )(lengths, *inputs)
   return out, m[..., 0], l[..., 0]
 
 
@@ -282,6 +340,8 @@ def ragged_mha(
     key: jax.Array,
     value: jax.Array,
     lengths: jax.Array,
+    key_scale: jax.Array | None = None,
+    value_scale: jax.Array | None = None,
     *,
     block_size: int = 256,
     mask_value: float = DEFAULT_MASK_VALUE,
@@ -290,9 +350,11 @@ def ragged_mha(
 
   Args:
     q: A [batch_size, 1, num_heads, head_dim] jax.Array.
-    k: A [batch_size, seq_len, num_heads, head_dim] jax.Array.
-    v: A [batch_size, seq_len, num_heads, head_dim] jax.Array.
+    k: A [batch_size, seq_len, num_heads, head_dim] jax.Array, possibly int8 quantized.
+    v: A [batch_size, seq_len, num_heads, head_dim] jax.Array, possibly int8 quantized.
     lengths: A i32[batch_size] jax.Array.
+    key_scale: With a quantized k, its [batch_size, seq_len, num_heads or 1, 1] scale, see `dequantize`.
+    value_scale: With a quantized v, its [batch_size, seq_len, num_heads or 1, 1] scale.
     block_size: Value defining the Pallas block length in the seq_len dimension
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
@@ -302,11 +364,12 @@ def ragged_mha(
     max logit ([batch_size, num_heads, 1]) and softmax denominator ([batch_size,
     num_heads, 1]).
   """
+  _check_quantized_dtype(key)
   cost_analysis = (
       reference_mha.lower(
           query,
-          key,
-          value,
+          dequantize(key, key_scale),
+          dequantize(value, value_scale),
           lengths,
           mask_value=mask_value,
       )
@@ -319,6 +382,10 @@ def ragged_mha(
       bytes_accessed=int(cost_analysis["bytes accessed"]),
   )
 
+  scales, scale_axes = (), ()
+  if key_scale is not None:
+    (key_scale, key_scale_axis), (value_scale, value_scale_axis) = _scale_rows(key_scale), _scale_rows(value_scale)
+    scales, scale_axes = (key_scale, value_scale), (key_scale_axis, value_scale_axis)
   query = jnp.swapaxes(query, 1, 2)
   key = jnp.swapaxes(key, 1, 2)
   value = jnp.swapaxes(value, 1, 2)
@@ -329,9 +396,9 @@ def ragged_mha(
           mask_value=mask_value,
           cost_estimate=cost_estimate,
       ),
-      in_axes=(1, 1, 1, None),
+      in_axes=(1, 1, 1, None) + scale_axes,
       out_axes=2,
-  )(query, key, value, lengths)
+  )(query, key, value, lengths, *scales)
   m = jnp.expand_dims(m, axis=-1)
   l = jnp.expand_dims(l, axis=-1)
   o = o * l
@@ -350,6 +417,8 @@ def ragged_gqa(
     key: jax.Array,
     value: jax.Array,
     lengths: jax.Array,
+    key_scale: jax.Array | None = None,
+    value_scale: jax.Array | None = None,
     *,
     block_size: int = 256,
     mask_value: float = DEFAULT_MASK_VALUE,
@@ -358,9 +427,11 @@ def ragged_gqa(
 
   Args:
     q: A [batch_size, num_heads_q, head_dim] jax.Array.
-    k: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array.
-    v: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array.
+    k: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array, possibly int8 quantized.
+    v: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array, possibly int8 quantized.
     lengths: A i32[batch_size] jax.Array.
+    key_scale: With a quantized k, its [batch_size, seq_len, num_heads_kv or 1, 1] scale, see `dequantize`.
+    value_scale: With a quantized v, its [batch_size, seq_len, num_heads_kv or 1, 1] scale.
     block_size: Value defining the Pallas block length in the seq_len dimension
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
@@ -370,11 +441,12 @@ def ragged_gqa(
     max logit ([batch_size, num_heads, 1]) and softmax denominator ([batch_size,
     num_heads, 1]).
   """
+  _check_quantized_dtype(key)
   cost_analysis = (
       reference_gqa.lower(
           jnp.squeeze(query),
-          jnp.swapaxes(key, 1, 2),
-          jnp.swapaxes(value, 1, 2),
+          jnp.swapaxes(dequantize(key, key_scale), 1, 2),
+          jnp.swapaxes(dequantize(value, value_scale), 1, 2),
           lengths,
           mask_value=mask_value,
       )
@@ -389,6 +461,10 @@ def ragged_gqa(
   batch_size, _, num_heads_q, head_dim = query.shape
   _, _, num_heads_kv, _ = key.shape
 
+  scales, scale_axes = (), ()
+  if key_scale is not None:
+    (key_scale, key_scale_axis), (value_scale, value_scale_axis) = _scale_rows(key_scale), _scale_rows(value_scale)
+    scales, scale_axes = (key_scale, value_scale), (key_scale_axis, value_scale_axis)  # (b, n_kv or None, 1, s)
   query = query.reshape(batch_size, num_heads_kv, num_heads_q // num_heads_kv, head_dim)  # (b, n_kv, n_q // n_kv, d)
   key = jnp.swapaxes(key, 1, 2)  # (b, n_kv, s, d)
   value = jnp.swapaxes(value, 1, 2)  # (b, n_kv, s, d)
@@ -399,9 +475,9 @@ def ragged_gqa(
           mask_value=mask_value,
           cost_estimate=cost_estimate,
       ),
-      in_axes=(1, 1, 1, None),
+      in_axes=(1, 1, 1, None) + scale_axes,
       out_axes=1,
-  )(query, key, value, lengths)
+  )(query, key, value, lengths, *scales)
 
   m = jnp.reshape(m, (batch_size, 1, num_heads_q, 1))
   l = jnp.reshape(l, (batch_size, 1, num_heads_q, 1))
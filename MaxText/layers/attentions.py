@@ -28,6 +28,7 @@ from jax.experimental.pallas.ops.tpu.splash_attention import splash_attention_ke
 from jax.experimental.pallas.ops.tpu.splash_attention import splash_attention_mask
 import jax.numpy as jnp
 import common_types
+from kernels.paged_attention import paged_gqa
 from kernels.ragged_attention import ragged_gqa
 from kernels.ragged_attention import ragged_mha
 from layers import embeddings
@@ -71,6 +72,7 @@ CACHE_BATCH = common_types.CACHE_BATCH
 CACHE_SEQUENCE = common_types.CACHE_SEQUENCE
 CACHE_HEADS = common_types.CACHE_HEADS
 CACHE_KV = common_types.CACHE_KV
+CACHE_PAGES = common_types.CACHE_PAGES
 CACHE_SCALE_BATCH = common_types.CACHE_SCALE_BATCH
 CACHE_SCALE_SEQUENCE = common_types.CACHE_SCALE_SEQUENCE
 CACHE_SCALE_HEADS = common_types.CACHE_SCALE_HEADS
@@ -119,6 +121,45 @@ def apply_mask_to_logits(logits: Array, mask: Array):
   return jnp.where((mask >= DEFAULT_MASK_VALUE * 0.5), logits, DEFAULT_MASK_VALUE)
 
 
+def ragged_cache_update(cache: Array, one_token: Array, lengths: Array, batch_axis: int, sequence_axis: int) -> Array:
+  """Writes the token of every slot at the length of that slot, with one scatter for the whole batch.
+
+  Args:
+    cache: A cache, or the scale of a quantized one, in any axis order.
+    one_token: The new tokens, laid out as cache with a sequence length of 1.
+    lengths: i32[batch] position of the new token of every slot. Positions past
+      the end of the cache are dropped.
+    batch_axis: The batch axis of cache and one_token.
+    sequence_axis: The sequence axis of cache and one_token.
+  Returns:
+    The updated cache.
+  """
+  batch = one_token.shape[batch_axis]
+  indices = [slice(None)] * cache.ndim
+  indices[batch_axis] = jnp.arange(batch)
+  indices[sequence_axis] = lengths
+  updates = jnp.squeeze(one_token, sequence_axis)
+  if abs(batch_axis - sequence_axis) > 1:
+    # Numpy indexing puts the batch first when the indexed axes are not adjacent.
+    updates = jnp.moveaxis(updates, batch_axis - int(sequence_axis < batch_axis), 0)
+  return cache.at[tuple(indices)].set(updates.astype(cache.dtype), mode="drop")
+
+
+def ragged_cache_update_loop(cache: Array, one_token: Array, lengths: Array, batch_axis: int, sequence_axis: int) -> Array:
+  """ragged_cache_update with one update per slot, whose cost grows with the batch; kept as the benchmark baseline."""
+  cache_locations = [slice(None)] * cache.ndim
+  new_token_locations = [slice(None)] * cache.ndim
+  new_token_locations[sequence_axis] = 0
+
+  def body(i, val):
+    cache_locations[batch_axis] = i
+    cache_locations[sequence_axis] = lengths[i]
+    new_token_locations[batch_axis] = i
+    return val.at[tuple(cache_locations)].set(one_token[tuple(new_token_locations)])
+
+  return jax.lax.fori_loop(0, one_token.shape[batch_axis], body, cache, unroll=8)
+
+
 class AttentionOp(nn.Module):
   config: Config
   mesh: Mesh
@@ -132,6 +173,7 @@ class AttentionOp(nn.Module):
   flash_axis_names: AxisNames = (BATCH, HEAD, LENGTH, D_KV)
   cache_logical_axis_names: AxisNames = (CACHE_BATCH, CACHE_SEQUENCE, CACHE_HEADS, CACHE_KV)
   cache_scale_logical_axis_names: AxisNames = (CACHE_SCALE_BATCH, CACHE_SCALE_SEQUENCE, CACHE_SCALE_HEADS, CACHE_SCALE_KV)
+  paged_cache_logical_axis_names: AxisNames = (CACHE_HEADS, CACHE_PAGES, CACHE_SEQUENCE, CACHE_KV)
   ragged_qkv_axis_names: AxisNames = (CACHE_BATCH, CACHE_HEADS, CACHE_SEQUENCE, CACHE_KV)
   ragged_lengths_names: AxisNames = (CACHE_BATCH,)
   prefill_cache_axis_order: AxisIdxes = (1, 2, 0, 3)
@@ -160,12 +202,28 @@ class AttentionOp(nn.Module):
   # Following Pallas MHA Flash Attention Reference.
   # https://github.com/google/jax/blob/main/jax/experimental/pallas/ops/tpu/flash_attention.py
   # This mask models (1) separate sequences (decoder_segment_ids) and (2) causality
-  def generate_attention_mask(self, query, key, decoder_segment_ids: Array | None, model_mode: str) -> Array | None:
+  def generate_attention_mask(
+      self,
+      query,
+      key,
+      decoder_segment_ids: Array | None,
+      model_mode: str,
+      kv_decoder_segment_ids: Array | None = None,
+      q_offset: Array | int = 0,
+  ) -> Array | None:
+    """Generates the attention mask.
+
+    `kv_decoder_segment_ids` and `q_offset` are only needed when the queries are a
+    chunk of a longer sequence whose keys start earlier, as in chunked prefill: the
+    query at row i then sits at sequence position q_offset + i.
+    """
     mask = None
     if model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE:
       mask = decoder_segment_ids[:, None, None, None, :] == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
     elif decoder_segment_ids is not None:
-      mask = decoder_segment_ids[:, :, None] == decoder_segment_ids[:, None, :]
+      if kv_decoder_segment_ids is None:
+        kv_decoder_segment_ids = decoder_segment_ids
+      mask = decoder_segment_ids[:, :, None] == kv_decoder_segment_ids[:, None, :]
       mask = mask[:, None, None, :, :]
 
     causal_mask = None
@@ -174,7 +232,7 @@ class AttentionOp(nn.Module):
       _, q_seq_len, _, _ = query.shape
       _, kv_seq_len, _, _ = key.shape
       mask_shape = (q_seq_len, kv_seq_len)
-      row_ids = jax.lax.broadcasted_iota(jnp.int32, mask_shape, 0)
+      row_ids = jax.lax.broadcasted_iota(jnp.int32, mask_shape, 0) + q_offset
       col_ids = jax.lax.broadcasted_iota(jnp.int32, mask_shape, 1)
       causal_mask = (col_ids <= row_ids)[None, None, None, :, :]
 
@@ -191,9 +249,13 @@ class AttentionOp(nn.Module):
       if self.sliding_window_size is None:
         raise ValueError("Sliding_window_size must be set if Local Sliding attention type")
 
-      all_ones = jnp.ones_like(output_mask)
-      sliding_mask = jnp.triu(all_ones, -1 * self.sliding_window_size + 1) * jnp.tril(all_ones, self.sliding_window_size - 1)
-      output_mask = sliding_mask * output_mask
+      mask_shape = output_mask.shape[-2:]
+      row_ids = jax.lax.broadcasted_iota(jnp.int32, mask_shape, 0) + q_offset
+      col_ids = jax.lax.broadcasted_iota(jnp.int32, mask_shape, 1)
+      sliding_mask = jnp.logical_and(
+          col_ids > row_ids - self.sliding_window_size, col_ids < row_ids + self.sliding_window_size
+      )
+      output_mask = jnp.logical_and(sliding_mask, output_mask)
 
     return jnp.where(output_mask, 0.0, DEFAULT_MASK_VALUE) if output_mask is not None else None
 
@@ -249,11 +311,25 @@ class AttentionOp(nn.Module):
   def ragged_attention(
       self, query: Array, key: Array | KVTensor, value: Array | KVTensor, lengths: Array, block_size: int
   ) -> tuple[Array, Array, Array]:
-    """Ragged Attention."""
-    if isinstance(query, KVTensor) or isinstance(query, KVTensor):
-      raise TypeError("Ragged attention does not currently support quantized tensors.")
+    """Ragged Attention.
+
+    A quantized key and value are passed to the kernels as their int8 values
+    and scales, so that they read the quantized cache and dequantize each block
+    in VMEM instead of dequantizing the whole cache in HBM first.
+    """
     b = nn.logical_to_mesh_axes(self.ragged_lengths_names)
     bsnd = nn.logical_to_mesh_axes(self.cache_logical_axis_names)
+    if isinstance(key, KVTensor) != isinstance(value, KVTensor):
+      raise TypeError("Ragged attention needs the key and value both quantized or both not.")
+    scales, scale_specs = (), ()
+    if isinstance(key, KVTensor):
+      key, key_scale = key.qvalue, key.scale[0]
+      value, value_scale = value.qvalue, value.scale[0]
+      scales = (key_scale, value_scale)
+      # Scales per token and head shard like the heads of the cache, scales per token are replicated over them.
+      scale_heads = bsnd[2] if key_scale.shape[2] == key.shape[2] else None
+      scale_spec = jax.sharding.PartitionSpec(bsnd[0], bsnd[1], scale_heads, None)
+      scale_specs = (scale_spec, scale_spec)
 
     @functools.partial(
         shard_map,
@@ -263,18 +339,45 @@ class AttentionOp(nn.Module):
             bsnd,
             bsnd,
             b,
-            None,
+            *scale_specs,
         ),
         out_specs=bsnd,
         check_rep=False,
     )
-    def wrap_ragged_attention(query, key, value, lengths, block_size):
+    def wrap_ragged_attention(query, key, value, lengths, *scales):
       if query.shape[-2] == key.shape[-2]:
-        return ragged_mha(query, key, value, lengths, block_size=block_size)
+        return ragged_mha(query, key, value, lengths, *scales, block_size=block_size)
       else:
-        return ragged_gqa(query, key, value, lengths, block_size=block_size)
+        return ragged_gqa(query, key, value, lengths, *scales, block_size=block_size)
 
-    return wrap_ragged_attention(query, key, value, lengths, block_size)
+    return wrap_ragged_attention(query, key, value, lengths, *scales)
+
+  def paged_attention(
+      self, query: Array, key_pages: Array, value_pages: Array, lengths: Array, block_tables: Array
+  ) -> tuple[Array, Array, Array]:
+    """Attention over the paged autoregressive cache, reading pages through the block tables."""
+    b = nn.logical_to_mesh_axes(self.ragged_lengths_names)
+    bsnd = nn.logical_to_mesh_axes(self.cache_logical_axis_names)
+    pages = nn.logical_to_mesh_axes(self.paged_cache_logical_axis_names)
+    block_tables_axes = nn.logical_to_mesh_axes((CACHE_BATCH, CACHE_PAGES))
+
+    @functools.partial(
+        shard_map,
+        mesh=self.mesh,
+        in_specs=(
+            bsnd,
+            pages,
+            pages,
+            b,
+            block_tables_axes,
+        ),
+        out_specs=bsnd,
+        check_rep=False,
+    )
+    def wrap_paged_attention(query, key_pages, value_pages, lengths, block_tables):
+      return paged_gqa(query, key_pages, value_pages, lengths, block_tables)
+
+    return wrap_paged_attention(query, key_pages, value_pages, lengths, block_tables)
 
   def tpu_flash_attention(
       self,
@@ -439,6 +542,8 @@ class AttentionOp(nn.Module):
       value: Array | KVTensor,
       decoder_segment_ids: Array | None,
       model_mode: str = common_types.MODEL_MODE_TRAIN,
+      kv_decoder_segment_ids: Array | None = None,
+      q_offset: Array | int = 0,
   ):
     """Apply Attention."""
     validate_compute_axis_order(self.compute_axis_order)
@@ -459,7 +564,9 @@ class AttentionOp(nn.Module):
     # Casting softmaxt computation for float32 for model stability.
     if model_mode == common_types.MODEL_MODE_TRAIN and self.float32_logits:
       attn_weights = attn_weights.astype(jnp.float32)
-    attn_mask = self.generate_attention_mask(query, key, decoder_segment_ids, model_mode)
+    attn_mask = self.generate_attention_mask(
+        query, key, decoder_segment_ids, model_mode, kv_decoder_segment_ids=kv_decoder_segment_ids, q_offset=q_offset
+    )
     if attn_mask is not None:
       attn_weights = apply_mask_to_logits(attn_weights, attn_mask)
     return self.compute_local_attention(attn_weights, value, q_seq_len, model_mode)
@@ -547,12 +654,14 @@ class AttentionOp(nn.Module):
   def _get_cached_kv_dtype(self, dtype):
     return self.kv_quant.dtype if self.kv_quant else dtype
 
-  def _get_cache_scale_logical_shape(self, batch, heads):
+  def _get_cache_scale_logical_shape(self, batch, heads, cache_length=None):
     assert self.kv_quant
+    if cache_length is None:
+      cache_length = self.max_prefill_predict_length
     if self.kv_quant.axis_cfg == "dkv":
-      return (batch, self.max_prefill_predict_length, heads, 1)
+      return (batch, cache_length, heads, 1)
     if self.kv_quant.axis_cfg == "heads_and_dkv":
-      return (batch, self.max_prefill_predict_length, 1, 1)
+      return (batch, cache_length, 1, 1)
     raise f"Invalid config for kv_quant_axis:{self.kv_quant.axis_cfg}"
 
   def _get_prefill_cache_vars(self, batch, heads, kv_head_size):
@@ -608,10 +717,23 @@ class AttentionOp(nn.Module):
       cached_key_scale_var = None
       cached_value_scale_var = None
 
+    if self.use_ragged_attention:
+      self._get_prefill_lengths_var(cache_logical_shape[0])
+
     key_vars = (cached_key_var, cached_key_scale_var)
     value_vars = (cached_value_var, cached_value_scale_var)
     return key_vars, value_vars, cached_segment_id_var
 
+  def _get_prefill_lengths_var(self, batch):
+    """The prompt length of every slot, which insert records for ragged attention over the prefill cache."""
+    return self.variable(
+        "cache",
+        "cached_prefill_lengths",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+
   def _get_ar_cache_vars(self, batch, heads, kv_head_size):
 
     dtype = self._get_cached_kv_dtype(self.dtype)
@@ -663,7 +785,7 @@ class AttentionOp(nn.Module):
     )
 
     if self.kv_quant:
-      cache_scale_logical_shape = self._get_cache_scale_logical_shape(batch, heads)
+      cache_scale_logical_shape = self._get_cache_scale_logical_shape(batch, heads, cache_length)
       cache_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
       cache_scale_shape = self.transpose_tuple(cache_scale_logical_shape, self.ar_cache_axis_order)
 
@@ -690,6 +812,166 @@ class AttentionOp(nn.Module):
     value_vars = (cached_value_var, cached_value_scale_var)
     return key_vars, value_vars, cached_segment_id_var, cache_index_var, cached_lengths_var
 
+  def _get_paged_ar_cache_layout(self, batch):
+    """Returns the page size, pages per slot and pool size of the paged autoregressive cache."""
+    page_size = self.config.paged_attention_page_size
+    cache_length = self.max_target_length - self.max_prefill_predict_length
+    pages_per_slot = -(-cache_length // page_size)
+    # By default the pool can hold every slot at full length, like the dense cache.
+    num_pages = self.config.paged_attention_num_pages or batch * pages_per_slot
+    return page_size, pages_per_slot, num_pages
+
+  def _get_paged_ar_cache_vars(self, batch, heads, kv_head_size):
+    """The paged autoregressive cache: a pool of pages shared by all slots and per slot block tables.
+
+    A page owner of 0 marks a free page, otherwise it is the owning slot + 1.
+    """
+    dtype = self._get_cached_kv_dtype(self.dtype)
+    page_size, pages_per_slot, num_pages = self._get_paged_ar_cache_layout(batch)
+    cache_shape = (heads, num_pages, page_size, kv_head_size)
+
+    cached_key_pages_var = self.variable(
+        "cache",
+        "cached_ar_key_pages",
+        nn.with_logical_partitioning(jnp.zeros, self.paged_cache_logical_axis_names),
+        cache_shape,
+        dtype,
+    )
+    cached_key_pages_var.value = nn.with_logical_constraint(
+        cached_key_pages_var.value,
+        self.paged_cache_logical_axis_names,
+    )
+
+    cached_value_pages_var = self.variable(
+        "cache",
+        "cached_ar_value_pages",
+        nn.with_logical_partitioning(jnp.zeros, self.paged_cache_logical_axis_names),
+        cache_shape,
+        dtype,
+    )
+    cached_value_pages_var.value = nn.with_logical_constraint(
+        cached_value_pages_var.value,
+        self.paged_cache_logical_axis_names,
+    )
+
+    block_table_var = self.variable(
+        "cache",
+        "cached_ar_block_table",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH, CACHE_PAGES)),
+        (batch, pages_per_slot),
+        jnp.int32,
+    )
+
+    page_owner_var = self.variable(
+        "cache",
+        "cached_ar_page_owner",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_PAGES,)),
+        (num_pages,),
+        jnp.int32,
+    )
+
+    active_var = self.variable(
+        "cache",
+        "cached_ar_active",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+
+    cached_lengths_var = self.variable(
+        "cache",
+        "cached_ar_lengths",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+    return cached_key_pages_var, cached_value_pages_var, block_table_var, page_owner_var, active_var, cached_lengths_var
+
+  def _uses_ring_cache(self) -> bool:
+    """Whether the decode kv cache is a ring of the last sliding_window_size tokens, see `_get_ring_cache_vars`."""
+    return self.config.ring_local_kv_cache and self.attention_type == AttentionType.LOCAL_SLIDING
+
+  def _get_ring_cache_vars(self, batch, heads, kv_head_size):
+    """The ring cache of local sliding window layers: the keys and values of the last sliding_window_size tokens.
+
+    It replaces both the prefill and the autoregressive cache during decoding.
+    Position p of a slot is stored at entry p % sliding_window_size, `MaxEngine.insert`
+    fills the entries of the prompt tail from the prefill cache, and
+    cached_ring_index is the entry of the next token of every slot. Entries are
+    only ever overwritten by tokens a window later, so the filled entries,
+    marked by cache_ring_segment_id, always form a prefix of the ring.
+    """
+    dtype = self._get_cached_kv_dtype(self.dtype)
+    cache_length = self.sliding_window_size
+    cache_logical_shape = (batch, cache_length, heads, kv_head_size)
+
+    cache_axis_names = self.transpose_tuple(self.cache_logical_axis_names, self.ar_cache_axis_order)
+    cache_shape = self.transpose_tuple(cache_logical_shape, self.ar_cache_axis_order)
+
+    cached_key_var = self.variable(
+        "cache",
+        "cached_ring_key",
+        nn.with_logical_partitioning(jnp.zeros, cache_axis_names),
+        cache_shape,
+        dtype,
+    )
+    cached_value_var = self.variable(
+        "cache",
+        "cached_ring_value",
+        nn.with_logical_partitioning(jnp.zeros, cache_axis_names),
+        cache_shape,
+        dtype,
+    )
+    cached_segment_id_var = self.variable(
+        "cache",
+        "cache_ring_segment_id",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH, CACHE_SEQUENCE)),
+        (batch, cache_length),
+        jnp.int32,
+    )
+    cached_index_var = self.variable(
+        "cache",
+        "cached_ring_index",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+
+    if self.kv_quant:
+      cache_scale_logical_shape = self._get_cache_scale_logical_shape(batch, heads, cache_length)
+      cache_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
+      cache_scale_shape = self.transpose_tuple(cache_scale_logical_shape, self.ar_cache_axis_order)
+
+      cached_key_scale_var = self.variable(
+          "cache",
+          "cached_ring_key_scale",
+          nn.with_logical_partitioning(jnp.zeros, cache_scale_axis_names),
+          cache_scale_shape,
+          jnp.bfloat16,
+      )
+      cached_value_scale_var = self.variable(
+          "cache",
+          "cached_ring_value_scale",
+          nn.with_logical_partitioning(jnp.zeros, cache_scale_axis_names),
+          cache_scale_shape,
+          jnp.bfloat16,
+      )
+    else:
+      cached_key_scale_var = None
+      cached_value_scale_var = None
+
+    key_vars = (cached_key_var, cached_key_scale_var)
+    value_vars = (cached_value_var, cached_value_scale_var)
+    return key_vars, value_vars, cached_segment_id_var, cached_index_var
+
+  def _init_ar_cache_vars(self, batch, heads, kv_head_size):
+    if self._uses_ring_cache():
+      _ = self._get_ring_cache_vars(batch, heads, kv_head_size)
+    elif self.config.use_paged_attention:
+      _ = self._get_paged_ar_cache_vars(batch, heads, kv_head_size)
+    else:
+      _ = self._get_ar_cache_vars(batch, heads, kv_head_size)
+
   def kv_cache_prefill(
       self,
       key: Array,
@@ -714,7 +996,7 @@ class AttentionOp(nn.Module):
     cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
         batch, heads, kv_head_size
     )
-    _ = self._get_ar_cache_vars(batch, heads, kv_head_size)  # initialize it now
+    self._init_ar_cache_vars(batch, heads, kv_head_size)  # initialize it now
 
     key_shaped_for_cache = jnp.transpose(key, self.prefill_cache_axis_order)
     value_shaped_for_cache = jnp.transpose(value, self.prefill_cache_axis_order)
@@ -736,6 +1018,77 @@ class AttentionOp(nn.Module):
 
     return key, value, decoder_segment_ids
 
+  def kv_cache_chunked_prefill(
+      self,
+      key: Array,
+      value: Array,
+      decoder_segment_ids: Array,
+      inputs_positions: Array,
+  ):
+    """In chunked prefill mode, we append the chunk to an existing prefill cache.
+
+    The prefill cache of the earlier chunks is passed in by the caller. The chunk's
+    keys and values are written at its first position, and the whole prefill cache
+    is returned so that the chunk attends to everything processed so far. The cache
+    grows by one chunk per call, so it may outgrow max_prefill_predict_length: insert
+    moves the prompt positions past it into the ar cache.
+
+    Args:
+      key: in shape [b, c, n, d].
+      value: in shape [b, c, n, d].
+      decoder_segment_ids: [b, c] -- marking segment ids for tokens of the chunk
+      inputs_positions: [b, c] -- positions of the chunk tokens in the sequence
+
+    Returns:
+      key, value, decoder_segment_id of the whole prefill cache and the chunk start.
+    """
+    batch, _, heads, kv_head_size = key.shape
+    assert key.dtype == value.dtype, "Key and Value Dtypes should match."
+
+    cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
+        batch, heads, kv_head_size
+    )
+    self._init_ar_cache_vars(batch, heads, kv_head_size)
+
+    chunk_start = inputs_positions[0, 0]
+    prefill_key_axis_names = self.transpose_tuple(self.cache_logical_axis_names, self.prefill_cache_axis_order)
+    sequence_axis = prefill_key_axis_names.index(CACHE_SEQUENCE)
+
+    def append(cache_var, chunk, axis):
+      # The chunk starts at most at the end of the cache of the earlier chunks, grow the cache to hold it.
+      cache = cache_var.value
+      pad_width = [(0, 0)] * cache.ndim
+      pad_width[axis] = (0, chunk.shape[axis])
+      cache = jnp.pad(cache, pad_width)
+      cache_var.value = jax.lax.dynamic_update_slice_in_dim(cache, chunk.astype(cache.dtype), chunk_start, axis)
+
+    key_shaped_for_cache = jnp.transpose(key, self.prefill_cache_axis_order)
+    value_shaped_for_cache = jnp.transpose(value, self.prefill_cache_axis_order)
+    if self.kv_quant:
+      key_shaped_for_cache, key_scale_shaped_for_cache = self.kv_quant.quantize(key_shaped_for_cache, prefill_key_axis_names)
+      value_shaped_for_cache, value_scale_shaped_for_cache = self.kv_quant.quantize(
+          value_shaped_for_cache, prefill_key_axis_names
+      )
+      prefill_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.prefill_cache_axis_order)
+      scale_sequence_axis = prefill_scale_axis_names.index(CACHE_SCALE_SEQUENCE)
+      append(cached_prefill_key_vars[1], key_scale_shaped_for_cache, scale_sequence_axis)
+      append(cached_prefill_value_vars[1], value_scale_shaped_for_cache, scale_sequence_axis)
+
+    append(cached_prefill_key_vars[0], key_shaped_for_cache, sequence_axis)
+    append(cached_prefill_value_vars[0], value_shaped_for_cache, sequence_axis)
+    append(cached_prefill_segment_id_var, decoder_segment_ids, 1)
+    # Positions past this chunk are no longer part of the sequence, e.g. when a cached prompt prefix is reused.
+    chunk_end = chunk_start + decoder_segment_ids.shape[1]
+    cache_positions = jnp.arange(cached_prefill_segment_id_var.value.shape[1])[None, :]
+    cached_prefill_segment_id_var.value = jnp.where(cache_positions < chunk_end, cached_prefill_segment_id_var.value, 0)
+
+    return (
+        self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
+        self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
+        cached_prefill_segment_id_var.value,
+        chunk_start,
+    )
+
   def update_ar_key_value(
       self,
       one_token_key: Array,
@@ -781,27 +1134,11 @@ class AttentionOp(nn.Module):
     ar_cache_batch_axis = ar_cache_axis_names.index(CACHE_BATCH)
 
     if use_ragged_attention:
-      cache_locations = [slice(None)] * 4
-      new_token_locations = [slice(None)] * 4
-      new_token_locations[ar_cache_sequence_axis] = 0
-
-      def key_body(i, val):
-        cache_locations[ar_cache_batch_axis] = i
-        cache_locations[ar_cache_sequence_axis] = lengths[i]
-        new_token_locations[ar_cache_batch_axis] = i
-        return val.at[tuple(cache_locations)].set(one_token_key_shaped_for_cache[tuple(new_token_locations)])
-
-      def value_body(i, val):
-        cache_locations[ar_cache_batch_axis] = i
-        cache_locations[ar_cache_sequence_axis] = lengths[i]
-        new_token_locations[ar_cache_batch_axis] = i
-        return val.at[tuple(cache_locations)].set(one_token_value_shaped_for_cache[tuple(new_token_locations)])
-
-      cached_key_var.value = jax.lax.fori_loop(
-          0, one_token_key_shaped_for_cache.shape[0], key_body, cached_key_var.value, unroll=8
+      cached_key_var.value = ragged_cache_update(
+          cached_key_var.value, one_token_key_shaped_for_cache, lengths, ar_cache_batch_axis, ar_cache_sequence_axis
       )
-      cached_value_var.value = jax.lax.fori_loop(
-          0, one_token_value_shaped_for_cache.shape[0], value_body, cached_value_var.value, unroll=8
+      cached_value_var.value = ragged_cache_update(
+          cached_value_var.value, one_token_value_shaped_for_cache, lengths, ar_cache_batch_axis, ar_cache_sequence_axis
       )
 
     else:
@@ -819,18 +1156,79 @@ class AttentionOp(nn.Module):
     if self.kv_quant:
       ar_cache_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
       ar_cache_scale_update_axis = ar_cache_scale_axis_names.index(CACHE_SCALE_SEQUENCE)
-      cached_key_scale_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_key_scale_var.value, one_token_key_scale_shaped_for_cache, ar_cache_update_idx, ar_cache_scale_update_axis
-      )
-      cached_value_scale_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_value_scale_var.value,
-          one_token_value_scale_shaped_for_cache,
-          ar_cache_update_idx,
-          ar_cache_scale_update_axis,
-      )
+      if use_ragged_attention:
+        # The scales of a slot are at the same positions as its tokens, which the ragged kernels read together.
+        ar_cache_scale_batch_axis = ar_cache_scale_axis_names.index(CACHE_SCALE_BATCH)
+        cached_key_scale_var.value = ragged_cache_update(
+            cached_key_scale_var.value,
+            one_token_key_scale_shaped_for_cache,
+            lengths,
+            ar_cache_scale_batch_axis,
+            ar_cache_scale_update_axis,
+        )
+        cached_value_scale_var.value = ragged_cache_update(
+            cached_value_scale_var.value,
+            one_token_value_scale_shaped_for_cache,
+            lengths,
+            ar_cache_scale_batch_axis,
+            ar_cache_scale_update_axis,
+        )
+      else:
+        cached_key_scale_var.value = jax.lax.dynamic_update_index_in_dim(
+            cached_key_scale_var.value, one_token_key_scale_shaped_for_cache, ar_cache_update_idx, ar_cache_scale_update_axis
+        )
+        cached_value_scale_var.value = jax.lax.dynamic_update_index_in_dim(
+            cached_value_scale_var.value,
+            one_token_value_scale_shaped_for_cache,
+            ar_cache_update_idx,
+            ar_cache_scale_update_axis,
+        )
 
     return
 
+  def append_ar_key_value(
+      self,
+      key: Array,
+      value: Array,
+      cached_key_vars: tuple[nn.Variable, nn.Variable | None],
+      cached_value_vars: tuple[nn.Variable, nn.Variable | None],
+      positions: Array,
+  ) -> None:
+    """Adds several tokens per slot to the ar kv cache, as when verifying speculated tokens.
+
+    Args:
+        key (Array): Keys of the new tokens, in shape [b, s, n, d]
+        value (Array): Values of the new tokens, in shape [b, s, n, d]
+        cached_key_vars (tuple[nn.Variable, nn.Variable|None],): Cached keys, possibly with scale
+        cached_value_vars (tuple[nn.Variable, nn.Variable|None],): Cached values, possibly with scale
+        positions (Array): [b, s] locations of the new tokens within the cache, out of range ones are dropped
+    """
+    batch, sequence, _, _ = key.shape
+
+    def scatter(cache_var, tokens, logical_axis_names):
+      # Index every cache axis with an iota laid out along its logical axis, so that the
+      # indexed shape is the logical [b, s, n, d] whatever the cache axis order.
+      cache_axis_names = self.transpose_tuple(logical_axis_names, self.ar_cache_axis_order)
+      indices = []
+      for axis_name, dim in zip(cache_axis_names, cache_var.value.shape):
+        logical_axis = logical_axis_names.index(axis_name)
+        if logical_axis == 0:
+          index = jnp.arange(batch)
+        elif logical_axis == 1:
+          index = positions
+        else:
+          index = jnp.arange(dim)
+        indices.append(jnp.reshape(index, index.shape + (1,) * (3 - logical_axis)))
+      cache_var.value = cache_var.value.at[tuple(indices)].set(tokens.astype(cache_var.value.dtype), mode="drop")
+      cache_var.value = nn.with_logical_constraint(cache_var.value, cache_axis_names)
+
+    assert positions.shape == (batch, sequence)
+    for (cache_var, cache_scale_var), tokens in zip((cached_key_vars, cached_value_vars), (key, value)):
+      if self.kv_quant:
+        tokens, tokens_scale = self.kv_quant.quantize(tokens, self.cache_logical_axis_names)
+        scatter(cache_scale_var, tokens_scale, self.cache_scale_logical_axis_names)
+      scatter(cache_var, tokens, self.cache_logical_axis_names)
+
   def get_cached_values(self, cache_vars, target_dtype, cache_axis_order) -> jax.Array | KVTensor:
     cache_var, cache_scale_var = cache_vars
     cache_value = cache_var.value
@@ -846,6 +1244,25 @@ class AttentionOp(nn.Module):
     cache_value_in_logical_shape = jax.tree.map(lambda x: self.reverse_transepose(x, cache_axis_order), cache_value)
     return cache_value_in_logical_shape
 
+  def _get_cached_prefill_values(self, key: Array, value: Array):
+    """Returns the (key, value, segment_id, lengths) of the prefill cache during autoregression.
+
+    The lengths are the prompt lengths recorded at insert with ragged attention, None otherwise.
+    """
+    batch, _, heads, kv_head_size = key.shape
+    # The below retrieves the existing prefill cache variables, not creating new ones
+    cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
+        batch, heads, kv_head_size
+    )
+    lengths = self._get_prefill_lengths_var(batch).value if self.use_ragged_attention else None
+
+    return (
+        self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
+        self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
+        cached_prefill_segment_id_var.value,
+        lengths,
+    )
+
   def kv_cache_autoregressive(
       self,
       key: Array,
@@ -855,19 +1272,25 @@ class AttentionOp(nn.Module):
     """In autoregressive mode, we update the cache for this entry and
        then return the full cache.
 
+    Several tokens per slot, as when verifying speculated tokens, are written
+    right after the earlier tokens of every slot, at its cached_ar_lengths,
+    rather than at the shared ring index, so that the entries of rejected tokens
+    can be reused once the caller rolls the lengths back. The returned ar cache
+    then only covers the earlier tokens: the caller attends to the new tokens
+    separately, with a causal mask. With ar_cache_at_slot_lengths, single tokens,
+    as those of the draft model, are written at the slot lengths too.
+
     Args:
-      key: in shape [b, 1, n, d].
-      value: in shape [b, 1, n, d].
-      decoder_segment_ids: [b, 1] -- marking segment ids for tokens
+      key: in shape [b, s, n, d].
+      value: in shape [b, s, n, d].
+      decoder_segment_ids: [b, s] -- marking segment ids for tokens
 
     Returns:
-      tuple of (key, value, segment_id) for both prefill and ar cache,
+      tuple of (key, value, segment_id, lengths) for both prefill and ar cache,
     Raises:
-      ValueError: when key/value shape is not [batch, 1, num_heads, heads_dim].
+      ValueError: when the cache hasn't been seeded by a prefill.
     """
     batch, sequence, heads, kv_head_size = key.shape
-    if sequence != 1:
-      raise ValueError(f"Sequence length should be 1 during autoregression, got {sequence=}")
     is_initialized = self.has_variable("cache", "cache_ar_index")
     if not is_initialized:
       raise ValueError("Error, we can't do autoregression if we haven't seeded the KV Cache.")
@@ -876,6 +1299,32 @@ class AttentionOp(nn.Module):
         self._get_ar_cache_vars(batch, heads, kv_head_size)
     )
 
+    if sequence > 1 or self.config.ar_cache_at_slot_lengths:
+      if use_ragged_attention:
+        raise ValueError(f"Ragged attention only supports one token per slot during autoregression, got {sequence=}")
+      # Tokens past the end of the cache are dropped, they only attend to each other.
+      earlier_lengths = cache_ar_lengths_var.value
+      positions = earlier_lengths[:, None] + jnp.arange(sequence)[None, :]
+      self.append_ar_key_value(key, value, cached_ar_key_vars, cached_ar_value_vars, positions)
+      slot_ids = jnp.arange(batch)[:, None]
+      # Entries being overwritten must not be attended to as earlier tokens.
+      earlier_segment_ids = cached_ar_segment_id_var.value.at[slot_ids, positions].set(0, mode="drop")
+      cached_ar_segment_id_var.value = cached_ar_segment_id_var.value.at[slot_ids, positions].set(
+          common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, mode="drop"
+      )
+      cache_ar_lengths_var.value = earlier_lengths + sequence
+      if sequence > 1:
+        ar_segment_ids, ar_lengths = earlier_segment_ids, earlier_lengths
+      else:
+        # A single token attends to its own entry, as when written at the shared ring index.
+        ar_segment_ids, ar_lengths = cached_ar_segment_id_var.value, cache_ar_lengths_var.value
+      return self._get_cached_prefill_values(key, value), (
+          self.get_cached_values(cached_ar_key_vars, key.dtype, self.ar_cache_axis_order),
+          self.get_cached_values(cached_ar_value_vars, value.dtype, self.ar_cache_axis_order),
+          ar_segment_ids,
+          ar_lengths,
+      )
+
     self.update_ar_key_value(
         key,
         value,
@@ -894,16 +1343,7 @@ class AttentionOp(nn.Module):
     )
     cache_ar_lengths_var.value = cache_ar_lengths_var.value.at[:].add(1)
 
-    # The below retrieves the existing prefill cache variables, not creating new ones
-    cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
-        batch, heads, kv_head_size
-    )
-
-    cached_prefill = (
-        self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
-        self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
-        cached_prefill_segment_id_var.value,
-    )
+    cached_prefill = self._get_cached_prefill_values(key, value)
 
     cached_ar = (
         self.get_cached_values(cached_ar_key_vars, key.dtype, self.ar_cache_axis_order),
@@ -913,6 +1353,128 @@ class AttentionOp(nn.Module):
     )
     return cached_prefill, cached_ar
 
+  def kv_cache_paged_autoregressive(
+      self,
+      key: Array,
+      value: Array,
+  ):
+    """In paged autoregressive mode, we write this entry to the page pool and
+       then return the prefill cache and the paged cache.
+
+    A slot gets a new page from the pool whenever its length crosses a page
+    boundary. Pages are returned to the pool when the slot is released or a new
+    request is inserted into it. Only active slots write and grow. A slot that
+    needs a page when the pool has none left is deactivated without writing or
+    growing, and MaxEngine.generate marks its tokens invalid from then on, so
+    the pool should be sized for the expected number of live tokens.
+
+    Args:
+      key: in shape [b, 1, n, d].
+      value: in shape [b, 1, n, d].
+
+    Returns:
+      tuple of (key, value, segment_id, lengths) for the prefill cache and
+      (key_pages, value_pages, lengths, block_tables) for the paged cache.
+    Raises:
+      ValueError: when key/value shape is not [batch, 1, num_heads, heads_dim].
+    """
+    batch, sequence, heads, kv_head_size = key.shape
+    if sequence != 1:
+      raise ValueError(f"Sequence length should be 1 during autoregression, got {sequence=}")
+    is_initialized = self.has_variable("cache", "cached_ar_key_pages")
+    if not is_initialized:
+      raise ValueError("Error, we can't do autoregression if we haven't seeded the KV Cache.")
+
+    key_pages_var, value_pages_var, block_table_var, page_owner_var, active_var, lengths_var = (
+        self._get_paged_ar_cache_vars(batch, heads, kv_head_size)
+    )
+    page_size, pages_per_slot, num_pages = self._get_paged_ar_cache_layout(batch)
+    cache_length = self.max_target_length - self.max_prefill_predict_length
+
+    lengths = lengths_var.value
+    slot_ids = jnp.arange(batch)
+    writable = jnp.logical_and(active_var.value == 1, lengths < cache_length)
+    page_idx = jnp.minimum(lengths // page_size, pages_per_slot - 1)
+
+    # Hand out the lowest numbered free pages to the slots starting a new page.
+    needs_page = jnp.logical_and(writable, lengths % page_size == 0)
+    free_pages = jnp.nonzero(page_owner_var.value == 0, size=batch, fill_value=num_pages)[0]
+    new_pages = jnp.where(needs_page, free_pages[jnp.cumsum(needs_page) - 1], num_pages)
+    # Slots left without a page once the pool is exhausted can't cache their token.
+    out_of_pages = jnp.logical_and(needs_page, new_pages == num_pages)
+    writable = jnp.logical_and(writable, jnp.logical_not(out_of_pages))
+    active_var.value = jnp.where(out_of_pages, 0, active_var.value)
+    block_table = block_table_var.value
+    block_table = block_table.at[slot_ids, page_idx].set(
+        jnp.where(new_pages < num_pages, new_pages, block_table[slot_ids, page_idx])
+    )
+    block_table_var.value = block_table
+    page_owner_var.value = page_owner_var.value.at[new_pages].set(slot_ids + 1, mode="drop")
+
+    # Out of range pages, for inactive slots, are dropped.
+    write_pages = jnp.where(writable, block_table[slot_ids, page_idx], num_pages)
+    offsets = lengths % page_size
+    key_pages_var.value = key_pages_var.value.at[:, write_pages, offsets, :].set(
+        jnp.swapaxes(key[:, 0], 0, 1).astype(key_pages_var.value.dtype), mode="drop"
+    )
+    value_pages_var.value = value_pages_var.value.at[:, write_pages, offsets, :].set(
+        jnp.swapaxes(value[:, 0], 0, 1).astype(value_pages_var.value.dtype), mode="drop"
+    )
+    key_pages_var.value = nn.with_logical_constraint(key_pages_var.value, self.paged_cache_logical_axis_names)
+    value_pages_var.value = nn.with_logical_constraint(value_pages_var.value, self.paged_cache_logical_axis_names)
+    lengths_var.value = lengths + writable.astype(jnp.int32)
+
+    cached_prefill = self._get_cached_prefill_values(key, value)
+
+    cached_ar = (
+        key_pages_var.value.astype(key.dtype),
+        value_pages_var.value.astype(value.dtype),
+        lengths_var.value,
+        block_table_var.value,
+    )
+    return cached_prefill, cached_ar
+
+  def kv_cache_ring_autoregressive(
+      self,
+      key: Array,
+      value: Array,
+  ):
+    """In autoregressive mode with a ring cache, we write this entry over the oldest one of every slot and
+       then return the ring.
+
+    Args:
+      key: in shape [b, 1, n, d].
+      value: in shape [b, 1, n, d].
+
+    Returns:
+      tuple of (key, value, segment_id) for the ring cache, which holds the
+      whole attention window of the new token.
+    Raises:
+      ValueError: when key/value shape is not [batch, 1, num_heads, heads_dim].
+    """
+    batch, sequence, heads, kv_head_size = key.shape
+    if sequence != 1:
+      raise ValueError(f"Sequence length should be 1 during autoregression with a ring cache, got {sequence=}")
+    is_initialized = self.has_variable("cache", "cached_ring_key")
+    if not is_initialized:
+      raise ValueError("Error, we can't do autoregression if we haven't seeded the KV Cache.")
+
+    cached_key_vars, cached_value_vars, cached_segment_id_var, cached_index_var = self._get_ring_cache_vars(
+        batch, heads, kv_head_size
+    )
+    ring_index = cached_index_var.value
+    self.append_ar_key_value(key, value, cached_key_vars, cached_value_vars, ring_index[:, None])
+    cached_segment_id_var.value = cached_segment_id_var.value.at[jnp.arange(batch), ring_index].set(
+        common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
+    )
+    cached_index_var.value = jnp.mod(ring_index + 1, self.sliding_window_size)
+
+    return (
+        self.get_cached_values(cached_key_vars, key.dtype, self.ar_cache_axis_order),
+        self.get_cached_values(cached_value_vars, value.dtype, self.ar_cache_axis_order),
+        cached_segment_id_var.value,
+    )
+
   def kv_cache(
       self, key: Array, value: Array, decoder_segment_ids: Array, model_mode: str, use_ragged_attention: bool = False
   ) -> tuple:
@@ -941,6 +1503,11 @@ class AttentionOp(nn.Module):
     elif model_mode == common_types.MODEL_MODE_PREFILL:
       return self.kv_cache_prefill(key, value, decoder_segment_ids), None
     elif model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE:
+      if self._uses_ring_cache():
+        # The ring holds the prompt tail too, there is no prefill cache to attend to.
+        return None, self.kv_cache_ring_autoregressive(key, value)
+      if self.config.use_paged_attention:
+        return self.kv_cache_paged_autoregressive(key, value)
       return self.kv_cache_autoregressive(key, value, use_ragged_attention)
     else:
       raise ValueError(f"Model Mode isn't supported! {model_mode=}")
@@ -969,17 +1536,38 @@ class AttentionOp(nn.Module):
     return attn_out
 
   @nn.compact
-  def __call__(self, query, key, value, decoder_segment_ids, model_mode):
+  def __call__(self, query, key, value, decoder_segment_ids, model_mode, inputs_positions=None):
+    if model_mode == common_types.MODEL_MODE_PREFILL and self.has_variable("cache", "cached_prefill_key"):
+      # A prefill cache was passed in, so this is a later chunk of a chunked prefill.
+      cached_key, cached_value, cached_segment_ids, chunk_start = self.kv_cache_chunked_prefill(
+          key, value, decoder_segment_ids, inputs_positions
+      )
+      unnormalized_output, _, exponentials_sum = self.apply_attention_dot(
+          query,
+          cached_key,
+          cached_value,
+          decoder_segment_ids,
+          model_mode,
+          kv_decoder_segment_ids=cached_segment_ids,
+          q_offset=chunk_start,
+      )
+      return unnormalized_output / exponentials_sum
+
     prefill_kv_cache, ar_kv_cache = self.kv_cache(
         key, value, decoder_segment_ids, model_mode, use_ragged_attention=self.use_ragged_attention
     )
+    if prefill_kv_cache is None:
+      # A ring cache, alone holding the whole attention window.
+      prefill_kv_cache, ar_kv_cache = ar_kv_cache, None
+    # During autoregression, ragged attention only reads the prompt of every slot rather than the whole prefill cache.
+    prefill_lengths = prefill_kv_cache[3] if ar_kv_cache is not None else None
 
     prefill_unnormalized_output, prefill_exponentials_max, prefill_exponentials_sum = self.apply_attention(
         query=query,
         key=prefill_kv_cache[0],
         value=prefill_kv_cache[1],
         decoder_segment_ids=prefill_kv_cache[2],
-        lengths=None,
+        lengths=prefill_lengths,
         model_mode=model_mode,
         use_ragged_attention=self.use_ragged_attention,
     )
@@ -990,20 +1578,31 @@ class AttentionOp(nn.Module):
         return prefill_unnormalized_output / prefill_exponentials_sum
       return prefill_unnormalized_output
 
-    ar_unnormalized_output, ar_exponentials_max, ar_exponentials_sum = self.apply_attention(
-        query=query,
-        key=ar_kv_cache[0],
-        value=ar_kv_cache[1],
-        decoder_segment_ids=ar_kv_cache[2],
-        lengths=ar_kv_cache[3],
-        model_mode=model_mode,
-        use_ragged_attention=self.use_ragged_attention,
-    )
+    if self.config.use_paged_attention:
+      ar_unnormalized_output, ar_exponentials_max, ar_exponentials_sum = self.paged_attention(query, *ar_kv_cache)
+    else:
+      ar_unnormalized_output, ar_exponentials_max, ar_exponentials_sum = self.apply_attention(
+          query=query,
+          key=ar_kv_cache[0],
+          value=ar_kv_cache[1],
+          decoder_segment_ids=ar_kv_cache[2],
+          lengths=ar_kv_cache[3],
+          model_mode=model_mode,
+          use_ragged_attention=self.use_ragged_attention,
+      )
 
     if ar_unnormalized_output is not None:
       unnormalized_outputs = [prefill_unnormalized_output, ar_unnormalized_output]
       exponentials_maxes = [prefill_exponentials_max, ar_exponentials_max]
       exponentials_sums = [prefill_exponentials_sum, ar_exponentials_sum]
+      if query.shape[1] > 1:
+        # Several new tokens per slot, e.g. speculated ones: they attend to each other causally.
+        new_unnormalized_output, new_exponentials_max, new_exponentials_sum = self.apply_attention_dot(
+            query, key, value, None, common_types.MODEL_MODE_PREFILL
+        )
+        unnormalized_outputs.append(new_unnormalized_output)
+        exponentials_maxes.append(new_exponentials_max)
+        exponentials_sums.append(new_exponentials_sum)
       return self.normalize_attention(unnormalized_outputs, exponentials_maxes, exponentials_sums)
     else:
       return prefill_unnormalized_output / prefill_exponentials_sum
@@ -1256,7 +1855,7 @@ class Attention(nn.Module):
         ragged_block_size=self.ragged_block_size,
     )
 
-    out = attention_op(query, key, value, decoder_segment_ids, model_mode)
+    out = attention_op(query, key, value, decoder_segment_ids, model_mode, inputs_positions=inputs_positions)
 
     out = nn.with_logical_constraint(out, self.out_axis_names)
 
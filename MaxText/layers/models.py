@@ -259,6 +259,7 @@ class Decoder(nn.Module):
       decoder_segment_ids=None,
       deterministic=False,
       model_mode=common_types.MODEL_MODE_TRAIN,
+      logits_positions=None,
   ):
     cfg = self.config
     mesh = self.mesh
@@ -397,6 +398,10 @@ class Decoder(nn.Module):
         epsilon=cfg.normalization_layer_epsilon,
         kernel_axes=("norm",),
     )(y)
+    if logits_positions is not None:
+      # Only project the positions whose logits are needed, e.g. the last prompt token during prefill.
+      # [batch, length, emb_dim] -> [batch, num_positions, emb_dim]
+      y = jnp.take_along_axis(y, logits_positions[:, :, None], axis=1)
     y = nn.Dropout(rate=cfg.dropout_rate, broadcast_dims=(-2,))(y, deterministic=deterministic)
 
     # [batch, length, emb_dim] -> [batch, length, vocab_size]
@@ -461,8 +466,13 @@ class Transformer(nn.Module):
       decoder_segment_ids=None,
       enable_dropout=True,
       model_mode=common_types.MODEL_MODE_TRAIN,
+      logits_positions=None,
   ):
-    """Applies Transformer decoder-branch on encoded-input and target."""
+    """Applies Transformer decoder-branch on encoded-input and target.
+
+    logits_positions, i32[batch, num_positions], restricts the returned logits
+    to these positions of every row, skipping the vocab projection of the others.
+    """
 
     if decoder_segment_ids is not None and model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE:
       raise ValueError(
@@ -476,5 +486,6 @@ class Transformer(nn.Module):
         decoder_segment_ids=decoder_segment_ids,
         deterministic=not enable_dropout,
         model_mode=model_mode,
+        logits_positions=logits_positions,
     )
     return logits
@@ -15,7 +15,8 @@
 """Implementation of Engine API for MaxText"""
 import copy as cp
 import functools
-from typing import Any, Optional, Tuple, Callable
+import os
+from typing import Any, Optional, Sequence, Tuple, Callable
 
 import flax
 from flax import linen as nn
@@ -36,6 +37,7 @@ from jetstream.engine import token_utils
 
 import max_utils
 import inference_utils
+import prefix_cache
 import pyconfig
 import jaxlib
 
@@ -45,6 +47,7 @@ warnings.simplefilter("ignore", category=FutureWarning)
 
 Prefix = Any
 Params = Any
+OffloadedSlot = Any
 
 
 @struct.dataclass
@@ -87,11 +90,16 @@ class MaxEngine(engine_api.Engine):
   JetStream efficient serving infrastructure.
   """
 
-  def __init__(self, config):
+  def __init__(self, config, devices: Optional[Sequence[jax.Device]] = None):
+    """Creates the engine on the given devices, all of them by default.
+
+    Engines on disjoint devices, e.g. from `split_devices`, can run prefill and
+    generate side by side, with prefixes moved between them by `transfer`.
+    """
     self.config = config
 
     # Mesh definition
-    devices_array = max_utils.create_device_mesh(config)
+    devices_array = max_utils.create_device_mesh(config, devices)
     self._mesh = jax.sharding.Mesh(devices_array, config.mesh_axes)
 
     # Model and Optimizer definition
@@ -102,9 +110,19 @@ class MaxEngine(engine_api.Engine):
     self.abstract_params = None
     self.kv_cache_annotations = None
     self.kv_cache_annotations_named = None
+    # Paths of the attention modules decoding from a ring cache, set by init_decode_state.
+    self.ring_cache_modules = set()
     self.kv_cache_shardings = None
     self.state_mesh_annotations = None
 
+    self.prefix_cache = None
+    if config.prefix_cache_max_bytes > 0:
+      self.prefix_cache = prefix_cache.PrefixCache(config.prefix_cache_block_size, config.prefix_cache_max_bytes)
+
+    self.draft_engine = None
+    if config.speculative_num_tokens > 0:
+      self.draft_engine = MaxEngine(create_draft_config(config), devices)
+
   def load_params(self, *args, rng: Optional[jax.random.PRNGKey] = None, **kwargs) -> Params:
     """Load Parameters, typically from GCS"""
     # pylint: disable=unused-argument
@@ -134,9 +152,20 @@ class MaxEngine(engine_api.Engine):
       params = self.quantize_params(state, rng3)
     else:
       params = state.params
+    if self.draft_engine is not None:
+      # The draft model params travel with the target ones, see `_split_draft_params`.
+      params = params | {"draft": self.draft_engine.load_params(rng=rng)}
     max_utils.print_mem_stats("After load_params")
     return params
 
+  def _split_draft_params(self, params: Params) -> Tuple[Params, Optional[Params]]:
+    """Separates the draft model params bundled by `load_params` from the target model params."""
+    if self.draft_engine is None:
+      return params, None
+    params = dict(params)
+    draft_params = params.pop("draft")
+    return params, draft_params
+
   def quantize_params(self, state, rng: Optional[jax.random.PRNGKey] = None):
     """Forward pass to quantize decode params."""
     if rng is None:
@@ -169,94 +198,540 @@ class MaxEngine(engine_api.Engine):
     self.model.quant.quant_mode = quantizations.get_quant_mode("serve")
     return params
 
+  def _prefill_apply(
+      self,
+      params: Params,
+      input_tokens: jax.Array,
+      positions: jax.Array,
+      decoder_segment_ids: jax.Array,
+      rng: jax.random.PRNGKey,
+      logits_positions: jax.Array,
+  ) -> Tuple[jax.Array, Any]:
+    """Runs the prefill forward pass, returning the logits at logits_positions and the new cache."""
+    with self._mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
+      logits, new_vars = self.model.apply(
+          params,
+          input_tokens,
+          positions,
+          decoder_segment_ids=decoder_segment_ids,
+          enable_dropout=False,
+          model_mode=common_types.MODEL_MODE_PREFILL,
+          logits_positions=logits_positions,
+          rngs={"params": rng},
+          mutable=["cache"],
+      )
+    return logits, new_vars["cache"]
+
+  def _make_prefix(
+      self,
+      selected_logits: jax.Array,
+      cache: Any,
+      true_lengths: jax.Array,
+      rng: jax.random.PRNGKey,
+      sampling_params: Optional[dict] = None,
+      stop_criteria: Optional[dict] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Samples the first token of every prefix row and assembles the prefix.
+
+    Args:
+      selected_logits: Logits of the last prompt token of every row, [batch, 1, vocab].
+      cache: The prefill cache, holding one row per prompt.
+      true_lengths: The real length of each prompt, pre-pad, of shape [batch].
+      rng: Key used for first token sampling.
+      sampling_params: Per slot sampling parameters of the rows, scalars or of
+        shape [batch], see `inference_utils.make_sampling_params`.
+      stop_criteria: Per slot stop criteria of the rows, unbatched or with a
+        leading [batch] dimension, see `inference_utils.make_stop_criteria`.
+    """
+    batch_size = selected_logits.shape[0]
+    next_pos = jnp.expand_dims(true_lengths, 1).astype(jnp.int32)
+    generated_tokens = jnp.zeros((batch_size, 1), dtype=jnp.int32)
+    selected_logits = jax.lax.with_sharding_constraint(selected_logits, self.replicated_sharding)
+    sampling_params = self._batch_sampling_params(sampling_params, batch_size)
+
+    # sampling first token
+    first_generated_token = self._sample(selected_logits, rng, sampling_params)
+
+    all_valid = jnp.ones(first_generated_token.shape, dtype=jnp.int8)
+    stop = self._init_stop_state(stop_criteria, batch_size)
+    if stop is not None:
+      # Prompt tokens past the prefill cache take up ar cache entries, which are left for fewer generated tokens.
+      max_length = self.config.max_target_length - jnp.maximum(true_lengths, self.config.max_prefill_predict_length)
+      stop["max_new_tokens"] = jnp.where(
+          stop["max_new_tokens"] > 0, jnp.minimum(stop["max_new_tokens"], max_length), max_length
+      ).astype(stop["max_new_tokens"].dtype)
+      # The first token is generated token number 1.
+      stop, all_valid = self._apply_stop_criteria(stop, generated_tokens - 1, first_generated_token, all_valid)
+    result = self._result_tokens(first_generated_token, all_valid, generated_tokens, stop)
+
+    prefix = {
+        "cache": cache,
+        "next_pos": next_pos,
+        "generated_tokens": generated_tokens,
+        "tokens": first_generated_token,
+    }
+    if sampling_params is not None:
+      prefix["sampling"] = sampling_params
+    if stop is not None:
+      prefix["stop"] = stop
+    if self.config.logprobs_top_k > 0:
+      prefix["logprobs"] = self._top_logprobs(selected_logits)
+    return prefix, result
+
+  def _prefill_impl(
+      self,
+      params: Params,
+      input_tokens: jax.Array,
+      true_lengths: jax.Array,
+      rng: jax.random.PRNGKey,
+      start_positions: Optional[jax.Array] = None,
+      sampling_params: Optional[dict] = None,
+      stop_criteria: Optional[dict] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Runs one prefill forward pass over a [batch, sequence] block of padded prompts.
+
+    Args:
+      params: Model parameters, holding the cache of earlier chunks when
+        start_positions is set.
+      input_tokens: Padded prompts of shape [batch, sequence].
+      true_lengths: The real length of each prompt, pre-pad, of shape [batch].
+      rng: Key used for the model apply and first token sampling.
+      start_positions: Sequence position of the first input token of each row,
+        of shape [batch]. Only set when continuing a chunked prefill.
+      sampling_params: Per slot sampling parameters of the rows, see `_make_prefix`.
+      stop_criteria: Per slot stop criteria of the rows, see `_make_prefix`.
+    Returns:
+      A prefix whose leaves carry a leading (or `cache_batch`) dimension of size
+      batch, and the first sampled token of every prompt.
+    """
+    batch_size, sequence_length = input_tokens.shape
+    positions = jnp.broadcast_to(jnp.arange(0, sequence_length), (batch_size, sequence_length))
+    if start_positions is not None:
+      positions = positions + start_positions[:, None]
+
+    zero_to_n = jnp.arange(0, sequence_length)
+    ones_to_keep = zero_to_n[None, :] < true_lengths[:, None]
+    sequence_indicator = ones_to_keep * common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
+
+    params, draft_params = self._split_draft_params(params)
+    rng, new_rng = jax.random.split(rng)
+    # Only the logits of the last prompt token of every row are computed.
+    last_positions = (true_lengths - 1)[:, None]
+    selected_logits, cache = self._prefill_apply(
+        params, input_tokens, positions, sequence_indicator, new_rng, last_positions
+    )
+    if start_positions is not None:
+      true_lengths = start_positions + true_lengths
+    prefix, result = self._make_prefix(selected_logits, cache, true_lengths, rng, sampling_params, stop_criteria)
+    if draft_params is not None:
+      _, prefix["draft_cache"] = self.draft_engine._prefill_apply(  # pylint: disable=protected-access
+          draft_params, input_tokens, positions, sequence_indicator, new_rng, last_positions
+      )
+    return prefix, result
+
   @functools.partial(jax.jit, static_argnums=(0,))
   def prefill(
       self,
       *,
       params: Params,
-      existing_prefix: Optional[jax.Array] = None,
+      existing_prefix: Optional[Prefix] = None,
       padded_tokens: jax.Array,
       true_length: int,
       sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
       rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict] = None,
+      stop_criteria: Optional[dict] = None,
   ) -> Tuple[Prefix, engine_api.ResultTokens]:
     """Computes a kv-cache for a new generate request.
 
     Args:
       params: Scalar multiplier.
       existing_prefix: If provided, represents a prefix that has already been
-        processed by the underlying model.
+        processed by the underlying model, e.g. the earlier chunks of a chunked
+        prefill. Every earlier chunk must have been full, i.e. unpadded.
       padded_tokens: Logically appended tokens to any existing prefix, this is
         what we compute prefill on.
       true_length: The real length of the tokens, pre-pad.
+      sampling_params: With per_slot_sampling, the sampling parameters of the
+        request, from `inference_utils.make_sampling_params`. Defaults to the
+        decode_sampling_* config.
+      stop_criteria: With per_slot_stop_criteria, the stop criteria of the
+        request, from `inference_utils.make_stop_criteria`. Defaults to the
+        stop_token_ids config and the longest generation.
     Returns:
       kv_cache: For the resulting text.
     """
-    if existing_prefix:
-      raise ValueError("We don't know what to do with existing_prefix")
-
     if rng is None:
       rng = jax.random.PRNGKey(0)
 
     input_tokens = jnp.expand_dims(padded_tokens, 0)  # [BATCH, SEQUENCE]
-    positions = jnp.expand_dims(jnp.arange(0, input_tokens.shape[1]), 0)
+    true_lengths = jnp.full((1,), true_length, dtype=jnp.int32)
+    if existing_prefix is None:
+      return self._prefill_impl(
+          params, input_tokens, true_lengths, rng, sampling_params=sampling_params, stop_criteria=stop_criteria
+      )
+
+    # The chunk attends to, and is appended to, the prefill cache of the earlier chunks.
+    start_positions = existing_prefix["next_pos"][:, 0]
+    params = params | {"cache": existing_prefix["cache"]}
+    if self.draft_engine is not None:
+      params["draft"] = params["draft"] | {"cache": existing_prefix["draft_cache"]}
+    return self._prefill_impl(params, input_tokens, true_lengths, rng, start_positions, sampling_params, stop_criteria)
+
+  def prefill_with_prefix_cache(
+      self,
+      *,
+      params: Params,
+      padded_tokens: jax.Array,
+      true_length: int,
+      sampler: Optional[Callable[[Any], Any]] = None,
+      rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict] = None,
+      stop_criteria: Optional[dict] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Like `prefill`, but only computes the part of the prompt missing from the prefix cache.
+
+    The longest cached prefix of the prompt is extended with the remaining
+    tokens, as a chunked prefill would, and the result is cached in turn. Falls
+    back to `prefill` when the prefix cache is disabled.
+    """
+    if self.prefix_cache is None:
+      return self.prefill(
+          params=params,
+          padded_tokens=padded_tokens,
+          true_length=true_length,
+          sampler=sampler,
+          rng=rng,
+          sampling_params=sampling_params,
+          stop_criteria=stop_criteria,
+      )
+
+    tokens = jax.device_get(padded_tokens)[:true_length]
+    # The last prompt token is always computed, its logits give the first generated token.
+    cached_prefix, cached_length = self.prefix_cache.lookup(tokens, max_length=true_length - 1)
+    if cached_prefix is None:
+      prefix, result = self.prefill(
+          params=params,
+          padded_tokens=padded_tokens,
+          true_length=true_length,
+          sampler=sampler,
+          rng=rng,
+          sampling_params=sampling_params,
+          stop_criteria=stop_criteria,
+      )
+    else:
+      # Pad the suffix to whole blocks, which bounds the number of compiled shapes.
+      block_size = self.prefix_cache.block_size
+      suffix_length = true_length - cached_length
+      padded_suffix = jnp.pad(
+          jnp.asarray(tokens[cached_length:]), (0, -(-suffix_length // block_size) * block_size - suffix_length)
+      )
+      existing_prefix = cached_prefix | {"next_pos": jnp.full_like(cached_prefix["next_pos"], cached_length)}
+      prefix, result = self.prefill(
+          params=params,
+          existing_prefix=existing_prefix,
+          padded_tokens=padded_suffix,
+          true_length=suffix_length,
+          sampler=sampler,
+          rng=rng,
+          sampling_params=sampling_params,
+          stop_criteria=stop_criteria,
+      )
+
+    if true_length // self.prefix_cache.block_size * self.prefix_cache.block_size > cached_length:
+      # Cache a copy, the prefix itself is donated by insert.
+      self.prefix_cache.insert(tokens, jax.tree_util.tree_map(jnp.copy, prefix))
+    return prefix, result
+
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def prefill_batch(
+      self,
+      *,
+      params: Params,
+      padded_tokens: jax.Array,
+      true_lengths: jax.Array,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict] = None,
+      stop_criteria: Optional[dict] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Computes kv-caches for several new generate requests in one forward pass.
+
+    All prompts must be padded to the same prefill bucket length. The returned
+    prefix holds one row per prompt and can be inserted with `insert_batch`.
+
+    Args:
+      params: Model parameters.
+      padded_tokens: Padded prompts of shape [num_prompts, bucket_length].
+      true_lengths: The real length of each prompt, pre-pad, of shape [num_prompts].
+      sampling_params: With per_slot_sampling, the sampling parameters of the
+        requests, scalars or of shape [num_prompts].
+      stop_criteria: With per_slot_stop_criteria, the stop criteria of the
+        requests, unbatched or with a leading [num_prompts] dimension.
+    Returns:
+      kv_cache: A batched prefix for the resulting texts, and the first token of
+        every prompt as a ResultTokens with one row per prompt.
+    """
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
+
+    return self._prefill_impl(
+        params,
+        padded_tokens,
+        true_lengths.astype(jnp.int32),
+        rng,
+        sampling_params=sampling_params,
+        stop_criteria=stop_criteria,
+    )
+
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def prefill_packed(
+      self,
+      *,
+      params: Params,
+      padded_tokens: jax.Array,
+      decoder_positions: jax.Array,
+      decoder_segment_ids: jax.Array,
+      start_positions: jax.Array,
+      true_lengths: jax.Array,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict] = None,
+      stop_criteria: Optional[dict] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Computes kv-caches for several short prompts concatenated into one sequence.
+
+    Prompt i occupies padded_tokens[start_positions[i]:start_positions[i] + true_lengths[i]],
+    is marked with its own (non zero) decoder segment id so that it only attends to
+    itself, and has positions restarting from 0. The packed cache is then split so that
+    the returned prefix holds one row per prompt, ready for `insert_batch`.
 
-    zero_to_n = jnp.arange(0, padded_tokens.shape[0])
-    ones_to_keep = zero_to_n < true_length
-    one_d_output = ones_to_keep * common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
-    sequence_indicator = jnp.expand_dims(one_d_output, 0)
+    Args:
+      params: Model parameters.
+      padded_tokens: i32[sequence] concatenated prompts, padded with zeros.
+      decoder_positions: i32[sequence] position of every token within its own prompt.
+      decoder_segment_ids: i32[sequence] distinct id per prompt, 0 for padding.
+      start_positions: i32[num_prompts] offset of every prompt in the packed sequence.
+      true_lengths: i32[num_prompts] length of every prompt.
+      sampling_params: With per_slot_sampling, the sampling parameters of the
+        prompts, scalars or of shape [num_prompts].
+      stop_criteria: With per_slot_stop_criteria, the stop criteria of the
+        prompts, unbatched or with a leading [num_prompts] dimension.
+    Returns:
+      kv_cache: A batched prefix with num_prompts rows, and the first token of every
+        prompt as a ResultTokens with one row per prompt.
+    """
+    if self.draft_engine is not None:
+      raise ValueError("Packed prefill doesn't support speculative decoding, set max_prefill_pack_size to 1.")
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
 
+    start_positions = start_positions.astype(jnp.int32)
+    true_lengths = true_lengths.astype(jnp.int32)
     rng, new_rng = jax.random.split(rng)
+    last_positions = (start_positions + true_lengths - 1)[None, :]
+    logits, cache = self._prefill_apply(
+        params, padded_tokens[None, :], decoder_positions[None, :], decoder_segment_ids[None, :], new_rng, last_positions
+    )
+    selected_logits = logits[0][:, None, :]
+    cache = self._unpack_prefill_cache(cache, start_positions, true_lengths)
+    return self._make_prefix(selected_logits, cache, true_lengths, rng, sampling_params, stop_criteria)
+
+  def _unpack_prefill_cache(self, cache: Any, start_positions: jax.Array, true_lengths: jax.Array) -> Any:
+    """Splits a batch 1 packed prefill cache into one row per packed prompt.
+
+    Every prompt is shifted to start at sequence position 0, positions past its true
+    length are zeroed and its segment ids are reset to the decoding indicator.
+    """
+
+    def unpack(path, boxed):
+      path_key = path[-1].key
+      if path_key not in [
+          "cached_prefill_key",
+          "cached_prefill_value",
+          "cached_prefill_key_scale",
+          "cached_prefill_value_scale",
+          "cache_prefill_segment_id",
+      ]:
+        return boxed  # The autoregressive cache is not copied by insert.
+      names = tuple(boxed.names)
+      value = boxed.unbox()
+      if common_types.CACHE_BATCH in names:
+        batch_idx, seq_idx = names.index(common_types.CACHE_BATCH), names.index(common_types.CACHE_SEQUENCE)
+      else:
+        batch_idx, seq_idx = names.index(common_types.CACHE_SCALE_BATCH), names.index(common_types.CACHE_SCALE_SEQUENCE)
+
+      sequence_length = value.shape[seq_idx]
+      valid = jnp.arange(sequence_length)[None, :] < true_lengths[:, None]  # [num_prompts, sequence]
+      if path_key == "cache_prefill_segment_id":
+        unpacked = valid.astype(value.dtype) * common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
+      else:
+        packed = jnp.moveaxis(value, (batch_idx, seq_idx), (0, 1))[0]  # [sequence, ...]
+        gather_idx = start_positions[:, None] + jnp.arange(sequence_length)[None, :]
+        unpacked = jnp.take(packed, gather_idx, axis=0, mode="clip")  # [num_prompts, sequence, ...]
+        valid = valid.reshape(valid.shape + (1,) * (unpacked.ndim - 2))
+        unpacked = jnp.where(valid, unpacked, jnp.zeros_like(unpacked))
+        unpacked = jnp.moveaxis(unpacked, (0, 1), (batch_idx, seq_idx))
+      return boxed.replace_boxed(unpacked)
+
+    return jax.tree_util.tree_map_with_path(
+        unpack, cache, is_leaf=lambda k: isinstance(k, flax.linen.spmd.LogicallyPartitioned)
+    )
+
+  def _generate_apply(
+      self,
+      params: Params,
+      cache: Any,
+      tokens: jax.Array,
+      positions: jax.Array,
+      rng: jax.random.PRNGKey,
+  ) -> Tuple[jax.Array, Any]:
+    """Runs the autoregressive forward pass over [batch, steps] tokens, returning the logits and the new cache."""
     with self._mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
-      flat_logits, new_vars = self.model.apply(
-          params,
-          input_tokens,
+      out_logits, new_vars = self.model.apply(
+          params | {"cache": cache},
+          tokens,
           positions,
-          decoder_segment_ids=sequence_indicator,
           enable_dropout=False,
-          model_mode=common_types.MODEL_MODE_PREFILL,
-          rngs={"params": new_rng},
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+          rngs={"params": rng},
           mutable=["cache"],
       )
 
-    next_pos = jnp.full((1, 1), true_length, dtype=jnp.int32)
-    generated_tokens = jnp.zeros((1, 1), dtype=jnp.int32)
-    selected_logits = jax.lax.dynamic_slice(
-        flat_logits, (0, true_length - 1, 0), (flat_logits.shape[0], 1, flat_logits.shape[2])
-    )
-    selected_logits = jax.lax.with_sharding_constraint(selected_logits, self.replicated_sharding)
+    out_logits = jax.lax.with_sharding_constraint(out_logits, self.replicated_sharding)
+    new_cache = jax.lax.with_sharding_constraint(new_vars["cache"], self.kv_cache_shardings)
+    return out_logits, new_cache
+
+  def _batch_sampling_params(self, sampling_params: Optional[dict], batch_size: int) -> Optional[dict]:
+    """Broadcasts per slot sampling parameters, by default from the config, to [batch_size]."""
+    if not self.config.per_slot_sampling:
+      if sampling_params is not None:
+        raise ValueError("Sampling parameters can only be set per request with per_slot_sampling")
+      return None
+    if sampling_params is None:
+      sampling_params = inference_utils.make_sampling_params(
+          self.config.decode_sampling_strategy,
+          topk=self.config.decode_sampling_top_k,
+          nucleus_topp=self.config.decode_sampling_nucleus_p,
+          temperature=self.config.decode_sampling_temperature,
+      )
+    return jax.tree_util.tree_map(lambda x: jnp.broadcast_to(x, (batch_size,)), sampling_params)
 
-    # sampling first token
-    first_generated_token = inference_utils.sampling(
-        selected_logits,
-        rng,
-        self.config.decode_sampling_strategy,
-        topk=self.config.decode_sampling_top_k,
-        nucleus_topp=self.config.decode_sampling_nucleus_p,
-        temperature=self.config.decode_sampling_temperature,
+  def _init_stop_state(self, stop_criteria: Optional[dict], batch_size: int) -> Optional[dict]:
+    """Broadcasts per slot stop criteria, by default from the config, to [batch_size, ...] and adds their state.
+
+    The state of a slot is whether it is done, and its last generated tokens,
+    which stop sequences are matched against.
+    """
+    if not self.config.per_slot_stop_criteria:
+      if stop_criteria is not None:
+        raise ValueError("Stop criteria can only be set per request with per_slot_stop_criteria")
+      return None
+    default_criteria = inference_utils.make_stop_criteria(
+        self.config.stop_token_ids,
+        max_stop_tokens=self.config.max_stop_tokens,
+        max_stop_sequences=self.config.max_stop_sequences,
+        max_stop_sequence_length=self.config.max_stop_sequence_length,
     )
+    if stop_criteria is None:
+      stop_criteria = default_criteria
+    stop = jax.tree_util.tree_map(
+        lambda x, default: jnp.broadcast_to(x, (batch_size,) + default.shape), stop_criteria, default_criteria
+    )
+    return stop | {
+        "recent_tokens": jnp.full((batch_size, self.config.max_stop_sequence_length), -1, dtype=jnp.int32),
+        "done": jnp.zeros((batch_size,), dtype=jnp.bool_),
+    }
 
-    all_valid = jnp.ones(first_generated_token.shape, dtype=jnp.int8)
-    result = engine_api.ResultTokens(
-        data=jnp.concatenate((first_generated_token, all_valid, generated_tokens), axis=1),
+  def _apply_stop_criteria(
+      self, stop: dict, generated_tokens: jax.Array, tokens: jax.Array, valid: jax.Array
+  ) -> Tuple[dict, jax.Array]:
+    """Checks the tokens of a step against the stop criteria of their slots.
+
+    A slot is done after a stop token, the last token of a stop sequence, or its
+    max_new_tokens-th token, which stay valid. Its later tokens are invalid.
+
+    Args:
+      stop: Per slot stop criteria and state, see `_init_stop_state`.
+      generated_tokens: i32[batch, 1] number of tokens generated before the
+        step, not counting the first one, which prefill generates.
+      tokens: i32[batch, n] tokens of the step.
+      valid: [batch, n] validity of the tokens, of which the leading ones are valid.
+    Returns:
+      The updated stop state and the validity of the tokens.
+    """
+    max_length = self.config.max_target_length - self.config.max_prefill_predict_length
+    max_new_tokens = jnp.where(stop["max_new_tokens"] > 0, jnp.minimum(stop["max_new_tokens"], max_length), max_length)
+    sequence_length = stop["recent_tokens"].shape[1]
+    # Stop sequences are right aligned, the leading positions of the shorter ones match any token.
+    sequence_padding = (
+        jnp.arange(sequence_length)[None, None, :] < sequence_length - stop["stop_sequence_lengths"][:, :, None]
+    )
+    done, recent_tokens = stop["done"], stop["recent_tokens"]
+    step_valid = []
+    for i in range(tokens.shape[1]):
+      token = tokens[:, i]
+      is_valid = (valid[:, i] > 0) & ~done
+      recent_tokens = jnp.where(
+          is_valid[:, None], jnp.concatenate((recent_tokens[:, 1:], token[:, None]), axis=1), recent_tokens
+      )
+      matches = jnp.all((recent_tokens[:, None, :] == stop["stop_sequences"]) | sequence_padding, axis=-1)
+      is_stop = (
+          jnp.any(token[:, None] == stop["stop_tokens"], axis=1)
+          | jnp.any(matches & (stop["stop_sequence_lengths"] > 0), axis=1)
+          | (generated_tokens[:, 0] + 2 + i >= max_new_tokens)
+      )
+      done = done | (is_valid & is_stop)
+      step_valid.append(is_valid)
+    valid = jnp.stack(step_valid, axis=1).astype(valid.dtype)
+    return stop | {"done": done, "recent_tokens": recent_tokens}, valid
+
+  def _result_tokens(
+      self, tokens: jax.Array, valid: jax.Array, lengths: jax.Array, stop: Optional[dict] = None
+  ) -> engine_api.ResultTokens:
+    """Lays out [batch, n] tokens, their validity and [batch, 1] lengths as ResultTokens.
+
+    With per_slot_stop_criteria, the done flag of every slot follows its length,
+    so that hosts can recycle slots without looking for stop tokens.
+    """
+    num_tokens = tokens.shape[1]
+    columns = [tokens, valid, lengths]
+    if stop is not None:
+      columns.append(stop["done"][:, None])
+    return engine_api.ResultTokens(
+        data=jnp.concatenate(columns, axis=1),
         # Tokens are shape [batch, speculations], so when we concatenate
         # tokens, validity and length along their index 1 dimension then they
         # occupy 0:speculations.
-        tokens_idx=(0, 1),
+        tokens_idx=(0, num_tokens),
         # Validity occupies the same amount of space, but next in line.
-        valid_idx=(1, 2),
+        valid_idx=(num_tokens, 2 * num_tokens),
         # And lengths is rank 1.
-        length_idx=(2, 3),
+        length_idx=(2 * num_tokens, 2 * num_tokens + 1),
         samples_per_slot=1,
     )
 
-    return {
-        "logits": selected_logits,
-        "cache": new_vars["cache"],
-        "next_pos": next_pos,
-        "generated_tokens": generated_tokens,
-        "tokens": first_generated_token,
-    }, result
+  def _top_logprobs(self, logits: jax.Array) -> dict:
+    """Returns the logprobs_top_k largest log probabilities of [batch, 1, vocab] logits and their tokens, [batch, k]."""
+    logprobs = jax.nn.log_softmax(logits[:, 0].astype(jnp.float32), axis=-1)
+    values, tokens = jax.lax.top_k(logprobs, self.config.logprobs_top_k)
+    return {"values": values, "tokens": tokens.astype(jnp.int32)}
+
+  def _sample(self, logits: jax.Array, rng: jax.random.PRNGKey, sampling_params: Optional[dict] = None) -> jax.Array:
+    """Samples tokens from [batch, ..., vocab] logits, with per slot parameters if given, else the config ones."""
+    if sampling_params is not None:
+      return inference_utils.sampling_per_slot(
+          logits, rng, sampling_params, num_candidates=self.config.decode_sampling_nucleus_candidates
+      )
+    return inference_utils.sampling(
+        logits,
+        rng,
+        self.config.decode_sampling_strategy,
+        topk=self.config.decode_sampling_top_k,
+        nucleus_topp=self.config.decode_sampling_nucleus_p,
+        temperature=self.config.decode_sampling_temperature,
+        nucleus_candidates=self.config.decode_sampling_nucleus_candidates,
+    )
 
   @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
   def generate(
@@ -269,78 +744,428 @@ class MaxEngine(engine_api.Engine):
     """Run one generate step"""
     if rng is None:
       rng = jax.random.PRNGKey(0)
+    return self._generate_impl(params, decode_state, rng)
+
+  @functools.partial(jax.jit, static_argnums=(0,), static_argnames=("num_steps",), donate_argnums=(2,))
+  def generate_n(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      num_steps: int,
+      eos_id: Optional[int] = None,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[jax.random.PRNGKey] = None,
+  ) -> Tuple[DecodeState, engine_api.ResultTokens]:
+    """Runs num_steps generate steps in a single call, amortizing the per step dispatch and host sync.
+
+    A slot stops producing valid tokens after eos_id, if given, or once it has
+    generated max_target_length - max_prefill_predict_length tokens, or with
+    per_slot_stop_criteria once its own criteria are met. Its later tokens are
+    computed but marked invalid.
+
+    Args:
+      params: Model parameters.
+      decode_state: The decode state to advance.
+      num_steps: Number of generate steps, static.
+      eos_id: Token ending a slot's generation.
+    Returns:
+      The advanced decode state, and a ResultTokens holding the [batch,
+      num_steps * tokens_per_step] block of generated tokens and its validity,
+      along with the number of tokens generated before the first step and, with
+      per_slot_stop_criteria, whether every slot is done after the last step.
+    """
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
+    max_length = self.config.max_target_length - self.config.max_prefill_predict_length
+
+    def step(carry, step_rng):
+      decode_state, done = carry
+      generated_tokens = decode_state["generated_tokens"]
+      decode_state, result = self._generate_impl(params, decode_state, step_rng)
+      tokens = result.data[:, result.tokens_idx[0] : result.tokens_idx[1]]
+      positions = generated_tokens + jnp.arange(tokens.shape[1])[None, :]
+      valid = (result.data[:, result.valid_idx[0] : result.valid_idx[1]] > 0) & ~done[:, None] & (positions < max_length)
+      if eos_id is not None:
+        # Tokens following an eos token of the same step are invalid too.
+        is_eos = valid & (tokens == eos_id)
+        valid = valid & (jnp.cumsum(is_eos, axis=1) - is_eos == 0)
+        done = done | jnp.any(is_eos, axis=1)
+      done = done | (generated_tokens[:, 0] + jnp.sum(valid, axis=1) >= max_length)
+      return (decode_state, done), (tokens, valid.astype(jnp.int32))
+
+    generated_tokens = decode_state["generated_tokens"]
+    done = jnp.zeros((generated_tokens.shape[0],), dtype=jnp.bool_)
+    (decode_state, _), (tokens, valid) = jax.lax.scan(step, (decode_state, done), jax.random.split(rng, num_steps))
+    # [num_steps, batch, tokens_per_step] to [batch, num_steps * tokens_per_step].
+    tokens = jnp.reshape(jnp.moveaxis(tokens, 0, 1), (tokens.shape[1], -1))
+    valid = jnp.reshape(jnp.moveaxis(valid, 0, 1), (valid.shape[1], -1))
+    return decode_state, self._result_tokens(tokens, valid, generated_tokens, decode_state.get("stop"))
+
+  def _generate_impl(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      rng: jax.random.PRNGKey,
+  ) -> Tuple[DecodeState, engine_api.ResultTokens]:
+    """Runs one generate step, see `generate`."""
+    if self.draft_engine is not None:
+      return self._generate_speculative(params, decode_state, rng)
 
     previous_token = decode_state["tokens"]
 
     rng, new_rng = jax.random.split(rng)
     # run one step generation
-    with self._mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
-      out_logits, new_vars = self.model.apply(
-          params | {"cache": decode_state["cache"]},
-          previous_token,
-          decode_state["next_pos"],
-          enable_dropout=False,
-          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
-          rngs={"params": new_rng},
-          mutable=["cache"],
-      )
-
-    out_logits = jax.lax.with_sharding_constraint(out_logits, self.replicated_sharding)
-    new_cache = jax.lax.with_sharding_constraint(new_vars["cache"], self.kv_cache_shardings)
+    out_logits, new_cache = self._generate_apply(
+        params, decode_state["cache"], previous_token, decode_state["next_pos"], new_rng
+    )
 
     # sampling tokens
-    new_token = inference_utils.sampling(
-        out_logits,
-        rng,
-        self.config.decode_sampling_strategy,
-        topk=self.config.decode_sampling_top_k,
-        nucleus_topp=self.config.decode_sampling_nucleus_p,
-        temperature=self.config.decode_sampling_temperature,
-    )
+    new_token = self._sample(out_logits, rng, decode_state.get("sampling"))
 
     all_valid = jnp.ones(new_token.shape, dtype=jnp.int8)
-    result = engine_api.ResultTokens(
-        data=jnp.concatenate((new_token, all_valid, decode_state["generated_tokens"]), axis=1),
-        # Tokens are shape [batch, speculations], so when we concatenate
-        # tokens, validity and length along their index 1 dimension then they
-        # occupy 0:speculations.
-        tokens_idx=(0, 1),
-        # Validity occupies the same amount of space, but next in line.
-        valid_idx=(1, 2),
-        # And lengths is rank 1.
-        length_idx=(2, 3),
-        samples_per_slot=1,
-    )
-
-    return {
-        "logits": out_logits,
+    if self.config.use_paged_attention:
+      # A slot the page pool ran out for is inactive and no longer caches its tokens, which are invalid.
+      has_pages = self._slot_cache_values(new_cache, self.kv_cache_annotations_named, "cached_ar_active") == 1
+      all_valid = all_valid * has_pages[:, None].astype(all_valid.dtype)
+    new_decode_state = {
         "cache": new_cache,
         "next_pos": decode_state["next_pos"] + 1,
         "generated_tokens": decode_state["generated_tokens"] + 1,
         "tokens": new_token,
-    }, result
+    }
+    if "stop" in decode_state:
+      new_decode_state["stop"], all_valid = self._apply_stop_criteria(
+          decode_state["stop"], decode_state["generated_tokens"], new_token, all_valid
+      )
+      if self.config.use_paged_attention:
+        new_decode_state["stop"]["done"] = new_decode_state["stop"]["done"] | ~has_pages
+    result = self._result_tokens(new_token, all_valid, decode_state["generated_tokens"], new_decode_state.get("stop"))
+    if self.config.logprobs_top_k > 0:
+      new_decode_state["logprobs"] = self._top_logprobs(out_logits)
+    return decode_state | new_decode_state, result
+
+  def _generate_speculative(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      rng: jax.random.PRNGKey,
+  ) -> Tuple[DecodeState, engine_api.ResultTokens]:
+    """Runs one speculative decoding step, emitting 1 to speculative_num_tokens + 1 tokens per slot.
+
+    The draft model greedily proposes speculative_num_tokens tokens, one at a
+    time, and the target model scores them all in a single forward pass. Draft
+    tokens are accepted up to the first one differing from the token sampled by
+    the target at its position, and the target token following the accepted ones
+    is emitted too. Emitted tokens are always target samples conditioned on the
+    earlier emitted tokens, so the output follows the target distribution. Both
+    models cache the tokens at the length of every slot, and the entries of
+    rejected tokens are masked out of both caches.
+    """
+    num_draft_tokens = self.config.speculative_num_tokens
+    num_steps = num_draft_tokens + 1
+    params, draft_params = self._split_draft_params(params)
+    tokens = decode_state["tokens"]
+    next_pos = decode_state["next_pos"]
+
+    # The draft model also runs on its last proposal, so that its cache covers every accepted token.
+    def draft_step(carry, _):
+      draft_cache, token, position = carry
+      draft_logits, draft_cache = self.draft_engine._generate_apply(  # pylint: disable=protected-access
+          draft_params, draft_cache, token, position, rng
+      )
+      token = jnp.argmax(draft_logits, axis=-1).astype(jnp.int32)
+      return (draft_cache, token, position + 1), token[:, 0]
 
-  @functools.partial(
-      jax.jit,
-      static_argnums=(0,),
-      donate_argnums=(
-          1,
-          2,
-      ),
+    (draft_cache, _, _), draft_tokens = jax.lax.scan(
+        draft_step, (decode_state["draft_cache"], tokens, next_pos), None, length=num_steps
+    )
+    draft_tokens = jnp.transpose(draft_tokens)[:, :num_draft_tokens]  # [batch, num_draft_tokens]
+
+    rng, new_rng = jax.random.split(rng)
+    out_logits, new_cache = self._generate_apply(
+        params,
+        decode_state["cache"],
+        jnp.concatenate((tokens, draft_tokens), axis=1),
+        next_pos + jnp.arange(num_steps)[None, :],
+        new_rng,
+    )
+    new_tokens = self._sample(out_logits, rng, decode_state.get("sampling")).astype(jnp.int32)  # [batch, num_steps]
+
+    num_accepted = jnp.sum(jnp.cumprod(draft_tokens == new_tokens[:, :num_draft_tokens], axis=1), axis=1)
+    num_emitted = num_accepted + 1
+    new_cache = self._rollback_ar_cache(new_cache, self.kv_cache_annotations_named, num_steps - num_emitted)
+    draft_cache = self._rollback_ar_cache(draft_cache, self.draft_engine.kv_cache_annotations_named, num_steps - num_emitted)
+
+    valid = (jnp.arange(num_steps)[None, :] < num_emitted[:, None]).astype(jnp.int32)
+    stop = {}
+    if "stop" in decode_state:
+      stop["stop"], valid = self._apply_stop_criteria(
+          decode_state["stop"], decode_state["generated_tokens"], new_tokens, valid
+      )
+    result = self._result_tokens(new_tokens, valid, decode_state["generated_tokens"], stop.get("stop"))
+
+    last_emitted = num_accepted[:, None]
+    new_decode_state = {
+        "cache": new_cache,
+        "draft_cache": draft_cache,
+        "next_pos": next_pos + num_emitted[:, None],
+        "generated_tokens": decode_state["generated_tokens"] + num_emitted[:, None],
+        "tokens": jnp.take_along_axis(new_tokens, last_emitted, axis=1),
+    } | stop
+    if self.config.logprobs_top_k > 0:
+      new_decode_state["logprobs"] = self._top_logprobs(jnp.take_along_axis(out_logits, last_emitted[:, :, None], axis=1))
+    return decode_state | new_decode_state, result
+
+  def _slot_cache_values(self, cache: Any, annotations: Any, key: str) -> jax.Array:
+    """Returns the [batch] values of the per slot cache leaves named key, which are identical across layers."""
+    for (path, leaf), names in zip(
+        jax.tree_util.tree_leaves_with_path(cache), jax.tree_util.tree_structure(cache).flatten_up_to(annotations)
+    ):
+      if path[-1].key == key:
+        batch_idx = names.index(common_types.CACHE_BATCH)
+        return jnp.reshape(jnp.moveaxis(leaf, batch_idx, -1), (-1, leaf.shape[batch_idx]))[0]
+    raise ValueError(f"The cache has no {key} leaves.")
+
+  def _rollback_ar_cache(self, cache: Any, annotations: Any, num_rejected: jax.Array) -> Any:
+    """Drops the newest num_rejected[slot] autoregressive cache entries of every slot.
+
+    The entries are masked out and the next tokens of the slot overwrite them.
+
+    Args:
+      cache: A decode state cache, just after several tokens per slot were appended.
+      annotations: The logical axis names of every cache leaf.
+      num_rejected: i32[batch] number of entries to drop per slot.
+    """
+
+    def along(x, names, full_names):
+      # Lays out x, whose axes are the logical axes `names`, along the same axes of a full_names leaf.
+      x = jnp.reshape(x, x.shape + (1,) * (len(full_names) - x.ndim))
+      return jnp.moveaxis(x, tuple(range(len(names))), tuple(full_names.index(name) for name in names))
+
+    # The lengths already count the entries to drop.
+    lengths = self._slot_cache_values(cache, annotations, "cached_ar_lengths")
+
+    def rollback(path, full_cache, names):
+      path_key = path[-1].key
+      if path_key == "cached_ar_lengths":
+        return full_cache - along(num_rejected, (common_types.CACHE_BATCH,), names)
+      elif path_key == "cache_ar_segment_id":
+        cache_positions = jnp.arange(full_cache.shape[names.index(common_types.CACHE_SEQUENCE)])[None, :]
+        rejected = (cache_positions >= (lengths - num_rejected)[:, None]) & (cache_positions < lengths[:, None])
+        rejected = along(rejected, (common_types.CACHE_BATCH, common_types.CACHE_SEQUENCE), names)
+        return jnp.where(rejected, 0, full_cache)
+      return full_cache
+
+    return jax.tree_util.tree_map_with_path(rollback, cache, annotations)
+
+  def _fill_slots(self, full_cache: jax.Array, slots: jax.Array, batch_idx: int, fill_value: int) -> jax.Array:
+    """Sets the entries of the given slots, a scalar or an array of slots, along batch_idx."""
+    if jnp.ndim(slots) == 0:
+      s = list(full_cache.shape)
+      s[batch_idx] = 1
+      fill = jnp.full(tuple(s), fill_value, dtype=full_cache.dtype)
+      return jax.lax.dynamic_update_index_in_dim(full_cache, fill, slots, batch_idx)
+    indices = [slice(None)] * full_cache.ndim
+    indices[batch_idx] = slots
+    return full_cache.at[tuple(indices)].set(fill_value, mode="drop")
+
+  def _free_pages(self, page_owner: jax.Array, slots: jax.Array) -> jax.Array:
+    """Returns the pages of the paged kv cache owned by the given slots to the pool."""
+    return jnp.where(jnp.isin(page_owner, jnp.atleast_1d(slots) + 1), 0, page_owner)
+
+  _RING_CACHE_KEYS = (
+      "cached_ring_key",
+      "cached_ring_value",
+      "cached_ring_key_scale",
+      "cached_ring_value_scale",
+      "cache_ring_segment_id",
+      "cached_ring_index",
   )
-  def insert(
+  _PREFILL_CACHE_KEYS = (
+      "cached_prefill_key",
+      "cached_prefill_value",
+      "cached_prefill_key_scale",
+      "cached_prefill_value_scale",
+      "cache_prefill_segment_id",
+  )
+  # Written at the shared cache_ar_index, unless decoding with ragged attention.
+  _AR_CACHE_KEYS = (
+      "cached_ar_key",
+      "cached_ar_value",
+      "cached_ar_key_scale",
+      "cached_ar_value_scale",
+      "cache_ar_segment_id",
+  )
+
+  def _cache_module_path(self, path) -> Tuple[str, ...]:
+    """The path of the attention module holding a cache leaf."""
+    return tuple(k.key for k in path[:-1])
+
+  def _cache_module(self, cache: Any, path) -> dict:
+    """The leaves of the attention module holding the cache leaf at path, by name."""
+    return functools.reduce(lambda module, key: module[key], self._cache_module_path(path), cache)
+
+  def _ring_cache_modules(self, cache: Any) -> set:
+    """The paths of the attention modules of a boxed cache decoding from a ring, see `AttentionOp._get_ring_cache_vars`."""
+    return {
+        self._cache_module_path(path)
+        for path, _ in jax.tree_util.tree_leaves_with_path(
+            cache, is_leaf=lambda k: isinstance(k, flax.linen.spmd.LogicallyPartitioned)
+        )
+        if path[-1].key == "cached_ring_key"
+    }
+
+  def _empty_ring_prefill_cache(self, cache: Any) -> Any:
+    """Empties the prefill cache of modules decoding from a ring along its sequence, decoding never reads it."""
+    ring_cache_modules = self._ring_cache_modules(cache)
+
+    def empty(path, boxed):
+      if path[-1].key not in self._PREFILL_CACHE_KEYS or self._cache_module_path(path) not in ring_cache_modules:
+        return boxed
+      names = tuple(boxed.names)
+      seq_idx = names.index(common_types.CACHE_SEQUENCE if common_types.CACHE_SEQUENCE in names else "cache_scale_sequence")
+      return boxed.replace_boxed(jax.lax.slice_in_dim(boxed.unbox(), 0, 0, axis=seq_idx))
+
+    return jax.tree_util.tree_map_with_path(
+        empty, cache, is_leaf=lambda k: isinstance(k, flax.linen.spmd.LogicallyPartitioned)
+    )
+
+  def _prefill_to_ring(
+      self, prefix_module: dict, module_annotations: dict, ring_key: str, ring_names: Tuple[str, ...], lengths: jax.Array
+  ) -> jax.Array:
+    """Lays out the prompt tail of the prefill cache rows of a module as rows of its ring cache leaf ring_key.
+
+    Args:
+      prefix_module: The prefix cache leaves of the attention module, by name.
+      module_annotations: The logical axis names of these leaves, by name.
+      ring_key: The name of the ring cache leaf to fill.
+      ring_names: The logical axis names of the ring cache leaf.
+      lengths: i32[num_prefixes] the prompt length of every prefix row.
+    Returns:
+      The ring cache leaf of the prefix rows.
+    """
+    window = self.config.sliding_window_size
+    if ring_key == "cached_ring_index":
+      return jnp.mod(lengths, window)
+    prefill_key = ring_key.replace("ring", "prefill")
+    prefill, prefill_names = prefix_module[prefill_key], module_annotations[prefill_key]
+    batch_name, seq_name = [name for name in prefill_names if name.endswith("batch") or name.endswith("sequence")]
+    batch_idx, seq_idx = prefill_names.index(batch_name), prefill_names.index(seq_name)
+
+    # Ring entry j holds the last prompt position congruent to j modulo the window, if any.
+    positions = lengths[:, None] - 1 - jnp.mod(lengths[:, None] - 1 - jnp.arange(window)[None, :], window)
+    rows = jnp.moveaxis(prefill, (batch_idx, seq_idx), (0, 1))
+    index = jnp.reshape(positions, positions.shape + (1,) * (rows.ndim - 2))
+    ring = jnp.take_along_axis(rows, jnp.maximum(index, 0), axis=1)
+    ring = jnp.where(index >= 0, ring, jnp.zeros_like(ring))
+    ring = jnp.moveaxis(ring, (0, 1), (batch_idx, seq_idx))
+    return jnp.transpose(ring, [prefill_names.index(name) for name in ring_names])
+
+  def _prefill_overflow_to_ar(
+      self,
+      prefix_module: dict,
+      module_annotations: dict,
+      ar_key: str,
+      ar_names: Tuple[str, ...],
+      overflow: jax.Array,
+      ar_index: jax.Array,
+  ) -> jax.Array:
+    """Lays out the prompt tail past max_prefill_predict_length of the prefill cache rows of a module as ar cache rows.
+
+    The tail positions take up ar cache entries as if they had been decoded.
+
+    Args:
+      prefix_module: The prefix cache leaves of the attention module, by name.
+      module_annotations: The logical axis names of these leaves, by name.
+      ar_key: The name of the ar cache leaf to fill.
+      ar_names: The logical axis names of the ar cache leaf.
+      overflow: i32[num_prefixes] the number of prompt positions of every prefix row past max_prefill_predict_length.
+      ar_index: The cache_ar_index of the module in the decode state.
+    Returns:
+      The ar cache leaf of the prefix rows.
+    """
+    prefill_length = self.config.max_prefill_predict_length
+    ar_length = self.config.max_target_length - prefill_length
+    prefill_key = ar_key.replace("_ar_", "_prefill_")
+    prefill, prefill_names = prefix_module[prefill_key], module_annotations[prefill_key]
+    batch_name, seq_name = [name for name in prefill_names if name.endswith("batch") or name.endswith("sequence")]
+    batch_idx, seq_idx = prefill_names.index(batch_name), prefill_names.index(seq_name)
+
+    # Ar entry j holds tail position positions[j]: the tail starts at entry 0 when the ar cache is written at the slot
+    # lengths, otherwise it ends right before the shared cache_ar_index.
+    entries = jnp.broadcast_to(jnp.arange(ar_length)[None, :], (overflow.shape[0], ar_length))
+    if self._ar_cache_at_slot_lengths():
+      positions = entries
+    else:
+      positions = jnp.mod(entries - jnp.squeeze(ar_index) + overflow[:, None], ar_length)
+    rows = jnp.moveaxis(prefill, (batch_idx, seq_idx), (0, 1))
+    index = jnp.reshape(positions, positions.shape + (1,) * (rows.ndim - 2))
+    ar = jnp.take_along_axis(rows, jnp.minimum(prefill_length + index, rows.shape[1] - 1), axis=1)
+    ar = jnp.where(index < jnp.reshape(overflow, (-1,) + (1,) * (index.ndim - 1)), ar, jnp.zeros_like(ar))
+    ar = jnp.moveaxis(ar, (0, 1), (batch_idx, seq_idx))
+    return jnp.transpose(ar, [prefill_names.index(name) for name in ar_names])
+
+  def _ar_cache_at_slot_lengths(self) -> bool:
+    """Whether the ar cache entries of every slot start at 0, rather than end right before the shared cache_ar_index."""
+    return self.config.use_ragged_attention or self.config.ar_cache_at_slot_lengths or self.draft_engine is not None
+
+  def _insert_impl(
       self,
       prefix: Prefix,
       decode_state: DecodeState,
-      slot: int,
+      slots: jax.Array,
   ) -> DecodeState:
-    """Insert into KV cache"""
-    unboxed_prefix = max_utils.unbox_logicallypartioned(prefix)
+    """Copies a prefix into decode state slots.
 
-    def copy(path, partial_cache, full_cache, annotations):
+    `slots` is either a scalar slot, in which case the prefix holds a single
+    request, or a [num_prefixes] array naming one slot per prefix row. Slots
+    outside of [0, max_concurrent_decodes) are dropped, which lets callers pad a
+    batch of prefixes up to a fixed compiled size.
+    """
+    unboxed_prefix = max_utils.unbox_logicallypartioned(prefix)
+    is_batched = jnp.ndim(slots) > 0
+
+    def update(full_cache, partial_cache, batch_idx):
+      if not is_batched:
+        return jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slots, batch_idx)
+      # partial_cache may be shorter than full_cache along the sequence axis.
+      indices = [slice(0, dim) for dim in partial_cache.shape]
+      indices[batch_idx] = slots
+      return full_cache.at[tuple(indices)].set(partial_cache, mode="drop")
+
+    prefill_length = self.config.max_prefill_predict_length
+    # Prompt positions past the prefill cache, which chunked prefill caches, go to the ar cache of the slot.
+    overflow = jnp.maximum(unboxed_prefix["next_pos"][:, 0] - prefill_length, 0)
+
+    def truncate(partial_cache, annotations):
+      seq_names = (common_types.CACHE_SEQUENCE, common_types.CACHE_SCALE_SEQUENCE)
+      seq_idx = annotations.index(next(name for name in seq_names if name in annotations))
+      return jax.lax.slice_in_dim(partial_cache, 0, min(partial_cache.shape[seq_idx], prefill_length), axis=seq_idx)
+
+    def copy(engine, prefix_cache, decode_cache, path, partial_cache, full_cache, annotations):
       path_key = path[-1].key
-      if path_key in ["cache_ar_index", "cached_ar_key", "cached_ar_value", "cached_ar_key_scale", "cached_ar_value_scale"]:
+      prefix_module = self._cache_module(prefix_cache, path)
+      module_annotations = self._cache_module(engine.kv_cache_annotations_named, path)
+      has_overflow = (
+          "cache_prefill_segment_id" in prefix_module
+          and prefix_module["cache_prefill_segment_id"].shape[1] > prefill_length
+          and not self.config.use_paged_attention
+      )
+      if path_key in [
+          "cache_ar_index",
+          "cached_ar_key_pages",
+          "cached_ar_value_pages",
+          "cached_ar_block_table",
+      ]:
+        return full_cache
+      if (
+          path_key in ["cached_ar_key", "cached_ar_value", "cached_ar_key_scale", "cached_ar_value_scale"]
+          and not has_overflow
+      ):
         return full_cache  # we don't even zero these out because we can mask them out.
+      if path_key == "cached_ar_page_owner":
+        # Pages held by the previous request of these slots go back to the pool.
+        return self._free_pages(full_cache, slots)
 
       batch_idx = -1
       if "cache_batch" in annotations:
@@ -351,60 +1176,347 @@ class MaxEngine(engine_api.Engine):
       if batch_idx < 0:
         raise ValueError(f"Batch index {batch_idx=} shouldn't be less than zero for {path_key}, got {annotations=}")
 
-      if path_key == "cache_ar_segment_id":
+      if self._cache_module_path(path) in engine.ring_cache_modules:
+        if path_key in self._RING_CACHE_KEYS:
+          ring_rows = self._prefill_to_ring(
+              prefix_module, module_annotations, path_key, annotations, unboxed_prefix["next_pos"][:, 0]
+          )
+          return update(full_cache, ring_rows, batch_idx)
+        return full_cache  # The emptied prefill cache, see `_empty_ring_prefill_cache`.
+
+      if path_key in self._AR_CACHE_KEYS and has_overflow:
+        ar_rows = engine._prefill_overflow_to_ar(  # pylint: disable=protected-access
+            prefix_module,
+            module_annotations,
+            path_key,
+            annotations,
+            overflow,
+            self._cache_module(decode_cache, path)["cache_ar_index"],
+        )
+        return update(full_cache, ar_rows, batch_idx)
+      elif path_key == "cache_ar_segment_id":
         ### goal: zero this out in case there is existing data
-        s = list(full_cache.shape)
-        s[batch_idx] = 1
-        zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
-        return jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
+        return self._fill_slots(full_cache, slots, batch_idx, 0)
       elif path_key == "cache_prefill_segment_id":
-        s = list(full_cache.shape)
-        s[batch_idx] = 1
-        zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
         ## zero out in case prefill cache is too small to cover
-        full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
+        full_cache = self._fill_slots(full_cache, slots, batch_idx, 0)
         ## copy prefill cachce
-        full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
+        full_cache = update(full_cache, truncate(partial_cache, annotations), batch_idx)
         return full_cache
+      elif path_key == "cached_prefill_lengths":
+        # Ragged attention reads the prefill cache of every slot up to its prompt length, see `AttentionOp.__call__`.
+        prefill_segment_ids = truncate(
+            prefix_module["cache_prefill_segment_id"], module_annotations["cache_prefill_segment_id"]
+        )
+        return update(full_cache, jnp.sum(prefill_segment_ids != 0, axis=1, dtype=full_cache.dtype), batch_idx)
       elif path_key == "cached_ar_lengths":
-        return full_cache.at[slot].set(0)
+        # The paged cache leaves the prompt tail out, see "cached_ar_active".
+        lengths = jnp.zeros_like(overflow) if self.config.use_paged_attention else overflow
+        return full_cache.at[slots].set(jnp.reshape(lengths, jnp.shape(slots)).astype(full_cache.dtype), mode="drop")
+      elif path_key == "cached_ar_active":
+        if self.config.use_paged_attention:
+          # Slots whose prompt doesn't fit in the prefill cache are stopped, as when the page pool runs out.
+          active = jnp.reshape(overflow == 0, jnp.shape(slots)).astype(full_cache.dtype)
+          return full_cache.at[slots].set(active, mode="drop")
+        return self._fill_slots(full_cache, slots, batch_idx, 1)
       elif path_key in [
           "cached_prefill_key",
           "cached_prefill_value",
           "cached_prefill_key_scale",
           "cached_prefill_value_scale",
       ]:
-        return jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
+        return update(full_cache, truncate(partial_cache, annotations), batch_idx)
       else:
         raise ValueError(f"We don't have a strategy for inserting {path_key}")
 
     inserted_cache = jax.tree_util.tree_map_with_path(
-        copy, unboxed_prefix["cache"], decode_state["cache"], self.kv_cache_annotations_named
+        functools.partial(copy, self, unboxed_prefix["cache"], decode_state["cache"]),
+        unboxed_prefix["cache"],
+        decode_state["cache"],
+        self.kv_cache_annotations_named,
     )
-    inserted_logits = jax.lax.dynamic_update_index_in_dim(decode_state["logits"], unboxed_prefix["logits"], slot, 0)
-    inserted_next_pos = jax.lax.dynamic_update_index_in_dim(decode_state["next_pos"], unboxed_prefix["next_pos"], slot, 0)
-    inserted_generated_tokens = jax.lax.dynamic_update_index_in_dim(
-        decode_state["generated_tokens"], unboxed_prefix["generated_tokens"], slot, 0
-    )
-    inserted_tokens = jax.lax.dynamic_update_index_in_dim(decode_state["tokens"], unboxed_prefix["tokens"], slot, 0)
+    inserted_cache = jax.lax.with_sharding_constraint(inserted_cache, self.kv_cache_shardings)
+    inserted_draft_cache = {}
+    if self.draft_engine is not None:
+      inserted_draft_cache["draft_cache"] = jax.lax.with_sharding_constraint(
+          jax.tree_util.tree_map_with_path(
+              functools.partial(copy, self.draft_engine, unboxed_prefix["draft_cache"], decode_state["draft_cache"]),
+              unboxed_prefix["draft_cache"],
+              decode_state["draft_cache"],
+              self.draft_engine.kv_cache_annotations_named,
+          ),
+          self.draft_engine.kv_cache_shardings,
+      )
+    inserted_next_pos = update(decode_state["next_pos"], unboxed_prefix["next_pos"], 0)
+    inserted_generated_tokens = update(decode_state["generated_tokens"], unboxed_prefix["generated_tokens"], 0)
+    inserted_tokens = update(decode_state["tokens"], unboxed_prefix["tokens"], 0)
+    inserted_sampling = {}
+    if self.config.per_slot_sampling:
+      inserted_sampling["sampling"] = jax.tree_util.tree_map(
+          lambda full, partial: update(full, partial, 0), decode_state["sampling"], unboxed_prefix["sampling"]
+      )
+    if self.config.per_slot_stop_criteria:
+      inserted_sampling["stop"] = jax.tree_util.tree_map(
+          lambda full, partial: update(full, partial, 0), decode_state["stop"], unboxed_prefix["stop"]
+      )
+    if self.config.logprobs_top_k > 0:
+      inserted_sampling["logprobs"] = jax.lax.with_sharding_constraint(
+          jax.tree_util.tree_map(
+              lambda full, partial: update(full, partial, 0), decode_state["logprobs"], unboxed_prefix["logprobs"]
+          ),
+          self.replicated_sharding,
+      )
 
-    inserted_logits = jax.lax.with_sharding_constraint(inserted_logits, self.replicated_sharding)
     inserted_generated_tokens = jax.lax.with_sharding_constraint(inserted_generated_tokens, self.replicated_sharding)
     inserted_next_pos = jax.lax.with_sharding_constraint(inserted_next_pos, self.replicated_sharding)
     inserted_tokens = jax.lax.with_sharding_constraint(inserted_tokens, self.replicated_sharding)
-    inserted_cache = jax.lax.with_sharding_constraint(inserted_cache, self.kv_cache_shardings)
+
+    return (
+        {
+            "cache": inserted_cache,
+            "next_pos": inserted_next_pos,
+            "generated_tokens": inserted_generated_tokens,
+            "tokens": inserted_tokens,
+        }
+        | inserted_draft_cache
+        | inserted_sampling
+    )
+
+  @functools.partial(
+      jax.jit,
+      static_argnums=(0,),
+      donate_argnums=(
+          1,
+          2,
+      ),
+  )
+  def insert(
+      self,
+      prefix: Prefix,
+      decode_state: DecodeState,
+      slot: int,
+  ) -> DecodeState:
+    """Insert into KV cache"""
+    return self._insert_impl(prefix, decode_state, slot)
+
+  @functools.partial(
+      jax.jit,
+      static_argnums=(0,),
+      donate_argnums=(
+          1,
+          2,
+      ),
+  )
+  def insert_batch(
+      self,
+      prefix: Prefix,
+      decode_state: DecodeState,
+      slots: jax.Array,
+  ) -> DecodeState:
+    """Insert every row of a batched prefix (see `prefill_batch`) into the KV cache.
+
+    Args:
+      prefix: A prefix with num_prefixes rows.
+      decode_state: The decode state to insert into.
+      slots: i32[num_prefixes] destination slots. Rows whose slot is out of range
+        (e.g. max_concurrent_decodes) are padding and are not inserted.
+    """
+    return self._insert_impl(prefix, decode_state, slots)
+
+  def _concat_prefixes(self, prefixes: Sequence[Prefix]) -> Prefix:
+    """Concatenates prefixes along their batch axes, zero padding the shorter ones along the other axes.
+
+    Padded prefill cache entries have segment id 0, so they are masked out like
+    the prompt padding.
+    """
+    prefixes = [max_utils.unbox_logicallypartioned(prefix) for prefix in prefixes]
+
+    def concat(*leaves_and_annotations):
+      *leaves, annotations = leaves_and_annotations
+      batch_idx = 0
+      if annotations is not None:
+        batch_names = [name for name in ("cache_batch", "cache_scale_batch") if name in annotations]
+        if not batch_names:
+          return leaves[0]  # e.g. cache_ar_index, which insert leaves untouched.
+        batch_idx = annotations.index(batch_names[0])
+      shape = [max(dims) for dims in zip(*(leaf.shape for leaf in leaves))]
+      padded = []
+      for leaf in leaves:
+        padding = [(0, 0 if axis == batch_idx else dim - leaf.shape[axis]) for axis, dim in enumerate(shape)]
+        padded.append(jnp.pad(leaf, padding))
+      return jnp.concatenate(padded, axis=batch_idx)
+
+    concatenated = {}
+    for key in prefixes[0]:
+      if key == "cache":
+        annotations = self.kv_cache_annotations_named
+      elif key == "draft_cache":
+        annotations = self.draft_engine.kv_cache_annotations_named
+      else:
+        annotations = jax.tree_util.tree_map(lambda _: None, prefixes[0][key])
+      concatenated[key] = jax.tree_util.tree_map(concat, *[prefix[key] for prefix in prefixes], annotations)
+    return concatenated
+
+  @functools.partial(
+      jax.jit,
+      static_argnums=(0,),
+      donate_argnums=(
+          1,
+          2,
+      ),
+  )
+  def bulk_insert(
+      self,
+      prefixes: Sequence[Prefix],
+      decode_state: DecodeState,
+      slots: jax.Array,
+  ) -> DecodeState:
+    """Insert several prefixes, e.g. of different prefill lengths, into the KV cache in one update.
+
+    Every cache leaf is scattered once for all prefixes, instead of once per
+    prefix with `insert`, so that admitting a burst of requests costs a single
+    dispatch and a single pass over the decode state.
+
+    Args:
+      prefixes: Prefixes holding one request each, as returned by `prefill`.
+      decode_state: The decode state to insert into.
+      slots: i32[len(prefixes)] destination slots. Prefixes whose slot is out of
+        range (e.g. max_concurrent_decodes) are padding and are not inserted.
+    """
+    return self._insert_impl(self._concat_prefixes(prefixes), decode_state, slots)
+
+  @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(1,))
+  def release_slots(
+      self,
+      decode_state: DecodeState,
+      slots: jax.Array,
+  ) -> DecodeState:
+    """Marks finished slots inactive and returns their kv cache pages to the pool.
+
+    Only needed with use_paged_attention, where a finished slot would otherwise
+    keep drawing pages until a new request is inserted into it.
+
+    Args:
+      decode_state: The decode state to release the slots of.
+      slots: i32[num_slots] slots to release. Out of range slots are ignored.
+    """
+
+    def release(path, full_cache, annotations):
+      path_key = path[-1].key
+      if path_key == "cached_ar_page_owner":
+        return self._free_pages(full_cache, slots)
+      elif path_key == "cached_ar_active":
+        return self._fill_slots(full_cache, slots, annotations.index("cache_batch"), 0)
+      return full_cache
+
+    released_cache = jax.tree_util.tree_map_with_path(release, decode_state["cache"], self.kv_cache_annotations_named)
+    return decode_state | {"cache": released_cache}
+
+  def _check_offload_supported(self):
+    if self.config.use_paged_attention:
+      raise ValueError("Offloading slots doesn't support use_paged_attention, whose pages are shared by all slots.")
+    if self.draft_engine is not None:
+      raise ValueError("Offloading slots doesn't support speculative decoding.")
+
+  def _slot_axes(self, decode_state: DecodeState) -> Any:
+    """The batch axis of every decode state leaf, or -1 for leaves shared by all slots, e.g. cache_ar_index."""
+
+    def cache_batch_axis(annotations):
+      for name in (common_types.CACHE_BATCH, common_types.CACHE_SCALE_BATCH):
+        if name in annotations:
+          return annotations.index(name)
+      return -1
 
     return {
-        "logits": inserted_logits,
-        "cache": inserted_cache,
-        "next_pos": inserted_next_pos,
-        "generated_tokens": inserted_generated_tokens,
-        "tokens": inserted_tokens,
+        key: (
+            jax.tree_util.tree_map(cache_batch_axis, self.kv_cache_annotations_named, is_leaf=lambda x: isinstance(x, tuple))
+            if key == "cache"
+            else jax.tree_util.tree_map(lambda _: 0, value)
+        )
+        for key, value in decode_state.items()
     }
 
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def _read_slot(self, decode_state: DecodeState, slot: int) -> OffloadedSlot:
+    """The rows of a slot, with batch size 1, and the leaves shared by all slots as they are."""
+
+    def read(leaf, batch_idx):
+      if batch_idx < 0:
+        return leaf
+      return jax.lax.dynamic_slice_in_dim(leaf, slot, 1, batch_idx)
+
+    return jax.tree_util.tree_map(read, decode_state, self._slot_axes(decode_state))
+
+  @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
+  def _write_slot(self, offloaded: OffloadedSlot, decode_state: DecodeState, slot: int) -> DecodeState:
+    """Writes the rows read by `_read_slot` into a slot, lining its ar cache up with the current cache_ar_index."""
+
+    def write(path, slot_leaf, full_leaf, batch_idx):
+      if batch_idx < 0:
+        return full_leaf
+      path_key = path[-1].key
+      if path[0].key == "cache" and path_key in self._AR_CACHE_KEYS and not self.config.use_ragged_attention:
+        # The ar entries of the slot end right before the cache_ar_index at offload, they must end right before the
+        # current one, so that the slot overwrites its own entries only once it would have without the offload.
+        names = self._cache_module(self.kv_cache_annotations_named, path[1:])[path_key]
+        seq_idx = names.index(
+            common_types.CACHE_SEQUENCE if common_types.CACHE_SEQUENCE in names else common_types.CACHE_SCALE_SEQUENCE
+        )
+        shift = (
+            self._cache_module(decode_state["cache"], path[1:])["cache_ar_index"]
+            - self._cache_module(offloaded["cache"], path[1:])["cache_ar_index"]
+        )
+        slot_leaf = jnp.roll(slot_leaf, jnp.squeeze(shift), axis=seq_idx)
+      return jax.lax.dynamic_update_index_in_dim(full_leaf, slot_leaf.astype(full_leaf.dtype), slot, batch_idx)
+
+    written = jax.tree_util.tree_map_with_path(write, offloaded, decode_state, self._slot_axes(decode_state))
+    written["cache"] = jax.lax.with_sharding_constraint(written["cache"], self.kv_cache_shardings)
+    return written
+
+  def _host_memory_kind(self) -> Optional[str]:
+    """Pinned host memory, as the offloading remat policies use, if the devices of the engine have some."""
+    kinds = {memory.kind for memory in self._mesh.devices.flat[0].addressable_memories()}
+    return "pinned_host" if "pinned_host" in kinds else None
+
+  def offload_slot(self, decode_state: DecodeState, slot: int) -> OffloadedSlot:
+    """Copies the prefill and ar kv cache and the generation state of a slot to host memory.
+
+    The slot can then be reused, e.g. by inserting a more urgent request, and the
+    offloaded request resumed later from any free slot with `restore_slot`,
+    without computing its prefill again. The decode state is left untouched.
+
+    Args:
+      decode_state: The decode state holding the slot.
+      slot: The slot to offload.
+    Returns:
+      The rows of the slot in pinned host memory, or as numpy arrays on devices
+      without pinned host memory.
+    """
+    self._check_offload_supported()
+    offloaded = self._read_slot(decode_state, slot)
+    memory_kind = self._host_memory_kind()
+    if memory_kind is None:
+      return jax.device_get(offloaded)
+    return jax.device_put(offloaded, jax.tree_util.tree_map(lambda x: x.sharding.with_memory_kind(memory_kind), offloaded))
+
+  def restore_slot(self, offloaded: OffloadedSlot, decode_state: DecodeState, slot: int) -> DecodeState:
+    """Resumes a request offloaded by `offload_slot` in a free slot, which may differ from its original slot.
+
+    Like `insert`, this donates decode_state and overwrites whatever the slot held.
+    """
+    self._check_offload_supported()
+    offloaded = jax.tree_util.tree_map(
+        lambda x: jax.device_put(x, x.sharding.with_memory_kind("device")) if isinstance(x, jax.Array) else x, offloaded
+    )
+    return self._write_slot(offloaded, decode_state, slot)
+
   def get_prefix_destination_sharding(self) -> Any:
     return jax.sharding.NamedSharding(mesh=self.mesh, spec=jax.sharding.PartitionSpec())
 
+  def transfer(self, prefix: Prefix) -> Prefix:
+    """Moves a prefix, e.g. computed by a prefill engine on other devices, onto the devices of this engine."""
+    return jax.device_put(prefix, self.get_prefix_destination_sharding())
+
   def get_tokenizer(self) -> tokenizer_pb2.TokenizerParameters:
     """Return a protobuf of tokenizer info, callable from Py or C++."""
     return tokenizer_pb2.TokenizerParameters(path=self.config.tokenizer_path, extra_ids=0)
@@ -430,7 +1542,7 @@ class MaxEngine(engine_api.Engine):
     # pylint: disable=unused-argument
     def init(abstract_params):
       x = jnp.ones(
-          (int(self.config.per_device_batch_size * jax.device_count()), self.config.max_prefill_predict_length),
+          (int(self.config.per_device_batch_size * self._mesh.size), self.config.max_prefill_predict_length),
           dtype=jnp.int32,
       )
       _, cache = self.model.apply(
@@ -444,16 +1556,32 @@ class MaxEngine(engine_api.Engine):
           mutable=["cache"],
       )
 
-      next_pos = jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1), dtype=jnp.int32)
-      generated_tokens = jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1), dtype=jnp.int32)
-      tokens = jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1), dtype=jnp.int32)
-      return {
-          "logits": jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1, self.config.vocab_size)),
-          "cache": cache["cache"],
+      next_pos = jnp.zeros((int(self.config.per_device_batch_size * self._mesh.size), 1), dtype=jnp.int32)
+      generated_tokens = jnp.zeros((int(self.config.per_device_batch_size * self._mesh.size), 1), dtype=jnp.int32)
+      tokens = jnp.zeros((int(self.config.per_device_batch_size * self._mesh.size), 1), dtype=jnp.int32)
+      cache = cache["cache"]
+      if self.config.ring_local_kv_cache:
+        cache = self._empty_ring_prefill_cache(cache)
+      decode_state = {
+          "cache": cache,
           "next_pos": next_pos,
           "generated_tokens": generated_tokens,
           "tokens": tokens,
       }
+      if self.config.per_slot_sampling:
+        decode_state["sampling"] = self._batch_sampling_params(
+            None, int(self.config.per_device_batch_size * self._mesh.size)
+        )
+      if self.config.per_slot_stop_criteria:
+        decode_state["stop"] = self._init_stop_state(None, int(self.config.per_device_batch_size * self._mesh.size))
+      if self.config.logprobs_top_k > 0:
+        decode_state["logprobs"] = {
+            "values": jnp.zeros((int(self.config.per_device_batch_size * self._mesh.size), self.config.logprobs_top_k)),
+            "tokens": jnp.zeros(
+                (int(self.config.per_device_batch_size * self._mesh.size), self.config.logprobs_top_k), dtype=jnp.int32
+            ),
+        }
+      return decode_state
 
     with nn_partitioning.axis_rules(self.config.logical_axis_rules):
       abstract_outputs = jax.eval_shape(init, self.abstract_params)
@@ -476,14 +1604,17 @@ class MaxEngine(engine_api.Engine):
       return isinstance(k, flax.linen.spmd.LogicallyPartitioned)
 
     self.kv_cache_annotations_named = jax.tree_util.tree_map(lambda x: tuple(x.names), cache, is_leaf=is_lp)
+    self.ring_cache_modules = self._ring_cache_modules(cache)
     del cache
     zeroed = max_utils.unbox_logicallypartioned(initialize())
+    if self.draft_engine is not None:
+      zeroed["draft_cache"] = self.draft_engine.init_decode_state(rng=rng)["cache"]
     return zeroed
 
   @property
   def max_concurrent_decodes(self) -> int:
     """Free slots."""
-    return int(self.config.per_device_batch_size * jax.device_count())
+    return int(self.config.per_device_batch_size * self._mesh.size)
 
   @property
   def max_prefill_length(self) -> int:
@@ -505,6 +1636,18 @@ class MaxEngine(engine_api.Engine):
     raise NotImplementedError
 
 
+def split_devices(config, devices: Optional[Sequence[jax.Device]] = None) -> Tuple[list, list]:
+  """Splits devices into the disaggregated_prefill_devices running prefill and the rest, running generate."""
+  devices = list(jax.devices() if devices is None else devices)
+  num_prefill_devices = config.disaggregated_prefill_devices
+  if not 0 < num_prefill_devices < len(devices):
+    raise ValueError(
+        f"disaggregated_prefill_devices must leave devices to both prefill and generate, got {num_prefill_devices=}"
+        f" with {len(devices)} devices"
+    )
+  return devices[:num_prefill_devices], devices[num_prefill_devices:]
+
+
 def set_engine_vars_from_base_engine(engine: engine_api.Engine, base_engine: engine_api.Engine, rng: jax.random.PRNGKey):
   """Set internal vars from base_engine, which has already loaded the checkpoint and has sharding,
   mesh, and kv cache related vars set.
@@ -518,6 +1661,35 @@ def set_engine_vars_from_base_engine(engine: engine_api.Engine, base_engine: eng
   )
 
 
+def create_draft_config(config) -> MaxEngineConfig:
+  """Creates the config of the draft model used for speculative decoding.
+
+  The draft model is configured by base.yml, overridden by the space separated
+  key=value pairs of `speculative_draft_args`, and shares the batch size,
+  sequence lengths, cache layout and device mesh of the target model.
+  """
+  target_keys = config.get_keys()
+  args = {k: v for k, v in target_keys.items() if k.startswith(("ici_", "dcn_"))}
+  for k in [
+      "per_device_batch_size",
+      "max_prefill_predict_length",
+      "max_target_length",
+      "prefill_cache_axis_order",
+      "ar_cache_axis_order",
+  ]:
+    args[k] = target_keys[k]
+  for draft_arg in config.speculative_draft_args.split():
+    k, v = draft_arg.split("=", 1)
+    args[k.strip()] = v.strip()
+  # The draft tokens are cached at the length of every slot, where the target's are, and rolled back with them.
+  args["ar_cache_at_slot_lengths"] = "true"
+  argv = ["MaxText/maxengine.py", os.path.join(os.path.dirname(__file__), "configs", "base.yml")]
+  argv += [f"{k}={v}" for k, v in args.items()]
+  # Unlike pyconfig.initialize, leaves the global config of the target model untouched.
+  draft_config = pyconfig._HyperParameters(argv)  # pylint: disable=protected-access
+  return MaxEngineConfig(cp.deepcopy(draft_config.keys))
+
+
 def create_engine_from_config_flags(batch_size, max_prefill_predict_length, max_target_length, args_str):
   """Create new MaxEngine instance with given batch_size, prefill and target lengths, and any config
   params provided through `args_str`.
@@ -28,6 +28,16 @@ def create_maxengine(devices: config_lib.Devices, config: Any) -> engine_api.Eng
   return maxengine.MaxEngine(config)
 
 
+def create_prefill_maxengine(devices: config_lib.Devices, config: Any) -> engine_api.Engine:
+  prefill_devices, _ = maxengine.split_devices(config, devices)
+  return maxengine.MaxEngine(config, prefill_devices)
+
+
+def create_generate_maxengine(devices: config_lib.Devices, config: Any) -> engine_api.Engine:
+  _, generate_devices = maxengine.split_devices(config, devices)
+  return maxengine.MaxEngine(config, generate_devices)
+
+
 def get_server_config(config_str: str, config: Any) -> Type[config_lib.ServerConfig]:
   """Gets the Server Config Required by JetStream"""
   match config_str:
@@ -40,6 +50,17 @@ def get_server_config(config_str: str, config: Any) -> Type[config_lib.ServerCon
           generate_engine_create_fns=(),
           interleaved_engine_create_fns=(functools.partial(create_maxengine, config=config),),
       )
+    case "MaxtextDisaggregatedServer":
+      # Prefill and generate run on disjoint devices, JetStream transferring prefixes from one to the other.
+      num_prefill_devices = config.disaggregated_prefill_devices
+      server_config = config_lib.ServerConfig(
+          prefill_slices=("tpu=" + str(num_prefill_devices),),
+          generate_slices=("tpu=" + str(jax.device_count() - num_prefill_devices),),
+          interleaved_slices=(),
+          prefill_engine_create_fns=(functools.partial(create_prefill_maxengine, config=config),),
+          generate_engine_create_fns=(functools.partial(create_generate_maxengine, config=config),),
+          interleaved_engine_create_fns=(),
+      )
     case _:
       raise NotImplementedError
   return server_config
@@ -0,0 +1,144 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of prefill results, so that requests sharing a prompt prefix only prefill the rest.
+
+Prompts are split into blocks of block_size tokens and stored in a trie keyed
+by those blocks. Every stored prompt references the prefix produced by its
+prefill, and every trie node along its full blocks points at the most recently
+stored prefix covering it. A lookup walks the trie with the blocks of a new
+prompt and returns the deepest prefix found, together with the number of tokens
+it covers. Entries are evicted least recently used first once their total size
+exceeds max_bytes.
+"""
+
+import collections
+from typing import Any, Optional, Sequence, Tuple
+
+import jax
+
+Prefix = Any
+
+
+class _Entry:
+  """A stored prefix and the trie nodes pointing at it."""
+
+  def __init__(self, prefix: Prefix, nbytes: int):
+    self.prefix = prefix
+    self.nbytes = nbytes
+    self.nodes = []
+
+
+class _TrieNode:
+  """A trie node, keyed by one block of tokens."""
+
+  def __init__(self, parent: Optional["_TrieNode"] = None, key: Optional[Tuple[int, ...]] = None):
+    self.parent = parent
+    self.key = key
+    self.children = {}
+    self.entry = None
+
+
+class PrefixCache:
+  """A block trie of prefill results with LRU eviction under a byte budget."""
+
+  def __init__(self, block_size: int, max_bytes: int):
+    if block_size <= 0:
+      raise ValueError(f"Prefix cache block size must be positive, got {block_size=}")
+    self.block_size = block_size
+    self.max_bytes = max_bytes
+    self.num_bytes = 0
+    self._root = _TrieNode()
+    self._lru = collections.OrderedDict()  # id(entry) -> entry, least recently used first.
+
+  def __len__(self) -> int:
+    return len(self._lru)
+
+  def _blocks(self, tokens: Sequence[int], num_blocks: int):
+    for i in range(num_blocks):
+      yield tuple(int(t) for t in tokens[i * self.block_size : (i + 1) * self.block_size])
+
+  def lookup(self, tokens: Sequence[int], max_length: Optional[int] = None) -> Tuple[Optional[Prefix], int]:
+    """Finds the longest cached prefix of tokens.
+
+    Args:
+      tokens: The prompt, without padding.
+      max_length: Cap on the matched length, e.g. to leave tokens for the caller to prefill.
+    Returns:
+      The cached prefix and the number of leading tokens of the prompt it covers,
+      a multiple of block_size, or (None, 0) if no block matches.
+    """
+    if max_length is None:
+      max_length = len(tokens)
+    node, best, best_length = self._root, None, 0
+    for depth, block in enumerate(self._blocks(tokens, min(len(tokens), max_length) // self.block_size), start=1):
+      node = node.children.get(block)
+      if node is None:
+        break
+      if node.entry is not None:
+        best, best_length = node.entry, depth * self.block_size
+    if best is None:
+      return None, 0
+    self._lru.move_to_end(id(best))
+    return best.prefix, best_length
+
+  def insert(self, tokens: Sequence[int], prefix: Prefix) -> None:
+    """Stores the prefill result of a prompt, for reuse by prompts sharing its full blocks.
+
+    The cache keeps a reference to prefix, so callers must not donate or modify
+    it afterwards.
+    """
+    num_blocks = len(tokens) // self.block_size
+    if num_blocks == 0:
+      return
+    nbytes = sum(leaf.nbytes for leaf in jax.tree_util.tree_leaves(prefix))
+    if nbytes > self.max_bytes:
+      return
+
+    entry = _Entry(prefix, nbytes)
+    node = self._root
+    for block in self._blocks(tokens, num_blocks):
+      if block not in node.children:
+        node.children[block] = _TrieNode(node, block)
+      node = node.children[block]
+      if node.entry is not None:
+        self._unlink(node.entry, node)
+      node.entry = entry
+      entry.nodes.append(node)
+
+    self._lru[id(entry)] = entry
+    self.num_bytes += nbytes
+    while self.num_bytes > self.max_bytes:
+      _, evicted = self._lru.popitem(last=False)
+      self._remove(evicted)
+
+  def _unlink(self, entry: _Entry, node: _TrieNode) -> None:
+    """Stops node pointing at entry, dropping entry once no node points at it."""
+    node.entry = None
+    entry.nodes.remove(node)
+    if not entry.nodes:
+      del self._lru[id(entry)]
+      self.num_bytes -= entry.nbytes
+
+  def _remove(self, entry: _Entry) -> None:
+    """Removes an evicted entry and prunes the trie nodes left without entries or children."""
+    self.num_bytes -= entry.nbytes
+    for node in entry.nodes:
+      node.entry = None
+    # The nodes of an entry form one path from the root, so pruning climbs from the deepest.
+    node = entry.nodes[-1]
+    while node.parent is not None and node.entry is None and not node.children:
+      del node.parent.children[node.key]
+      node = node.parent
+    entry.nodes = []
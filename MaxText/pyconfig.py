@@ -109,6 +109,33 @@ def validate_keys(keys):
     max_logging.log("Not using emergency checkpoint, ignoring local_checkpoint_directory and local_checkpoint_period")
   if keys["num_experts"] > 1:
     validate_megablox_parallelism(keys)
+  if keys["use_paged_attention"]:
+    assert not keys["quantize_kvcache"], "use_paged_attention doesn't support quantize_kvcache"
+    assert keys["paged_attention_page_size"] > 0, "paged_attention_page_size must be positive"
+  if keys["prefix_cache_max_bytes"] > 0:
+    assert keys["prefix_cache_block_size"] > 0, "prefix_cache_block_size must be positive"
+    assert (
+        keys["max_prefill_predict_length"] % keys["prefix_cache_block_size"] == 0
+    ), "max_prefill_predict_length must be a multiple of prefix_cache_block_size"
+  assert keys["decode_steps_per_call"] >= 1, "decode_steps_per_call must be positive"
+  assert keys["disaggregated_prefill_devices"] >= 0, "disaggregated_prefill_devices must not be negative"
+  assert 0 <= keys["logprobs_top_k"] <= keys["vocab_size"], "logprobs_top_k must be between 0 and vocab_size"
+  assert keys["decode_sampling_nucleus_candidates"] >= 0, "decode_sampling_nucleus_candidates must be non-negative"
+  if keys["ring_local_kv_cache"]:
+    assert keys["sliding_window_size"] > 0, "ring_local_kv_cache needs a positive sliding_window_size"
+    assert not keys["use_paged_attention"], "ring_local_kv_cache doesn't support use_paged_attention"
+    assert keys["speculative_num_tokens"] == 0, "ring_local_kv_cache doesn't support speculative decoding"
+  if keys["per_slot_stop_criteria"]:
+    assert keys["max_stop_sequence_length"] > 0, "max_stop_sequence_length must be positive"
+    assert len(keys["stop_token_ids"]) <= keys["max_stop_tokens"], "stop_token_ids can't exceed max_stop_tokens"
+  if keys["use_ragged_attention"] and keys["quantize_kvcache"]:
+    assert keys["kv_quant_dtype"] == "int8", "use_ragged_attention only supports int8 quantize_kvcache"
+  if keys["speculative_num_tokens"] > 0:
+    assert not keys["use_ragged_attention"], "speculative decoding doesn't support use_ragged_attention"
+    assert not keys["use_paged_attention"], "speculative decoding doesn't support use_paged_attention"
+  if keys["ar_cache_at_slot_lengths"]:
+    assert not keys["use_ragged_attention"], "ar_cache_at_slot_lengths doesn't support use_ragged_attention"
+    assert not keys["use_paged_attention"], "ar_cache_at_slot_lengths doesn't support use_paged_attention"
 
 
 def validate_data_input(keys):
@@ -0,0 +1,52 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the ahead of time compilation cache """
+
+import os
+import tempfile
+import unittest
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import aot_cache
+
+
+class AotCacheTest(unittest.TestCase):
+  """Tests for aot_cache.compile_or_load."""
+
+  @pytest.mark.tpu
+  def test_compile_then_load(self):
+    fn = jax.jit(lambda x, y: {"sum": x + y, "prod": x * y})
+    x = jnp.arange(8, dtype=jnp.float32)
+    abstract_args = aot_cache.abstractify((x, x))
+    with tempfile.TemporaryDirectory() as cache_dir:
+      compiled = aot_cache.compile_or_load(fn, abstract_args, cache_dir, "fn", {"a": 1})
+      self.assertEqual(len(os.listdir(cache_dir)), 1)
+      loaded = aot_cache.compile_or_load(fn, abstract_args, cache_dir, "fn", {"a": 1})
+      self.assertEqual(len(os.listdir(cache_dir)), 1)
+      for result in (compiled(x, x), loaded(x, x)):
+        self.assertTrue(jnp.array_equal(result["sum"], 2 * x))
+        self.assertTrue(jnp.array_equal(result["prod"], x * x))
+
+      aot_cache.compile_or_load(fn, abstract_args, cache_dir, "fn", {"a": 2})
+      self.assertEqual(len(os.listdir(cache_dir)), 2)  # A different config compiles again.
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -174,6 +174,110 @@ class AttentionTest(unittest.TestCase):
       self.assertTrue(mha_full_this_idx.shape == mha_idx.shape)
       self.assertTrue(jax.numpy.allclose(mha_full_this_idx, mha_idx, rtol=1e-02, atol=1e-02, equal_nan=False))
 
+  @pytest.mark.tpu
+  def test_chunked_prefill(self):
+    prefill_length = self.cfg.max_prefill_predict_length
+    chunk_size = prefill_length // 2
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(self.dtype)
+
+    mha_full = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    variables = dict(self._attention_as_mha_generic_variable)
+    for start in range(0, prefill_length, chunk_size):
+      lnx_chunk = lnx[:, start : start + chunk_size, :]
+      mha_chunk, output_cache = self._attention_as_mha_generic.apply(
+          variables,
+          lnx_chunk,
+          lnx_chunk,
+          decoder_segment_ids=decoder_segment_ids[:, start : start + chunk_size],
+          inputs_positions=decoder_positions[:, start : start + chunk_size],
+          deterministic=True,
+          model_mode=common_types.MODEL_MODE_PREFILL,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      variables.update(output_cache)
+
+      self.assertTrue(
+          jax.numpy.allclose(mha_chunk, mha_full[:, start : start + chunk_size, :], rtol=1e-02, atol=1e-02, equal_nan=False)
+      )
+
+    # The chunked prefill cache must seed autoregression like a single prefill does.
+    lnx_idx = lnx[:, prefill_length : prefill_length + 1, :]
+    mha_idx, _ = self._attention_as_mha_generic.apply(
+        variables,
+        lnx_idx,
+        lnx_idx,
+        inputs_positions=decoder_positions[:, prefill_length : prefill_length + 1],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+    self.assertTrue(
+        jax.numpy.allclose(
+            mha_full[:, prefill_length : prefill_length + 1, :], mha_idx, rtol=1e-02, atol=1e-02, equal_nan=False
+        )
+    )
+
+  @pytest.mark.tpu
+  def test_multi_token_autoregression(self):
+    prefill_length = self.cfg.max_prefill_predict_length
+    decode_total_length = self.cfg.max_target_length
+    num_tokens = 4
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(self.dtype)
+
+    mha_full = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    _, output_cache = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx[:, 0:prefill_length, :],
+        lnx[:, 0:prefill_length, :],
+        decoder_segment_ids=decoder_segment_ids[:, 0:prefill_length],
+        inputs_positions=decoder_positions[:, 0:prefill_length],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_PREFILL,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+
+    # Several tokens per step, as when verifying speculated tokens, attend to each other causally.
+    for idx in range(prefill_length, decode_total_length, num_tokens):
+      lnx_idx = lnx[:, idx : idx + num_tokens, :]
+      self._attention_as_mha_generic_variable.update(output_cache)
+      mha_idx, output_cache = self._attention_as_mha_generic.apply(
+          self._attention_as_mha_generic_variable,
+          lnx_idx,
+          lnx_idx,
+          inputs_positions=decoder_positions[:, idx : idx + num_tokens],
+          deterministic=True,
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+
+      mha_full_this_idx = mha_full[:, idx : idx + num_tokens, :]
+      self.assertTrue(mha_full_this_idx.shape == mha_idx.shape)
+      self.assertTrue(jax.numpy.allclose(mha_full_this_idx, mha_idx, rtol=1e-02, atol=1e-02, equal_nan=False))
+
   @pytest.mark.tpu
   def test_model_mode_prefill_dtype_float32(self):
     self._test_model_mode_prefill_dtype(jnp.float32)
@@ -721,5 +825,24 @@ class AttentionTest(unittest.TestCase):
     )
 
 
+class RaggedCacheUpdateTest(unittest.TestCase):
+  """Tests that the ragged ar cache update scatter matches the per slot loop."""
+
+  def test_matches_loop(self):
+    batch, length, heads, head_dim = 6, 16, 2, 4
+    rng_cache, rng_token, rng_lengths = jax.random.split(jax.random.PRNGKey(0), 3)
+    logical_cache = jax.random.normal(rng_cache, (batch, length, heads, head_dim))
+    logical_token = jax.random.normal(rng_token, (batch, 1, heads, head_dim))
+    # The last slot is past the end of the cache and is dropped.
+    lengths = jnp.concatenate([jax.random.randint(rng_lengths, (batch - 1,), 0, length), jnp.array([length])])
+    # Adjacent and non adjacent batch and sequence axes, the latter being the default ar_cache_axis_order.
+    for axis_order in ((0, 1, 2, 3), (1, 0, 2, 3), (1, 2, 0, 3)):
+      cache, token = jnp.transpose(logical_cache, axis_order), jnp.transpose(logical_token, axis_order)
+      batch_axis, sequence_axis = axis_order.index(0), axis_order.index(1)
+      expected = attentions.ragged_cache_update_loop(cache, token, lengths, batch_axis, sequence_axis)
+      updated = attentions.ragged_cache_update(cache, token, lengths, batch_axis, sequence_axis)
+      np.testing.assert_array_equal(updated, expected, err_msg=f"{axis_order=}")
+
+
 if __name__ == "__main__":
   unittest.main()
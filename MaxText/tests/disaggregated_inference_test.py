@@ -0,0 +1,85 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for disaggregated prefill and generate on CPU devices """
+
+import os
+import sys
+import unittest
+
+# Only takes effect if no test initialized the jax backend before.
+os.environ["XLA_FLAGS"] = os.environ.get("XLA_FLAGS", "") + " --xla_force_host_platform_device_count=4"
+
+import jax
+import jax.numpy as jnp
+
+import pyconfig
+from disaggregated_inference import DisaggregatedInference, Request
+from maxengine import MaxEngine, split_devices
+
+
+class DisaggregatedInferenceTest(unittest.TestCase):
+  """Tests that disaggregated inference generates the tokens of interleaved inference."""
+
+  def setUp(self):
+    super().setUp()
+    if jax.device_count() < 4:
+      self.skipTest("Needs 4 devices, e.g. --xla_force_host_platform_device_count=4")
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=1.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        max_target_length=16,
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_prefill_predict_length=8,
+        disaggregated_prefill_devices=2,
+    )
+    self.config = pyconfig.config
+
+  def test_matches_interleaved(self):
+    prefill_devices, generate_devices = split_devices(self.config)
+    prefill_engine = MaxEngine(self.config, prefill_devices)
+    generate_engine = MaxEngine(self.config, generate_devices)
+    self.assertEqual(generate_engine.max_concurrent_decodes, 2)
+    # The same rng initializes the same random weights on both meshes.
+    prefill_params = prefill_engine.load_params(rng=jax.random.PRNGKey(0))
+    generate_params = generate_engine.load_params(rng=jax.random.PRNGKey(0))
+
+    requests = [
+        Request(id=str(i), tokens=jnp.arange(1, 9, dtype=jnp.int32) * (i + 1) % 100, true_length=3 + i) for i in range(3)
+    ]
+    results = DisaggregatedInference(prefill_engine, generate_engine, prefill_params, generate_params).run(requests)
+
+    for request in requests:
+      prefix, first_token = generate_engine.prefill(
+          params=generate_params, padded_tokens=request.tokens, true_length=request.true_length
+      )
+      decode_state = generate_engine.insert(prefix, generate_engine.init_decode_state(), 0)
+      expected = [int(first_token.data[0, 0])]
+      while len(expected) < len(results[request.id]):
+        decode_state, result_tokens = generate_engine.generate(generate_params, decode_state)
+        expected.append(int(result_tokens.data[0, 0]))
+      self.assertEqual(len(expected), 1 + self.config.max_target_length - self.config.max_prefill_predict_length)
+      self.assertEqual(results[request.id], expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
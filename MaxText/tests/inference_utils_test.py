@@ -0,0 +1,154 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for inference_utils """
+
+import unittest
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import inference_utils
+
+
+class SamplingPerSlotTest(unittest.TestCase):
+  """Tests that sampling_per_slot samples the distributions of sampling with the same parameters."""
+
+  num_samples = 4096
+  # Raw probabilities of about .46, .28, .17, .06, .02 and .01: a nucleus of 0.8 holds the first 3 tokens, but 4 once
+  # the logits are scaled by a temperature of 2.
+  logits = jnp.array([3.0, 2.5, 2.0, 1.0, 0.0, -1.0])
+
+  def frequencies(self, tokens):
+    return jnp.bincount(tokens, length=self.logits.shape[0]) / self.num_samples
+
+  def test_matches_sampling(self):
+    logits = jnp.tile(self.logits, (self.num_samples, 1))
+    for algorithm, kwargs in (
+        ("weighted", {"temperature": 2.0}),
+        ("topk", {"topk": 3, "temperature": 2.0}),
+        ("nucleus", {"nucleus_topp": 0.8, "temperature": 2.0}),
+        ("nucleus", {"nucleus_topp": 0.8, "temperature": 0.5}),
+    ):
+      expected = inference_utils.sampling(logits, jax.random.PRNGKey(0), algorithm, **kwargs)
+      sampling_params = jax.tree_util.tree_map(
+          lambda x: jnp.broadcast_to(x, (self.num_samples,)), inference_utils.make_sampling_params(algorithm, **kwargs)
+      )
+      tokens = inference_utils.sampling_per_slot(logits, jax.random.PRNGKey(1), sampling_params)
+      expected_frequencies, frequencies = self.frequencies(expected), self.frequencies(tokens)
+      msg = f"{algorithm=} {kwargs=} {frequencies=} {expected_frequencies=}"
+      self.assertTrue(jnp.all((frequencies > 0) == (expected_frequencies > 0)), msg=msg)
+      self.assertTrue(jnp.allclose(frequencies, expected_frequencies, atol=0.04), msg=msg)
+
+  def test_greedy(self):
+    logits = jax.random.normal(jax.random.PRNGKey(0), (4, 32))
+    sampling_params = jax.tree_util.tree_map(
+        lambda x: jnp.broadcast_to(x, (4,)), inference_utils.make_sampling_params("greedy")
+    )
+    tokens = inference_utils.sampling_per_slot(logits, jax.random.PRNGKey(1), sampling_params)
+    self.assertTrue(jnp.array_equal(tokens, inference_utils.sampling(logits, jax.random.PRNGKey(1), "greedy")))
+
+
+class NucleusCandidatesTest(unittest.TestCase):
+  """Tests that sampling among candidates keeps the nucleus of sampling the whole vocabulary."""
+
+  vocab = 512
+
+  def peaked_logits(self):
+    # Row i puts almost all of its mass on tokens 3 * i and 3 * i + 1.
+    logits = jnp.zeros((4, self.vocab))
+    for i in range(4):
+      logits = logits.at[i, 3 * i].set(20.0).at[i, 3 * i + 1].set(19.0)
+    return logits
+
+  @pytest.mark.tpu
+  def test_nucleus_within_candidates(self):
+    logits = self.peaked_logits()
+    for seed in range(8):
+      tokens = inference_utils.sample_nucleus_topp_logits(logits, 0.9, 1.0, jax.random.PRNGKey(seed), num_candidates=8)
+      for i, token in enumerate(tokens.tolist()):
+        self.assertIn(token, (3 * i, 3 * i + 1))
+
+  @pytest.mark.tpu
+  def test_falls_back_to_sort(self):
+    # Uniform logits need the whole vocabulary to reach the nucleus.
+    logits = jax.random.normal(jax.random.PRNGKey(0), (4, self.vocab)) * 0.01
+    rng = jax.random.PRNGKey(1)
+    pruned = inference_utils.sample_nucleus_topp_logits(logits, 0.9, 1.0, rng, num_candidates=8)
+    exact = inference_utils.sample_nucleus_topp_logits(logits, 0.9, 1.0, rng)
+    self.assertTrue(jnp.array_equal(pruned, exact))
+
+  @pytest.mark.tpu
+  def test_per_slot_candidates(self):
+    logits = self.peaked_logits()
+    sampling_params = {
+        "topk": jnp.array([0, 2, 0, 0], dtype=jnp.int32),
+        "nucleus_topp": jnp.array([0.9, 1.0, 1.0, 0.9], dtype=jnp.float32),
+        "temperature": jnp.array([1.0, 1.0, 0.0, 1.0], dtype=jnp.float32),
+    }
+    for seed in range(8):
+      rng = jax.random.PRNGKey(seed)
+      pruned = inference_utils.sampling_per_slot(logits, rng, sampling_params, num_candidates=8)
+      exact = inference_utils.sampling_per_slot(logits, rng, sampling_params)
+      self.assertEqual(pruned[2], exact[2])  # Greedy.
+      for i, token in enumerate(pruned.tolist()):
+        self.assertIn(token, (3 * i, 3 * i + 1))
+
+    # A weighted row needs the whole vocabulary.
+    sampling_params["nucleus_topp"] = jnp.ones((4,), dtype=jnp.float32)
+    rng = jax.random.PRNGKey(0)
+    pruned = inference_utils.sampling_per_slot(logits, rng, sampling_params, num_candidates=8)
+    exact = inference_utils.sampling_per_slot(logits, rng, sampling_params)
+    self.assertTrue(jnp.array_equal(pruned, exact))
+
+    # The nucleus of a top k past the candidates is cut over the whole top k, not over the candidates alone.
+    logits = jax.random.normal(jax.random.PRNGKey(0), (4, self.vocab)) * 0.01
+    sampling_params = {
+        "topk": jnp.full((4,), 256, dtype=jnp.int32),
+        "nucleus_topp": jnp.full((4,), 0.9, dtype=jnp.float32),
+        "temperature": jnp.ones((4,), dtype=jnp.float32),
+    }
+    for seed in range(8):
+      rng = jax.random.PRNGKey(seed)
+      pruned = inference_utils.sampling_per_slot(logits, rng, sampling_params, num_candidates=8)
+      exact = inference_utils.sampling_per_slot(logits, rng, sampling_params)
+      self.assertTrue(jnp.array_equal(pruned, exact))
+
+
+class StopCriteriaTest(unittest.TestCase):
+  """Tests for make_stop_criteria."""
+
+  def test_padding(self):
+    stop = inference_utils.make_stop_criteria(
+        [7], [[1, 2], [3]], 5, max_stop_tokens=2, max_stop_sequences=3, max_stop_sequence_length=3
+    )
+    self.assertEqual(stop["stop_tokens"].tolist(), [7, -1])
+    self.assertEqual(stop["stop_sequences"].tolist(), [[-1, 1, 2], [-1, -1, 3], [-1, -1, -1]])
+    self.assertEqual(stop["stop_sequence_lengths"].tolist(), [2, 1, 0])
+    self.assertEqual(int(stop["max_new_tokens"]), 5)
+
+  def test_too_many(self):
+    with self.assertRaises(ValueError):
+      inference_utils.make_stop_criteria([1, 2, 3], max_stop_tokens=2, max_stop_sequences=1, max_stop_sequence_length=2)
+    with self.assertRaises(ValueError):
+      inference_utils.make_stop_criteria(
+          (), [[1, 2, 3]], max_stop_tokens=2, max_stop_sequences=1, max_stop_sequence_length=2
+      )
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -22,6 +22,8 @@ import unittest
 import jax
 import jax.numpy as jnp
 from kernels.ragged_attention import ragged_mqa, reference_mqa, ragged_mha, reference_mha, ragged_gqa, reference_gqa
+from kernels.ragged_attention import dequantize
+from kernels.paged_attention import paged_gqa, reference_paged_gqa
 
 
 class RaggedAttentionTest(unittest.TestCase):
@@ -104,6 +106,106 @@ class RaggedAttentionTest(unittest.TestCase):
         msg=f"Avg difference: {jnp.average(abs(ragged_out - reference_out))} > 1e-2",
     )
 
+  @pytest.mark.tpu
+  def test_ragged_gqa_quantized(self):
+    q = jax.random.normal(self.k1, (self.batch_size, 1, self.num_query_heads, self.head_dim), dtype=self.dtype)
+    shape = (self.batch_size, self.max_target_length, self.num_kv_heads, self.head_dim)
+    k = jax.random.randint(self.k2, shape, -127, 128, dtype=jnp.int8)
+    v = jax.random.randint(self.k3, shape, -127, 128, dtype=jnp.int8)
+    # A scale per token and head for the keys, per token for the values, as the two KVQuant layouts.
+    k_scale = jax.random.uniform(self.k2, shape[:3] + (1,), minval=0.001, maxval=0.01)
+    v_scale = jax.random.uniform(self.k3, shape[:2] + (1, 1), minval=0.001, maxval=0.01)
+    lengths = jnp.array(np.random.randint(1, self.max_target_length, self.batch_size), dtype=jnp.int32)
+
+    ragged_out, ragged_max, ragged_denom = ragged_gqa(q, k, v, lengths, k_scale, v_scale)
+    ragged_out = ragged_out / ragged_denom
+    reference_out, reference_max, reference_denom = reference_gqa(
+        jnp.squeeze(q),
+        jnp.swapaxes(dequantize(k, k_scale), 1, 2),
+        jnp.swapaxes(dequantize(v, v_scale), 1, 2),
+        lengths,
+    )
+    self.assertTrue(
+        jnp.max(abs(ragged_out - reference_out)) < 1e-1,
+        msg=f"Max difference: {jnp.max(abs(ragged_out - reference_out))} > 1e-1",
+    )
+    self.assertTrue(
+        jnp.average(abs(ragged_out - reference_out)) < 1e-2,
+        msg=f"Avg difference: {jnp.average(abs(ragged_out - reference_out))} > 1e-2",
+    )
+
+  def test_ragged_gqa_rejects_int4(self):
+    q = jnp.zeros((self.batch_size, 1, self.num_query_heads, self.head_dim), dtype=self.dtype)
+    shape = (self.batch_size, self.max_target_length, self.num_kv_heads, self.head_dim)
+    k = v = jnp.zeros(shape, dtype=jnp.int4)
+    scale = jnp.ones(shape[:2] + (1, 1))
+    lengths = jnp.ones((self.batch_size,), dtype=jnp.int32)
+    with self.assertRaises(ValueError):
+      ragged_gqa(q, k, v, lengths, scale, scale)
+
+
+class PagedAttentionTest(unittest.TestCase):
+  """Tests for paged attention kernel."""
+
+  batch_size = 4
+  num_kv_heads = 8
+  num_query_heads = 32
+  max_target_length = 512
+  page_size = 64
+  head_dim = 128
+
+  dtype = jnp.float32
+  key = jax.random.key(0)
+  k1, k2, k3, k4 = jax.random.split(key, 4)
+
+  def get_paged_data(self):
+    """Random dense keys and values, and the same data scattered to shuffled pages of a pool."""
+    pages_per_slot = self.max_target_length // self.page_size
+    num_pages = self.batch_size * pages_per_slot
+    q = jax.random.normal(self.k1, (self.batch_size, 1, self.num_query_heads, self.head_dim), dtype=self.dtype)
+    k = jax.random.normal(
+        self.k2, (self.batch_size, self.num_kv_heads, self.max_target_length, self.head_dim), dtype=self.dtype
+    )
+    v = jax.random.normal(
+        self.k3, (self.batch_size, self.num_kv_heads, self.max_target_length, self.head_dim), dtype=self.dtype
+    )
+    lengths = jnp.array(np.random.randint(1, self.max_target_length, self.batch_size), dtype=jnp.int32)
+    block_tables = jax.random.permutation(self.k4, num_pages).reshape(self.batch_size, pages_per_slot).astype(jnp.int32)
+
+    def to_pages(x):
+      x = x.reshape(self.batch_size, self.num_kv_heads, pages_per_slot, self.page_size, self.head_dim)
+      x = jnp.swapaxes(x, 0, 1).reshape(self.num_kv_heads, num_pages, self.page_size, self.head_dim)
+      return jnp.zeros_like(x).at[:, block_tables.reshape(-1)].set(x)
+
+    return q, k, v, to_pages(k), to_pages(v), lengths, block_tables
+
+  @pytest.mark.tpu
+  def test_reference_paged_gqa(self):
+    q, k, v, k_pages, v_pages, lengths, block_tables = self.get_paged_data()
+
+    paged_out, _, _ = reference_paged_gqa(q, k_pages, v_pages, lengths, block_tables)
+    reference_out, _, _ = reference_gqa(jnp.squeeze(q), k, v, lengths)
+    self.assertTrue(
+        jnp.max(abs(paged_out - reference_out)) < 1e-3,
+        msg=f"Max difference: {jnp.max(abs(paged_out - reference_out))} > 1e-3",
+    )
+
+  @pytest.mark.tpu
+  def test_paged_gqa(self):
+    q, k, v, k_pages, v_pages, lengths, block_tables = self.get_paged_data()
+
+    paged_out, paged_max, paged_denom = paged_gqa(q, k_pages, v_pages, lengths, block_tables)
+    paged_out = paged_out / paged_denom
+    reference_out, reference_max, reference_denom = reference_gqa(jnp.squeeze(q), k, v, lengths)
+    self.assertTrue(
+        jnp.max(abs(paged_out - reference_out)) < 1e-1,
+        msg=f"Max difference: {jnp.max(abs(paged_out - reference_out))} > 1e-1",
+    )
+    self.assertTrue(
+        jnp.average(abs(paged_out - reference_out)) < 1e-2,
+        msg=f"Avg difference: {jnp.average(abs(paged_out - reference_out))} > 1e-2",
+    )
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,249 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for MaxEngine, e.g. its batched entry points against single prompt prefill, insert and generate """
+
+import sys
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import common_types
+import pyconfig
+from maxengine import MaxEngine
+
+PROMPTS = [[5, 9, 2, 7], [3, 1], [8, 6, 4]]
+
+
+class MaxEngineTest(unittest.TestCase):
+  """Tests that the batched entry points of MaxEngine generate what one prompt at a time does."""
+
+  def setUp(self):
+    super().setUp()
+    self.init_engine()
+
+  def init_engine(self, max_prefill_predict_length=16, **kwargs):
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=4.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        dtype="float32",
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_target_length=24,
+        max_prefill_predict_length=max_prefill_predict_length,
+        **kwargs,
+    )
+    self.engine = MaxEngine(pyconfig.config)
+    self.params = self.engine.load_params(rng=jax.random.PRNGKey(0))
+
+  def pad(self, prompt, length=8):
+    return jnp.array(prompt + [0] * (length - len(prompt)), dtype=jnp.int32)
+
+  def decode(self, decode_state, num_steps):
+    """Returns the decode state after num_steps generate steps and the [batch, num_steps] generated tokens."""
+    tokens = []
+    for _ in range(num_steps):
+      decode_state, result_tokens = self.engine.generate(self.params, decode_state)
+      tokens.append(np.asarray(result_tokens.data[:, result_tokens.tokens_idx[0]]))
+    return decode_state, np.stack(tokens, axis=1)
+
+  def insert_one_at_a_time(self, prompts):
+    """Prefills and inserts prompts one at a time into slots 0, 1, ..., returns their first tokens and the decode state."""
+    decode_state = self.engine.init_decode_state()
+    first_tokens = []
+    for slot, prompt in enumerate(prompts):
+      prefix, first_token = self.engine.prefill(
+          params=self.params, padded_tokens=self.pad(prompt), true_length=len(prompt)
+      )
+      first_tokens.append(int(first_token.data[0, 0]))
+      decode_state = self.engine.insert(prefix, decode_state, slot)
+    return first_tokens, decode_state
+
+  def assert_caches_close(self, cache, expected_cache):
+    jax.tree_util.tree_map(lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5), cache, expected_cache)
+
+  def test_prefill_batch(self):
+    expected_first_tokens, expected_state = self.insert_one_at_a_time(PROMPTS)
+
+    prefix, first_tokens = self.engine.prefill_batch(
+        params=self.params,
+        padded_tokens=jnp.stack([self.pad(prompt) for prompt in PROMPTS]),
+        true_lengths=jnp.array([len(prompt) for prompt in PROMPTS]),
+    )
+    decode_state = self.engine.insert_batch(prefix, self.engine.init_decode_state(), jnp.arange(len(PROMPTS)))
+
+    self.assertEqual([int(token) for token in first_tokens.data[:, 0]], expected_first_tokens)
+    self.assert_caches_close(decode_state["cache"], expected_state["cache"])
+    _, expected_tokens = self.decode(expected_state, 4)
+    _, tokens = self.decode(decode_state, 4)
+    np.testing.assert_array_equal(tokens[: len(PROMPTS)], expected_tokens[: len(PROMPTS)])
+
+  def prefill_insert_packed(self, prompts):
+    """Like `insert_one_at_a_time`, with the prompts prefilled packed into one sequence."""
+    lengths = [len(prompt) for prompt in prompts]
+    starts = np.cumsum([0] + lengths[:-1])
+    prefix, first_tokens = self.engine.prefill_packed(
+        params=self.params,
+        padded_tokens=self.pad(sum(prompts, []), 16),
+        decoder_positions=self.pad([i for length in lengths for i in range(length)], 16),
+        decoder_segment_ids=self.pad([i + 1 for i, length in enumerate(lengths) for _ in range(length)], 16),
+        start_positions=jnp.array(starts),
+        true_lengths=jnp.array(lengths),
+    )
+    decode_state = self.engine.insert_batch(prefix, self.engine.init_decode_state(), jnp.arange(len(prompts)))
+    return [int(token) for token in first_tokens.data[:, 0]], decode_state
+
+  def test_prefill_packed(self):
+    expected_first_tokens, expected_state = self.insert_one_at_a_time(PROMPTS)
+    first_tokens, decode_state = self.prefill_insert_packed(PROMPTS)
+
+    self.assertEqual(first_tokens, expected_first_tokens)
+    _, expected_tokens = self.decode(expected_state, 4)
+    _, tokens = self.decode(decode_state, 4)
+    np.testing.assert_array_equal(tokens[: len(PROMPTS)], expected_tokens[: len(PROMPTS)])
+
+  def test_prefill_packed_isolates_prompts(self):
+    _, decode_state = self.prefill_insert_packed(PROMPTS)
+    # Only the middle prompt differs, the prompts around it must not see it.
+    _, other_decode_state = self.prefill_insert_packed([PROMPTS[0], [11, 12], PROMPTS[2]])
+
+    cache, other_cache = decode_state["cache"], other_decode_state["cache"]
+    for (path, leaf), other_leaf, names in zip(
+        jax.tree_util.tree_leaves_with_path(cache),
+        jax.tree_util.tree_leaves(other_cache),
+        jax.tree_util.tree_structure(cache).flatten_up_to(self.engine.kv_cache_annotations_named),
+    ):
+      if path[-1].key.startswith(("cached_prefill", "cache_prefill")):
+        batch_idx = names.index("cache_batch")
+        for slot in (0, 2):
+          np.testing.assert_allclose(
+              np.take(leaf, slot, axis=batch_idx), np.take(other_leaf, slot, axis=batch_idx), rtol=1e-5, atol=1e-5
+          )
+    _, tokens = self.decode(decode_state, 4)
+    _, other_tokens = self.decode(other_decode_state, 4)
+    np.testing.assert_array_equal(tokens[[0, 2]], other_tokens[[0, 2]])
+
+  def generate_n(self, num_steps, eos_id=None):
+    """Returns the [batch, num_steps] tokens and validity of one generate_n call after inserting PROMPTS."""
+    _, decode_state = self.insert_one_at_a_time(PROMPTS)
+    _, result_tokens = self.engine.generate_n(self.params, decode_state, num_steps=num_steps, eos_id=eos_id)
+    data = np.asarray(result_tokens.data)
+    tokens = data[:, result_tokens.tokens_idx[0] : result_tokens.tokens_idx[1]]
+    valid = data[:, result_tokens.valid_idx[0] : result_tokens.valid_idx[1]]
+    return tokens, valid
+
+  def test_generate_n(self):
+    _, expected_state = self.insert_one_at_a_time(PROMPTS)
+    _, expected_tokens = self.decode(expected_state, 4)
+
+    tokens, valid = self.generate_n(4)
+
+    np.testing.assert_array_equal(tokens[: len(PROMPTS)], expected_tokens[: len(PROMPTS)])
+    np.testing.assert_array_equal(valid[: len(PROMPTS)], 1)
+
+  def test_generate_n_masks_tokens_after_eos(self):
+    _, expected_state = self.insert_one_at_a_time(PROMPTS)
+    _, expected_tokens = self.decode(expected_state, 4)
+    # The third token of the first prompt ends it partway, as well as any other prompt generating it.
+    eos_id = int(expected_tokens[0, 2])
+
+    tokens, valid = self.generate_n(4, eos_id=eos_id)
+
+    np.testing.assert_array_equal(tokens[: len(PROMPTS)], expected_tokens[: len(PROMPTS)])
+    for slot in range(len(PROMPTS)):
+      is_eos = expected_tokens[slot] == eos_id
+      num_valid = int(np.argmax(is_eos)) + 1 if is_eos.any() else 4
+      np.testing.assert_array_equal(valid[slot], [1] * num_valid + [0] * (4 - num_valid))
+    self.assertLessEqual(int(np.sum(valid[0])), 3)
+
+  def test_bulk_insert(self):
+    _, expected_state = self.insert_one_at_a_time(PROMPTS)
+
+    # Prefixes of different prefill lengths.
+    prefixes = [
+        self.engine.prefill(params=self.params, padded_tokens=self.pad(prompt, length), true_length=len(prompt))[0]
+        for prompt, length in zip(PROMPTS, (8, 4, 16))
+    ]
+    decode_state = self.engine.bulk_insert(prefixes, self.engine.init_decode_state(), jnp.arange(len(PROMPTS)))
+
+    _, expected_tokens = self.decode(expected_state, 4)
+    _, tokens = self.decode(decode_state, 4)
+    np.testing.assert_array_equal(tokens[: len(PROMPTS)], expected_tokens[: len(PROMPTS)])
+
+  def test_chunked_prefill_past_max_prefill_length(self):
+    prompt = [5, 9, 2, 7, 3, 1, 8, 6, 4, 11, 13]
+
+    def prefill_and_decode(chunk_size):
+      # Another slot decodes first, so that the shared cache_ar_index has moved on when the prompt is inserted.
+      decode_state = self.engine.init_decode_state()
+      prefix, _ = self.engine.prefill(params=self.params, padded_tokens=self.pad(PROMPTS[1]), true_length=2)
+      decode_state, _ = self.decode(self.engine.insert(prefix, decode_state, 0), 2)
+      prefix = None
+      for start in range(0, len(prompt), chunk_size):
+        chunk = prompt[start : start + chunk_size]
+        prefix, first_token = self.engine.prefill(
+            params=self.params, existing_prefix=prefix, padded_tokens=self.pad(chunk, chunk_size), true_length=len(chunk)
+        )
+      decode_state, tokens = self.decode(self.engine.insert(prefix, decode_state, 1), 6)
+      return [int(first_token.data[0, 0])] + list(tokens[1])
+
+    expected_tokens = prefill_and_decode(chunk_size=16)
+    # The last 3 prompt tokens don't fit in the prefill cache.
+    self.init_engine(max_prefill_predict_length=8, prefill_chunk_size=4)
+    self.assertEqual(prefill_and_decode(chunk_size=4), expected_tokens)
+
+  def test_logprobs(self):
+    self.assertNotIn("logits", self.engine.init_decode_state())
+    self.init_engine(logprobs_top_k=4)
+    prompt = PROMPTS[0]
+    prefix, first_token = self.engine.prefill(params=self.params, padded_tokens=self.pad(prompt), true_length=len(prompt))
+    first_token = int(first_token.data[0, 0])
+
+    # The logits of the last prompt token and of the first generated one, from a forward pass over both.
+    sequence = jnp.array([prompt + [first_token]], dtype=jnp.int32)
+    logits = self.engine.model.apply(
+        self.params,
+        sequence,
+        jnp.arange(sequence.shape[1])[None, :],
+        decoder_segment_ids=jnp.ones_like(sequence),
+        enable_dropout=False,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"params": jax.random.PRNGKey(0)},
+    )
+    expected_values, expected_tokens = jax.lax.top_k(jax.nn.log_softmax(logits[0, -2:].astype(jnp.float32)), 4)
+
+    self.assertNotIn("logits", prefix)
+    np.testing.assert_allclose(prefix["logprobs"]["values"], expected_values[:1], rtol=1e-4, atol=1e-4)
+    np.testing.assert_array_equal(prefix["logprobs"]["tokens"], expected_tokens[:1])
+    decode_state = self.engine.insert(prefix, self.engine.init_decode_state(), 0)
+    self.assertNotIn("logits", decode_state)
+    self.assertEqual(decode_state["logprobs"]["values"].shape, (self.engine.max_concurrent_decodes, 4))
+    np.testing.assert_allclose(decode_state["logprobs"]["values"][0], expected_values[0], rtol=1e-4, atol=1e-4)
+    decode_state, _ = self.engine.generate(self.params, decode_state)
+    self.assertEqual(decode_state["logprobs"]["tokens"].shape, (self.engine.max_concurrent_decodes, 4))
+    np.testing.assert_allclose(decode_state["logprobs"]["values"][0], expected_values[1], rtol=1e-4, atol=1e-4)
+    np.testing.assert_array_equal(decode_state["logprobs"]["tokens"][0], expected_tokens[1])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -105,6 +105,37 @@ class TestModel(unittest.TestCase):
   def test_logits_dtype_without_cast(self):
     self._test_logits_cast_driver(cast_logits_to_fp32=False, expected_dtype=jnp.bfloat16)
 
+  def test_prefill_logits_positions(self):
+    devices_array = max_utils.create_device_mesh(self.cfg)
+    mesh = Mesh(devices_array, self.cfg.mesh_axes)
+    model = models.Transformer(config=self.cfg, mesh=mesh, quant=None)
+
+    ids, decoder_segment_ids, decoder_positions = self.get_data()
+    transformer_vars = model.init(
+        {"params": self.rng, "aqt": self.rng}, ids, decoder_positions, decoder_segment_ids, enable_dropout=False
+    )
+
+    def prefill(logits_positions=None):
+      logits, _ = model.apply(
+          transformer_vars,
+          ids[:, :MAX_PREFILL_PREDICT_LENGTH],
+          decoder_positions[:, :MAX_PREFILL_PREDICT_LENGTH],
+          decoder_segment_ids=decoder_segment_ids[:, :MAX_PREFILL_PREDICT_LENGTH],
+          enable_dropout=False,
+          model_mode=common_types.MODEL_MODE_PREFILL,
+          logits_positions=logits_positions,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      return logits
+
+    batch_size = ids.shape[0]
+    last_positions = jnp.full((batch_size, 1), MAX_PREFILL_PREDICT_LENGTH - 1, dtype=jnp.int32)
+    full_logits = prefill()
+    last_logits = prefill(last_positions)
+    self.assertEqual(last_logits.shape, (batch_size, 1, self.cfg.vocab_size))
+    self.assertTrue(jax.numpy.allclose(full_logits[:, -1:, :], last_logits, rtol=1e-02, atol=1e-02, equal_nan=False))
+
   @pytest.mark.tpu
   def test_train_vs_prefill_and_autoregress(self):
     PREFILL_RANGE = MAX_PREFILL_PREDICT_LENGTH
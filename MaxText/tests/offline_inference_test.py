@@ -0,0 +1,163 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the offline inference loop """
+
+import os
+import sys
+import unittest
+
+import jax.numpy as jnp
+
+import pyconfig
+from maxengine import MaxEngine
+
+# offline_inference imports its siblings as top level modules.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference_mlperf"))
+from offline_inference import InputData, OfflineInference  # pylint: disable=wrong-import-position
+
+
+class OfflineInferenceTest(unittest.TestCase):
+  """Tests of OfflineInference.batch_inference_with_callback."""
+
+  def test_eos_ends_rows_with_per_slot_stop_criteria(self):
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=2.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_target_length=16,
+        max_prefill_predict_length=8,
+        tokenizer_path="../assets/tokenizer.llama2",
+        per_slot_stop_criteria=True,
+    )
+    inference = OfflineInference(MaxEngine(pyconfig.config), None, None)
+    inference.init_decode_state()
+    data = [
+        InputData(id=str(i), tokens=jnp.array([1, 5 + i, 7, 0, 0, 0, 0, 0], dtype=jnp.int32), true_length=3)
+        for i in range(3)
+    ]
+    generated = {row.id: [] for row in data}
+    done = []
+
+    def emit_token(id_, token):
+      generated[id_].append(token)
+      return True  # Every first decoded token is the eos token, long before max_new_tokens.
+
+    inference.batch_inference_with_callback(
+        data, emit_first_token=lambda id_, token: False, emit_token=emit_token, desc="test", emit_done=done.append
+    )
+
+    self.assertEqual(sorted(done), [row.id for row in data])
+    for row in data:
+      self.assertEqual(len(generated[row.id]), 1)
+
+  def test_rows_end_at_their_own_max_decode_length(self):
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=2.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_target_length=16,
+        max_prefill_predict_length=8,
+        tokenizer_path="../assets/tokenizer.llama2",
+    )
+    inference = OfflineInference(MaxEngine(pyconfig.config), None, None)
+    inference.init_decode_state()
+    # As on an engine shared by a longer bucket, the short row ends before the engine's max_decode_length.
+    data = [
+        InputData(id="short", tokens=jnp.array([1, 5, 7, 0], dtype=jnp.int32), true_length=3, max_decode_length=3),
+        InputData(id="long", tokens=jnp.array([1, 6, 7, 0], dtype=jnp.int32), true_length=3),
+    ]
+    generated = {row.id: [] for row in data}
+
+    def emit_token(id_, token):
+      generated[id_].append(token)
+      return False
+
+    inference.batch_inference_with_callback(
+        data, emit_first_token=lambda id_, token: False, emit_token=emit_token, desc="test"
+    )
+
+    self.assertEqual(inference.max_decode_length, 8)
+    self.assertEqual(len(generated["long"]) - len(generated["short"]), 8 - 3)
+
+  def test_pipelined_decode_matches_decoding_each_row_alone(self):
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=2.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        dtype="float32",
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_target_length=16,
+        max_prefill_predict_length=8,
+        tokenizer_path="../assets/tokenizer.llama2",
+    )
+    inference = OfflineInference(MaxEngine(pyconfig.config), None, None)
+    engine, params = inference.engine, inference.params
+    # Three rows for two slots: the short first row frees its slot for the third one while a step is in flight.
+    max_decode_lengths = {"0": 1, "1": 6, "2": 3}
+    data = [
+        InputData(
+            id=id_,
+            tokens=jnp.array([1, 5 + i, 7, 0, 0, 0, 0, 0], dtype=jnp.int32),
+            true_length=3,
+            max_decode_length=max_decode_length,
+        )
+        for i, (id_, max_decode_length) in enumerate(max_decode_lengths.items())
+    ]
+
+    expected = {}
+    for row in data:
+      prefix, first_token = engine.prefill(params=params, padded_tokens=row.tokens, true_length=row.true_length)
+      decode_state = engine.insert(prefix, engine.init_decode_state(), 0)
+      expected[row.id] = [int(first_token.data[0, 0])]
+      for _ in range(inference.max_decode_length + 1):
+        decode_state, result_tokens = engine.generate(params, decode_state)
+        expected[row.id].append(int(result_tokens.data[0, result_tokens.tokens_idx[0]]))
+
+    generated = {row.id: [] for row in data}
+
+    def emit(id_, token):
+      generated[id_].append(token)
+      return False
+
+    inference.init_decode_state()
+    inference.batch_inference_with_callback(data, emit_first_token=emit, emit_token=emit, desc="test")
+
+    for row in data:
+      self.assertEqual(generated[row.id], expected[row.id][: len(generated[row.id])])
+    # Every row ends the same number of tokens past its max_decode_length, none losing or gaining a stale token.
+    self.assertEqual(len({len(generated[id_]) - n for id_, n in max_decode_lengths.items()}), 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,76 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for decoding with the paged autoregressive kv cache """
+
+import sys
+import unittest
+
+import pytest
+
+import jax
+import jax.numpy as jnp
+
+import pyconfig
+from maxengine import MaxEngine
+
+
+class PagedAttentionTest(unittest.TestCase):
+  """Tests of MaxEngine.generate with a page pool too small for its slots."""
+
+  @pytest.mark.tpu
+  def test_exhausted_pool_invalidates_tokens(self):
+    # Two pages of two tokens per layer, so that the fifth token of a slot finds the pool exhausted.
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=1.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_target_length=16,
+        max_prefill_predict_length=8,
+        use_paged_attention=True,
+        paged_attention_page_size=2,
+        paged_attention_num_pages=2,
+        per_slot_stop_criteria=True,
+        tokenizer_path="../assets/tokenizer.llama2",
+    )
+    engine = MaxEngine(pyconfig.config)
+    params = engine.load_params(rng=jax.random.PRNGKey(0))
+    prefix, _ = engine.prefill(params=params, padded_tokens=jnp.array([1, 5, 9, 0], dtype=jnp.int32), true_length=3)
+    decode_state = engine.insert(prefix, engine.init_decode_state(), 0)
+
+    valid, done = [], []
+    for _ in range(6):
+      decode_state, result_tokens = engine.generate(params, decode_state)
+      valid.append(int(result_tokens.data[0, result_tokens.valid_idx[0]]))
+      done.append(bool(result_tokens.data[0, result_tokens.length_idx[1]]))
+
+    self.assertEqual(valid, [1, 1, 1, 1, 0, 0])
+    self.assertEqual(done, [False, False, False, False, True, True])
+    # The tokens that found no page were not counted into the cache.
+    lengths = engine._slot_cache_values(  # pylint: disable=protected-access
+        decode_state["cache"], engine.kv_cache_annotations_named, "cached_ar_lengths"
+    )
+    self.assertEqual(int(lengths[0]), 4)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,76 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the prefix cache """
+
+import unittest
+
+import jax.numpy as jnp
+
+from prefix_cache import PrefixCache
+
+
+def make_prefix(value):
+  return {"cache": jnp.full((4,), value, dtype=jnp.float32)}  # 16 bytes
+
+
+class PrefixCacheTest(unittest.TestCase):
+  """Tests for PrefixCache."""
+
+  def test_longest_prefix(self):
+    cache = PrefixCache(block_size=2, max_bytes=1024)
+    cache.insert([1, 2, 3, 4, 5], make_prefix(1))
+    cache.insert([1, 2, 7, 8], make_prefix(2))
+
+    prefix, length = cache.lookup([1, 2, 3, 4, 9, 9])
+    self.assertEqual(length, 4)
+    self.assertEqual(prefix["cache"][0], 1)
+
+    prefix, length = cache.lookup([1, 2, 9, 9])
+    self.assertEqual(length, 2)
+    self.assertEqual(prefix["cache"][0], 2)  # The most recently stored prefix covering the block.
+
+    self.assertEqual(cache.lookup([9, 9, 9]), (None, 0))
+
+  def test_max_length(self):
+    cache = PrefixCache(block_size=2, max_bytes=1024)
+    cache.insert([1, 2, 3, 4], make_prefix(1))
+    _, length = cache.lookup([1, 2, 3, 4], max_length=3)
+    self.assertEqual(length, 2)
+
+  def test_lru_eviction(self):
+    cache = PrefixCache(block_size=2, max_bytes=32)
+    cache.insert([1, 2], make_prefix(1))
+    cache.insert([3, 4], make_prefix(2))
+    cache.lookup([1, 2])  # [3, 4] is now least recently used.
+    cache.insert([5, 6], make_prefix(3))
+
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.num_bytes, 32)
+    self.assertEqual(cache.lookup([3, 4]), (None, 0))
+    self.assertEqual(cache.lookup([1, 2])[1], 2)
+    self.assertEqual(cache.lookup([5, 6])[1], 2)
+
+  def test_replaced_entry_is_freed(self):
+    cache = PrefixCache(block_size=2, max_bytes=1024)
+    cache.insert([1, 2], make_prefix(1))
+    cache.insert([1, 2, 3, 4], make_prefix(2))
+    self.assertEqual(len(cache), 1)
+    self.assertEqual(cache.num_bytes, 16)
+
+
+if __name__ == "__main__":
+  unittest.main()
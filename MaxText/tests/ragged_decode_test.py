@@ -0,0 +1,87 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for ragged attention decode over the prefill and autoregressive caches """
+
+import sys
+import unittest
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import pyconfig
+from maxengine import MaxEngine
+
+
+def ragged_config(**kwargs):
+  pyconfig.initialize(
+      [sys.argv[0], "configs/base.yml"],
+      per_device_batch_size=2.0,
+      run_name="test",
+      enable_checkpointing=False,
+      base_num_decoder_layers=2,
+      attention="dot_product",
+      dtype="float32",
+      base_emb_dim=256,
+      base_num_query_heads=4,
+      base_num_kv_heads=2,
+      head_dim=128,
+      base_mlp_dim=512,
+      max_prefill_predict_length=256,
+      max_target_length=512,
+      ragged_block_size=128,
+      **kwargs,
+  )
+  return pyconfig.config
+
+
+class RaggedDecodeTest(unittest.TestCase):
+  """Tests that ragged decode, reading every slot up to its own lengths, samples the tokens of dense decode."""
+
+  @pytest.mark.tpu
+  def test_matches_dense(self):
+    engine = MaxEngine(ragged_config(use_ragged_attention=True))
+    dense_engine = MaxEngine(ragged_config())
+    # The same rng initializes the same random weights.
+    params = engine.load_params(rng=jax.random.PRNGKey(0))
+    dense_params = dense_engine.load_params(rng=jax.random.PRNGKey(0))
+
+    # Prompts shorter than and spanning several kernel blocks of the prefill cache.
+    prompts = [[5, 9, 2], list(range(1, 201))]
+    results = []
+    for e, p in ((engine, params), (dense_engine, dense_params)):
+      decode_state = e.init_decode_state()
+      tokens = []
+      for slot, prompt in enumerate(prompts):
+        prefix, first_token = e.prefill(
+            params=p,
+            padded_tokens=jnp.array(prompt + [0] * (256 - len(prompt)), dtype=jnp.int32),
+            true_length=len(prompt),
+        )
+        decode_state = e.insert(prefix, decode_state, slot)
+        tokens.append([int(first_token.data[0, 0])])
+      for _ in range(4):
+        decode_state, result_tokens = e.generate(p, decode_state)
+        for slot, slot_tokens in enumerate(tokens):
+          slot_tokens.append(int(result_tokens.data[slot, 0]))
+      results.append(tokens)
+
+    self.assertEqual(results[0], results[1])
+
+
+if __name__ == "__main__":
+  unittest.main()
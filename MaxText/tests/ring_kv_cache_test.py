@@ -0,0 +1,83 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the ring kv cache of local sliding window attention layers """
+
+import sys
+import unittest
+
+import jax
+import jax.numpy as jnp
+
+import pyconfig
+from maxengine import MaxEngine
+
+
+def gemma2_config(**kwargs):
+  pyconfig.initialize(
+      [sys.argv[0], "configs/base.yml"],
+      per_device_batch_size=1.0,
+      run_name="test",
+      enable_checkpointing=False,
+      decoder_block="gemma2",
+      base_num_decoder_layers=1,
+      attention="dot_product",
+      dtype="float32",
+      base_emb_dim=256,
+      base_num_query_heads=2,
+      base_num_kv_heads=2,
+      head_dim=128,
+      base_mlp_dim=512,
+      sliding_window_size=4,
+      max_target_length=16,
+      **kwargs,
+  )
+  return pyconfig.config
+
+
+class RingKVCacheTest(unittest.TestCase):
+  """Tests that decoding local layers from a ring samples the tokens a prefill of the whole sequence does."""
+
+  def test_matches_prefill(self):
+    engine = MaxEngine(gemma2_config(max_prefill_predict_length=8, ring_local_kv_cache=True))
+    # Prefills whole sequences, which attend within the window through the mask.
+    reference_engine = MaxEngine(gemma2_config(max_prefill_predict_length=16))
+    # The same rng initializes the same random weights.
+    params = engine.load_params(rng=jax.random.PRNGKey(0))
+    reference_params = reference_engine.load_params(rng=jax.random.PRNGKey(0))
+
+    prompt = [5, 9, 2, 7, 3, 11]  # Longer than the window.
+    prefix, first_token = engine.prefill(
+        params=params, padded_tokens=jnp.array(prompt + [0, 0], dtype=jnp.int32), true_length=len(prompt)
+    )
+    decode_state = engine.insert(prefix, engine.init_decode_state(), 0)
+    tokens = [int(first_token.data[0, 0])]
+    for _ in range(6):
+      decode_state, result_tokens = engine.generate(params, decode_state)
+      tokens.append(int(result_tokens.data[0, 0]))
+
+    for i, token in enumerate(tokens):
+      sequence = prompt + tokens[:i]
+      _, expected = reference_engine.prefill(
+          params=reference_params,
+          padded_tokens=jnp.array(sequence + [0] * (16 - len(sequence)), dtype=jnp.int32),
+          true_length=len(sequence),
+      )
+      self.assertEqual(token, int(expected.data[0, 0]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,94 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the offline inference schedulers """
+
+import os
+import tempfile
+import unittest
+
+from inference_mlperf import scheduler
+
+
+def make_entry(id_, padded_length, output_length):
+  return scheduler.TraceEntry(
+      id=str(id_),
+      tokens=[1] * padded_length,
+      true_length=padded_length,
+      output_length=output_length,
+      expected_output_length=output_length,
+  )
+
+
+class SchedulerTest(unittest.TestCase):
+  """Tests for the scheduling policies and the simulator."""
+
+  def test_order(self):
+    trace = [make_entry(0, 64, 10), make_entry(1, 32, 30), make_entry(2, 64, 20)]
+    ids = lambda rows: [row.id for row in rows]
+    self.assertEqual(ids(scheduler.create_scheduler("fifo").order(trace)), ["0", "1", "2"])
+    self.assertEqual(ids(scheduler.create_scheduler("shortest_output_first").order(trace)), ["0", "2", "1"])
+    self.assertEqual(ids(scheduler.create_scheduler("longest_output_first").order(trace)), ["1", "2", "0"])
+    self.assertEqual(ids(scheduler.create_scheduler("bucket").order(trace)), ["0", "2", "1"])
+
+  def test_num_prefills_allowed(self):
+    policy = scheduler.Scheduler(max_prefills_per_decode=2, min_empty_slots=3)
+    self.assertEqual(policy.num_prefills_allowed(0, 4, 0), 4)  # Nothing to decode.
+    self.assertEqual(policy.num_prefills_allowed(0, 2, 2), 0)  # Waiting for more empty slots.
+    self.assertEqual(policy.num_prefills_allowed(0, 4, 2), 2)
+    self.assertEqual(policy.num_prefills_allowed(2, 2, 2), 0)
+
+  def test_latency_target(self):
+    policy = scheduler.LatencyTargetScheduler(tpot_target=0.2, ttft_target=2.0, prefill_time=0.05, decode_step_time=0.08)
+    self.assertEqual(policy.max_prefills_per_decode, 2)
+    self.assertEqual(policy.num_prefills_allowed(0, 4, 2), 2)
+    self.assertEqual(policy.num_prefills_allowed(2, 2, 2), 0)
+    self.assertEqual(policy.num_prefills_allowed(2, 2, 2, oldest_wait=1.96), 1)  # About to miss its first token target.
+    self.assertEqual(policy.num_prefills_allowed(2, 0, 4, oldest_wait=1.96), 0)
+
+  def test_latency_target_late_backlog_still_decodes(self):
+    policy = scheduler.LatencyTargetScheduler(tpot_target=0.2, ttft_target=2.0, prefill_time=0.05, decode_step_time=0.08)
+    # Every queued row is late, yet only one of them is prefilled past the budget before the next decode step.
+    allowed = [policy.num_prefills_allowed(n, 8 - n, 2, oldest_wait=5.0) for n in range(6)]
+    self.assertEqual(allowed, [2, 1, 1, 0, 0, 0])
+
+  def test_simulate_longest_first_shortens_drain(self):
+    trace = [make_entry(i, 32, 4) for i in range(6)] + [make_entry(6, 32, 40)]
+    results = {
+        policy: scheduler.simulate(scheduler.create_scheduler(policy), trace, batch_size=2, max_decode_length=64)
+        for policy in ["fifo", "longest_output_first"]
+    }
+    self.assertEqual(results["fifo"].num_prefill_calls, 7)
+    self.assertLess(results["longest_output_first"].total_time, results["fifo"].total_time)
+    self.assertLess(results["longest_output_first"].drain_time, results["fifo"].drain_time)
+
+  def test_simulate_batches_prefills(self):
+    trace = [make_entry(i, 32, 2) for i in range(4)]
+    result = scheduler.simulate(scheduler.Scheduler(), trace, batch_size=4, max_decode_length=8, max_prefill_batch_size=4)
+    self.assertEqual(result.num_prefill_calls, 1)
+    self.assertEqual(result.num_decodes, 1)
+    self.assertEqual(result.slot_utilization, 1.0)
+
+  def test_trace_round_trip(self):
+    trace = [make_entry(0, 32, 5), make_entry(1, 64, 7)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, "trace.jsonl")
+      scheduler.save_trace(trace, path)
+      self.assertEqual(scheduler.load_trace(path), trace)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,88 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for offloading decode slots to host memory and restoring them """
+
+import sys
+import unittest
+
+import jax
+import jax.numpy as jnp
+
+import pyconfig
+from maxengine import MaxEngine
+
+
+class SlotOffloadTest(unittest.TestCase):
+  """Tests that a request offloaded mid generation and restored into another slot generates the same tokens."""
+
+  def setUp(self):
+    super().setUp()
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=2.0,
+        run_name="test",
+        enable_checkpointing=False,
+        base_num_decoder_layers=2,
+        attention="dot_product",
+        dtype="float32",
+        base_emb_dim=256,
+        base_num_query_heads=2,
+        base_num_kv_heads=2,
+        max_target_length=16,
+        max_prefill_predict_length=8,
+    )
+    self.engine = MaxEngine(pyconfig.config)
+    self.params = self.engine.load_params(rng=jax.random.PRNGKey(0))
+
+  def prefill(self, prompt):
+    return self.engine.prefill(
+        params=self.params,
+        padded_tokens=jnp.array(prompt + [0] * (8 - len(prompt)), dtype=jnp.int32),
+        true_length=len(prompt),
+    )
+
+  def generate(self, decode_state, slot, tokens, steps):
+    for _ in range(steps):
+      decode_state, result_tokens = self.engine.generate(self.params, decode_state)
+      tokens.append(int(result_tokens.data[slot, 0]))
+    return decode_state
+
+  def test_restore_matches_uninterrupted(self):
+    prompt = [5, 9, 2, 7]
+    prefix, first_token = self.prefill(prompt)
+    decode_state = self.engine.insert(prefix, self.engine.init_decode_state(), 0)
+    expected = [int(first_token.data[0, 0])]
+    self.generate(decode_state, 0, expected, 6)
+
+    prefix, first_token = self.prefill(prompt)
+    decode_state = self.engine.insert(prefix, self.engine.init_decode_state(), 0)
+    tokens = [int(first_token.data[0, 0])]
+    decode_state = self.generate(decode_state, 0, tokens, 3)
+    offloaded = self.engine.offload_slot(decode_state, 0)
+
+    # Another request takes over the slot, moving the ar cache index on, before the first one resumes elsewhere.
+    other_prefix, _ = self.prefill([3, 1])
+    decode_state = self.engine.insert(other_prefix, decode_state, 0)
+    decode_state = self.generate(decode_state, 0, [], 2)
+    decode_state = self.engine.restore_slot(offloaded, decode_state, 1)
+    self.generate(decode_state, 1, tokens, 3)
+
+    self.assertEqual(tokens, expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
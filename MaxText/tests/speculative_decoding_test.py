@@ -0,0 +1,94 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for speculative decoding with a draft model """
+
+import sys
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import pyconfig
+from maxengine import MaxEngine
+
+
+class SpeculativeDecodingTest(unittest.TestCase):
+  """Tests the autoregressive caches of the target and draft models across speculative steps."""
+
+  def setUp(self):
+    super().setUp()
+    model_args = {
+        "base_num_decoder_layers": 2,
+        "attention": "dot_product",
+        "dtype": "float32",
+        "scan_layers": False,
+        "base_emb_dim": 256,
+        "base_mlp_dim": 512,
+        "base_num_query_heads": 2,
+        "base_num_kv_heads": 2,
+    }
+    draft_args = model_args | {"base_num_decoder_layers": 1, "run_name": "draft", "enable_checkpointing": False}
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=2.0,
+        run_name="test",
+        enable_checkpointing=False,
+        max_target_length=24,
+        max_prefill_predict_length=8,
+        speculative_num_tokens=3,
+        speculative_draft_args=" ".join(f"{k}={v}" for k, v in draft_args.items()),
+        **model_args,
+    )
+    self.engine = MaxEngine(pyconfig.config)
+    self.params = self.engine.load_params(rng=jax.random.PRNGKey(0))
+
+  def assert_cache_holds_emitted_tokens(self, cache, generated_tokens):
+    """Asserts the ar cache of every slot holds exactly its emitted tokens, at its first positions."""
+    for path, leaf in jax.tree_util.tree_leaves_with_path(cache):
+      if path[-1].key == "cached_ar_lengths":
+        np.testing.assert_array_equal(leaf, generated_tokens)
+      elif path[-1].key == "cache_ar_segment_id":
+        positions = np.arange(leaf.shape[1])[None, :]
+        np.testing.assert_array_equal(np.asarray(leaf) != 0, positions < generated_tokens[:, None])
+
+  def test_rejected_entries_are_rolled_back(self):
+    decode_state = self.engine.init_decode_state()
+    for slot, prompt in enumerate([[5, 9, 2, 7], [3, 1]]):
+      prefix, _ = self.engine.prefill(
+          params=self.params,
+          padded_tokens=jnp.array(prompt + [0] * (8 - len(prompt)), dtype=jnp.int32),
+          true_length=len(prompt),
+      )
+      decode_state = self.engine.insert(prefix, decode_state, slot)
+
+    num_steps = self.engine.config.speculative_num_tokens + 1
+    num_rejected = 0
+    for _ in range(3):
+      decode_state, result_tokens = self.engine.generate(self.params, decode_state)
+      num_emitted = np.sum(result_tokens.data[:, result_tokens.valid_idx[0] : result_tokens.valid_idx[1]], axis=1)
+      num_rejected += int(np.sum(num_steps - num_emitted))
+      # The shared ring index would have moved num_steps entries per step, the slots only their emitted tokens.
+      generated_tokens = np.asarray(decode_state["generated_tokens"])[:, 0]
+      self.assert_cache_holds_emitted_tokens(decode_state["cache"], generated_tokens)
+      self.assert_cache_holds_emitted_tokens(decode_state["draft_cache"], generated_tokens)
+    # The draft model differs from the target one, so that some of its tokens are rejected.
+    self.assertGreater(num_rejected, 0)
+
+
+if __name__ == "__main__":
+  unittest.main()